@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+import array
+import getopt
+import logging
+import random
+import resource
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from coapthon import defines
+from coapthon.client.helperclient import HelperClient
+from coapthon.layers.blocklayer import BlockSizePolicy
+from coapthon.messages.request import Request
+from coapthon.resources.resource import Resource
+from coapthon.server.coap import CoAP
+
+__author__ = 'giacomo'
+
+SIZES = (1024, 10240, 102400, 1048576, 10485760)
+
+
+class BlockResource(Resource):
+    def __init__(self, name="Block", coap_server=None):
+        super(BlockResource, self).__init__(name, coap_server, visible=True, observable=False,
+                                            allow_children=False)
+        self.payload = ""
+        self.streaming_body = True
+        # size of the last body received
+        self.received = 0
+
+    def render_GET(self, request):
+        return self
+
+    def render_PUT(self, request):
+        body = request.payload
+        if hasattr(body, "read"):
+            # spooled to a temporary file
+            body.seek(0, 2)
+            self.received = body.tell()
+            body.close()
+        else:
+            self.received = len(body)
+        return self
+
+
+class LossyRelay(object):
+    def __init__(self, server, loss, seed=None):
+        """
+        UDP relay between one client and the server, dropping datagrams in both directions. It measures the latency
+        of every block: from the first transmission of a request to the response forwarded to the client.
+
+        :param server: the (ip, port) of the server
+        :param loss: the probability of dropping a datagram
+        :param seed: the seed of the losses
+        """
+        self.server = server
+        self.loss = loss
+        self._random = random.Random(seed)
+        self._front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._front.bind(("127.0.0.1", 0))
+        self._back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._back.bind(("127.0.0.1", 0))
+        self.address = self._front.getsockname()
+        self._client = None
+        # MID -> time of the first transmission of a request
+        self._sent = {}
+        self.latencies = array.array("d")
+        self.dropped = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset(self):
+        """
+        Forget the latencies measured so far.
+
+        """
+        self._sent = {}
+        self.latencies = array.array("d")
+        self.dropped = 0
+
+    def run(self):
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self._front, self._back], [], [], 0.1)
+            for sock in readable:
+                datagram, source = sock.recvfrom(65535)
+                now = time.time()
+                if len(datagram) < 4:
+                    continue
+                mid = struct.unpack("!H", datagram[2:4])[0]
+                if self._random.random() < self.loss:
+                    self.dropped += 1
+                    if sock is self._front:
+                        self._sent.setdefault(mid, now)
+                    continue
+                if sock is self._front:
+                    self._client = source
+                    self._sent.setdefault(mid, now)
+                    self._back.sendto(datagram, self.server)
+                elif self._client is not None:
+                    sent = self._sent.pop(mid, None)
+                    # empty ACKs do not answer a block
+                    if sent is not None and ord(datagram[1]) != defines.Codes.EMPTY.number:
+                        self.latencies.append(now - sent)
+                    self._front.sendto(datagram, self._client)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self._front.close()
+        self._back.close()
+
+
+class MemorySampler(object):
+    def __init__(self, interval=0.01):
+        """
+        Sample the resident memory of the process while a transfer runs.
+
+        :param interval: the seconds between two samples
+        """
+        self.interval = interval
+        self.start = rss()
+        self.peak = self.start
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :return: the peak growth of the resident memory in KiB
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+        return self.peak - self.start
+
+
+def rss():
+    """
+    Get the resident memory of the process in KiB, from /proc if available, the peak otherwise.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, p):
+    """
+    Get a percentile of a sorted list.
+
+    :param values: the sorted values
+    :param p: the percentile, between 0 and 100
+    :return: the value, None if the list is empty
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def block_state(server, client):
+    """
+    Count the block-wise state left behind by the transfers.
+
+    :param server: the server
+    :param client: the HelperClient
+    :return: a dict table -> entries, with the bytes still counted in the budget of the server
+    """
+    layer = server._blockLayer
+    state = {}
+    for name in ("_block1_receive", "_block2_receive", "_block2_snapshots", "_block1_buffers"):
+        state["server" + name] = len(getattr(layer, name))
+    for name in ("_block1_sent", "_block2_sent"):
+        state["client" + name] = len(getattr(client.protocol._blockLayer, name))
+    state["client_block2_transfers"] = len(client.protocol._block2_transfers)
+    state["server_bytes_in_use"] = layer._bytes_in_use
+    return state
+
+
+def transfer(client, relay, method, size, block_size):
+    """
+    Transfer a payload and measure it.
+
+    :param client: the HelperClient
+    :param relay: the LossyRelay between the client and the server
+    :param method: "GET" for Block2, "PUT" for Block1
+    :param size: the size of the payload
+    :param block_size: the block size asked by the client, None for the default
+    :return: the response, the seconds elapsed, the growth of the resident memory in KiB
+    """
+    request = Request()
+    request.destination = client.server
+    request.uri_path = "block"
+    if method == "GET":
+        request.code = defines.Codes.GET.number
+        if block_size is not None:
+            request.block2 = (0, 0, block_size)
+    else:
+        request.code = defines.Codes.PUT.number
+        request.payload = "x" * size
+        if block_size is not None:
+            request.block1 = (0, 1, block_size)
+    relay.reset()
+    sampler = MemorySampler()
+    start = time.time()
+    response = client.send_request(request)
+    elapsed = time.time() - start
+    return response, elapsed, sampler.stop()
+
+
+def benchmark(port, sizes, loss, window, nstart, block_size, adaptive, seed):
+    """
+    Run the benchmark and print the report.
+
+    :param port: the port of the server on loopback
+    :param sizes: the sizes of the payloads
+    :param loss: the probability that the relay drops a datagram
+    :param window: the blocks of a Block2 transfer requested at once
+    :param nstart: the NSTART of the client
+    :param block_size: the block size asked by the client, None for the default
+    :param adaptive: if client and server choose the block size from the losses measured
+    :param seed: the seed of the losses
+    """
+    address = ("127.0.0.1", port)
+    server = CoAP(address, block_policy=BlockSizePolicy() if adaptive else None)
+    node = BlockResource()
+    server.add_resource("block/", node)
+    listener = threading.Thread(target=server.listen, args=(1,))
+    listener.start()
+    relay = LossyRelay(address, loss, seed)
+    client = HelperClient(relay.address, nstart=nstart, block2_window=window,
+                          block_policy=BlockSizePolicy() if adaptive else None)
+
+    print "Loss %.1f%%, Block2 window %d, NSTART %d, block size %s%s" % (
+        100 * loss, window, nstart, block_size or defines.MAX_PAYLOAD, ", adaptive" if adaptive else "")
+    leaked = False
+    try:
+        for size in sizes:
+            node.payload = "x" * size
+            for method in ("GET", "PUT"):
+                response, elapsed, memory = transfer(client, relay, method, size, block_size)
+                if method == "GET":
+                    ok = response is not None and response.payload is not None and len(response.payload) == size
+                else:
+                    ok = response is not None and node.received == size
+                latencies = sorted(relay.latencies)
+                # the last blocks of a pipelined transfer are answered after the response
+                time.sleep(0.2)
+                state = block_state(server, client)
+                leaks = ", ".join("%s %d" % (name, count) for name, count in sorted(state.items()) if count)
+                leaked = leaked or bool(leaks)
+                print "%-3s %9d B  %7.2f s  %9.1f KiB/s  %6d blocks  block latency (ms) p50 %s p99 %s  " \
+                      "dropped %d  peak RSS +%d KiB  %s  leaked: %s" % (
+                          method, size, elapsed, size / 1024.0 / elapsed, len(latencies),
+                          "%.2f" % (1000 * percentile(latencies, 50)) if latencies else "-",
+                          "%.2f" % (1000 * percentile(latencies, 99)) if latencies else "-",
+                          relay.dropped, memory, "ok" if ok else "FAILED", leaks or "none")
+                node.received = 0
+    finally:
+        client.stop()
+        relay.close()
+        server.close()
+        listener.join()
+    return not leaked
+
+
+def usage():  # pragma: no cover
+    print "benchmark_blockwise.py [-p <port>] [-s <size>[,<size>...]] [-l <loss>] [-w <window>] [-n <nstart>] " \
+          "[-b <block size>] [-a] [-r <seed>]"
+
+
+def main(argv):  # pragma: no cover
+    port = 5683
+    sizes = SIZES
+    loss = 0.0
+    window = 1
+    nstart = defines.NSTART
+    block_size = None
+    adaptive = False
+    seed = None
+
+    try:
+        opts, args = getopt.getopt(argv, "hp:s:l:w:n:b:ar:", ["port=", "sizes=", "loss=", "window=", "nstart=",
+                                                               "block-size=", "adaptive", "seed="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-s", "--sizes"):
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt in ("-l", "--loss"):
+            loss = float(arg)
+        elif opt in ("-w", "--window"):
+            window = int(arg)
+        elif opt in ("-n", "--nstart"):
+            nstart = int(arg)
+        elif opt in ("-b", "--block-size"):
+            block_size = int(arg)
+        elif opt in ("-a", "--adaptive"):
+            adaptive = True
+        elif opt in ("-r", "--seed"):
+            seed = int(arg)
+
+    logging.basicConfig(level=logging.ERROR)
+    if not benchmark(port, sizes, loss, window, nstart, block_size, adaptive, seed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
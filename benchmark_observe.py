@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import array
+import getopt
+import logging
+import multiprocessing
+import resource
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+
+__author__ = 'giacomo'
+
+# registrations in flight for every observer process, more overflow the receive buffer of the server
+WINDOW = 64
+
+
+class BenchmarkResource(Resource):
+    def __init__(self, name="Benchmark", coap_server=None):
+        super(BenchmarkResource, self).__init__(name, coap_server, visible=True, observable=True,
+                                                allow_children=False)
+        self.payload = repr(time.time())
+
+    def render_GET(self, request):
+        return self
+
+
+def register(sockets, observers, server, resources, con):
+    """
+    Register the observers, a window of requests at a time, sending again the requests left unanswered.
+
+    :param sockets: the sockets of the observers
+    :param observers: the ids of the observers, observer i uses socket i % len(sockets) and token i
+    :param server: the (ip, port) of the server
+    :param resources: the number of resources, observer i observes resource i % resources
+    :param con: if the registrations are CON
+    :return: the number of registered observers
+    """
+    serializer = Serializer()
+    # token -> observer, for the observers without a response
+    waiting = dict((struct.pack("!I", i), i) for i in observers)
+    for _ in range(defines.MAX_RETRANSMIT):
+        pending = sorted(waiting.values())
+        for start in range(0, len(pending), WINDOW):
+            window = pending[start:start + WINDOW]
+            for i in window:
+                request = Request()
+                request.type = defines.Types["CON"] if con else defines.Types["NON"]
+                request.code = defines.Codes.GET.number
+                # five digits like the ephemeral ports, the server keys exchanges on str(port) + str(mid)
+                request.mid = 10000 + i % 50000
+                request.token = struct.pack("!I", i)
+                request.destination = server
+                request.uri_path = "obs" + str(i % resources)
+                request.observe = 0
+                sockets[i % len(sockets)].sendto(serializer.serialize(request), server)
+            deadline = time.time() + defines.ACK_TIMEOUT
+            while time.time() < deadline and any(struct.pack("!I", i) in waiting for i in window):
+                readable, _, _ = select.select(sockets, [], [], max(deadline - time.time(), 0))
+                for sock in readable:
+                    datagram, source = sock.recvfrom(1152)
+                    message = serializer.deserialize(datagram, source)
+                    if isinstance(message, Response) and waiting.pop(message.token, None) is not None:
+                        # the server is busy but making progress
+                        deadline = time.time() + defines.ACK_TIMEOUT
+        if not waiting:
+            break
+    registered = len(observers) - len(waiting)
+    return registered
+
+
+def observe(server, resources, observers, sockets, con, ready, done, results):  # pragma: no cover
+    """
+    Body of an observer process: register the observers, then receive the notifications until done is set.
+    CON notifications are acknowledged.
+
+    :param server: the (ip, port) of the server
+    :param resources: the number of resources
+    :param observers: the ids of the observers simulated by this process
+    :param sockets: the number of sockets shared by the observers
+    :param con: if the registrations are CON
+    :param ready: the event set when the observers are registered
+    :param done: the event set when the updates are over
+    :param results: the queue receiving the number of registered observers, then the encoded latencies
+    """
+    socks = []
+    for _ in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.bind(("127.0.0.1", 0))
+        socks.append(sock)
+    registered = register(socks, observers, server, resources, con)
+    results.put(registered)
+    ready.set()
+
+    serializer = Serializer()
+    latencies = array.array("d")
+    drain = None
+    while drain is None or time.time() < drain:
+        if drain is None and done.is_set():
+            drain = time.time() + 1
+        readable, _, _ = select.select(socks, [], [], 0.1)
+        for sock in readable:
+            datagram, source = sock.recvfrom(1152)
+            now = time.time()
+            message = serializer.deserialize(datagram, source)
+            if not isinstance(message, Response) or message.observe is None:
+                continue
+            if message.type == defines.Types["CON"]:
+                sock.sendto(struct.pack("!BBH", (defines.VERSION << 6) | (defines.Types["ACK"] << 4), 0,
+                                        message.mid), source)
+            latencies.append(now - float(message.payload))
+    results.put(latencies.tostring())
+    for sock in socks:
+        sock.close()
+
+
+def percentile(values, p):
+    """
+    Get a percentile of a sorted list.
+
+    :param values: the sorted values
+    :param p: the percentile, between 0 and 100
+    :return: the value, None if the list is empty
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def rss():
+    """
+    Get the resident memory of the process in KiB, from /proc if available, the peak otherwise.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(port, observers, resources, rate, duration, processes, sockets, workers, con):
+    """
+    Run the benchmark and print the report.
+
+    :param port: the port of the server on loopback
+    :param observers: the number of observers
+    :param resources: the number of observed resources
+    :param rate: the resource updates per second, spread round robin over the resources
+    :param duration: the seconds the updates last
+    :param processes: the number of processes simulating the observers
+    :param sockets: the number of sockets of every observer process
+    :param workers: the notification workers of the server
+    :param con: if the registrations are CON
+    """
+    address = ("127.0.0.1", port)
+    server = CoAP(address, notification_workers=workers)
+    nodes = []
+    for i in range(resources):
+        node = BenchmarkResource()
+        server.add_resource("obs" + str(i) + "/", node)
+        nodes.append(node)
+    listener = threading.Thread(target=server.listen, args=(1,))
+    listener.start()
+
+    memory_start = rss()
+    results = multiprocessing.Queue()
+    done = multiprocessing.Event()
+    children = []
+    for p in range(processes):
+        ready = multiprocessing.Event()
+        child = multiprocessing.Process(target=observe, args=(address, resources, range(p, observers, processes),
+                                                              sockets, con, ready, done, results))
+        child.start()
+        children.append((child, ready))
+    start = time.time()
+    registered = 0
+    for child, ready in children:
+        ready.wait()
+        registered += results.get()
+    print "Registered %d/%d observers on %d resources in %.2f s" % (registered, observers, resources,
+                                                                   time.time() - start)
+    memory_registered = rss()
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    updates = 0
+    fan_out = []
+    while time.time() - start < duration:
+        node = nodes[updates % resources]
+        node.payload = repr(time.time())
+        node.observe_count += 1
+        before = time.time()
+        server.notify(node)
+        fan_out.append(time.time() - before)
+        updates += 1
+        delay = start + float(updates) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.time() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    done.set()
+
+    latencies = array.array("d")
+    for _ in children:
+        latencies.fromstring(results.get())
+    for child, _ in children:
+        child.join()
+    server.close()
+    listener.join()
+
+    latencies = sorted(latencies)
+    fan_out.sort()
+    expected = 0
+    for i in range(resources):
+        # observers of resource i times the updates of resource i
+        expected += len(range(i, observers, resources)) * (updates / resources + (1 if i < updates % resources else 0))
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    print "Updates: %d in %.2f s (%.1f/s)" % (updates, elapsed, updates / elapsed)
+    print "Notifications: %d received, %d expected, %.1f/s" % (len(latencies), expected, len(latencies) / elapsed)
+    print "Fan-out per update (ms): p50 %.2f p90 %.2f p99 %.2f max %.2f" % tuple(
+        1000 * percentile(fan_out, p) for p in (50, 90, 99, 100))
+    if latencies:
+        print "Notification latency (ms): p50 %.2f p90 %.2f p99 %.2f max %.2f" % tuple(
+            1000 * percentile(latencies, p) for p in (50, 90, 99, 100))
+    print "Server CPU: %.2f s (%.0f%%)" % (cpu, 100 * cpu / elapsed)
+    print "Server RSS (KiB): %d before registration, %d registered (%.2f per observer), %d peak" % (
+        memory_start, memory_registered, float(memory_registered - memory_start) / max(registered, 1),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def usage():  # pragma: no cover
+    print "benchmark_observe.py [-p <port>] [-n <observers>] [-r <resources>] [-u <updates/s>] [-d <seconds>] " \
+          "[-P <processes>] [-s <sockets>] [-w <workers>] [-c]"
+
+
+def main(argv):  # pragma: no cover
+    port = 5683
+    observers = 1000
+    resources = 10
+    rate = 10.0
+    duration = 10.0
+    processes = 1
+    sockets = 16
+    workers = 1
+    con = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hp:n:r:u:d:P:s:w:c", ["port=", "observers=", "resources=", "rate=",
+                                                                "duration=", "processes=", "sockets=",
+                                                                "workers=", "con"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-n", "--observers"):
+            observers = int(arg)
+        elif opt in ("-r", "--resources"):
+            resources = int(arg)
+        elif opt in ("-u", "--rate"):
+            rate = float(arg)
+        elif opt in ("-d", "--duration"):
+            duration = float(arg)
+        elif opt in ("-P", "--processes"):
+            processes = int(arg)
+        elif opt in ("-s", "--sockets"):
+            sockets = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-c", "--con"):
+            con = True
+
+    logging.basicConfig(level=logging.ERROR)
+    benchmark(port, observers, resources, rate, duration, processes, sockets, workers, con)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -1,33 +1,121 @@
+import collections
 import logging
 import logging.config
 import random
 import socket
 import threading
+import time
 from coapthon.messages.message import Message
 from coapthon.messages.response import Response
 from coapthon import defines
-from coapthon.layers.blocklayer import BlockLayer
+from coapthon.layers.blocklayer import BlockLayer, ReassemblyBuffer
 from coapthon.layers.messagelayer import MessageLayer
 from coapthon.layers.observelayer import ObserveLayer
 from coapthon.layers.requestlayer import RequestLayer
 from coapthon.messages.request import Request
 from coapthon.serializer import Serializer
+from coapthon.utils import TokenBucket
 import os.path
 
 __author__ = 'giacomo'
 
 logger = logging.getLogger(__name__)
 
+
+class Block2Transfer(object):
+    def __init__(self, request, size, etag, window, size_hint=None):
+        """
+        A Block2 transfer fetched with several block requests outstanding at once. The blocks are written at their
+        offset in a buffer preallocated for the size of the representation, or for a window of blocks if unknown,
+        so they can arrive in any order.
+
+        :type request: Request
+        :param request: the request that started the transfer
+        :param size: the size of the blocks
+        :param etag: the ETag of the representation, None to take the one of the first block received
+        :param window: the maximum number of block requests outstanding
+        :param size_hint: the size of the representation announced in Size2, None if unknown
+        """
+        self.request = request
+        self.size = size
+        self.etag = etag
+        self.size_hint = size_hint
+        self.buffer = ReassemblyBuffer(size_hint if size_hint is not None else window * size, None)
+        # block request -> number of the block, for the requests not answered yet
+        self.requests = {}
+        # block requests of the representation before the transfer restarted, not answered yet
+        self.stale = set()
+        self.received = set()
+        self.next_num = 0
+        # the number of the last block, None until a block without the M flag is received
+        self.last = None
+        self.last_response = None
+        # set when the transfer is answered or a block cannot be served, the transfer is dropped once the blocks
+        # still outstanding are answered
+        self.closed = False
+        # last block received, the transfer is purged after EXCHANGE_LIFETIME without blocks
+        self.timestamp = time.time()
+
+    def write(self, response):
+        """
+        Store a block.
+
+        :type response: Response
+        :param response: the response carrying the block
+        """
+        num, m, size = response.block2
+        if self.last is not None and num > self.last:
+            return
+        if m == 0:
+            self.last = num
+            self.last_response = response
+            self.received = set(n for n in self.received if n < num)
+        if response.payload:
+            self.buffer.write(response.payload, num * size)
+        self.received.add(num)
+
+    @property
+    def completed(self):
+        return self.last is not None and len(self.received) == self.last + 1
+
+
 class CoAP(object):
-    def __init__(self, server, starting_mid, callback):
+    def __init__(self, server, starting_mid, callback, nstart=defines.NSTART, probing_rate=None, block2_window=1,
+                 block_policy=None):
+        """
+        Initialize the client.
+
+        :param server: Server address
+        :param starting_mid: the first MID to use
+        :param callback: function called on every received response
+        :param nstart: the maximum number of outstanding interactions with a single server
+        :param probing_rate: bytes per second allowed for NON requests to a single server, None to disable pacing.
+            RFC 7252 suggests 1 for a server that does not answer
+        :param block2_window: the number of blocks of a Block2 transfer requested at once, the block requests are
+            subject to nstart. 1 fetches one block per round trip
+        :type block_policy: BlockSizePolicy
+        :param block_policy: chooses the block size from the losses and round trip times measured, None to always
+            use defines.MAX_PAYLOAD
+        """
         self._currentMID = starting_mid
         self._server = server
         self._callback = callback
         self.stopped = threading.Event()
         self.to_be_stopped = []
 
+        self._nstart = nstart
+        self._probing_rate = probing_rate
+        self._outstanding = {}
+        self._pending = {}
+        self._buckets = {}
+        self._nstart_lock = threading.Lock()
+
+        self._block2_window = block2_window
+        # hash(server + token) -> Block2Transfer
+        self._block2_transfers = {}
+
         self._messageLayer = MessageLayer(self._currentMID)
-        self._blockLayer = BlockLayer()
+        self._blockLayer = BlockLayer(policy=block_policy)
         self._observeLayer = ObserveLayer()
         self._requestLayer = RequestLayer(self)
 
@@ -63,29 +151,108 @@ class CoAP(object):
         assert isinstance(c, int)
         self._currentMID = c
 
-    def send_message(self, message):
+    def send_message(self, message, progress=None):
+        """
+        Send a request or an empty message.
 
+        :type message: Message
+        :param message: the message
+        :param progress: for a request sent block-wise, function called with the bytes sent and the size of the body,
+            None if unknown, when the server acknowledges a block
+        """
         if isinstance(message, Request):
             request = self._requestLayer.send_request(message)
             request = self._observeLayer.send_request(request)
-            request = self._blockLayer.send_request(request)
-            transaction = self._messageLayer.send_request(request)
-            if transaction.request.type == defines.Types["CON"]:
-                self._start_retransmission(transaction, transaction.request)
-
-            self.send_datagram(transaction.request)
+            request = self._blockLayer.send_request(request, progress)
+            self._submit(request)
         elif isinstance(message, Message):
             message = self._observeLayer.send_empty(message)
             message = self._messageLayer.send_empty(None, None, message)
             self.send_datagram(message)
 
+    def _submit(self, request):
+        """
+        Send a request, or queue it if NSTART interactions with the server are already outstanding.
+
+        :type request: Request
+        :param request: the request
+        """
+        if request.type != defines.Types["NON"]:
+            with self._nstart_lock:
+                outstanding = self._outstanding.setdefault(request.destination, set())
+                if len(outstanding) >= self._nstart:
+                    logger.debug("NSTART reached, queue request")
+                    self._pending.setdefault(request.destination, collections.deque()).append(request)
+                    return
+                outstanding.add(request)
+        self._send_request(request)
+
+    def _send_request(self, request):
+        """
+        Send a request that has already passed the NSTART check.
+
+        :type request: Request
+        :param request: the request
+        """
+        transaction = self._messageLayer.send_request(request)
+        if transaction.request.type == defines.Types["CON"]:
+            self._start_retransmission(transaction, transaction.request)
+
+        self.send_datagram(transaction.request)
+
+    def _exchange_completed(self, request):
+        """
+        Release the outstanding interaction held by a request and send the requests queued for the same server.
+
+        :type request: Request
+        :param request: the request whose interaction is no longer outstanding
+        """
+        ready = []
+        with self._nstart_lock:
+            outstanding = self._outstanding.get(request.destination)
+            if outstanding is None or request not in outstanding:
+                return
+            outstanding.remove(request)
+            pending = self._pending.get(request.destination)
+            while pending and len(outstanding) < self._nstart:
+                queued = pending.popleft()
+                outstanding.add(queued)
+                ready.append(queued)
+            if not pending:
+                self._pending.pop(request.destination, None)
+            if not outstanding:
+                del self._outstanding[request.destination]
+        for queued in ready:
+            self._send_request(queued)
+
     def send_datagram(self, message):
         host, port = message.destination
         logger.debug("send_datagram - " + str(message))
         serializer = Serializer()
-        message = serializer.serialize(message)
+        datagram = serializer.serialize(message)
+
+        if self._probing_rate is not None and isinstance(message, Request) \
+                and message.type == defines.Types["NON"]:
+            self._pace(message.destination, len(datagram))
+
+        self._socket.sendto(datagram, (host, port))
 
-        self._socket.sendto(message, (host, port))
+    def _pace(self, destination, length):
+        """
+        Wait until a NON datagram can be sent without exceeding the probing rate towards the destination.
+
+        :param destination: the (ip, port) of the server
+        :param length: the length of the datagram in bytes
+        """
+        with self._nstart_lock:
+            bucket = self._buckets.get(destination)
+            if bucket is None:
+                bucket = TokenBucket(self._probing_rate)
+                self._buckets[destination] = bucket
+        wait = bucket.consume(length)
+        if wait > 0:
+            logger.debug("Probing rate reached, wait " + str(wait) + " seconds")
+            self.stopped.wait(timeout=wait)
 
     def _start_retransmission(self, transaction, message):
         """
@@ -114,6 +281,7 @@ class CoAP(object):
         :param future_time: the amount of time to wait before a new attempt
         :param retransmit_count: the number of retransmissions
         """
+        sent = time.time()
         with transaction:
             while retransmit_count < defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected) \
                     and not self.stopped.isSet():
@@ -126,9 +294,14 @@ class CoAP(object):
 
             if message.acknowledged or message.rejected:
                 message.timeouted = False
+                # the round trip time of a retransmitted message is ambiguous
+                rtt = time.time() - sent if retransmit_count == 0 else None
+                self._blockLayer.record(message.destination, retransmit_count, rtt)
             else:
                 logger.warning("Give up on message {message}".format(message=message.line_print))
                 message.timeouted = True
+                if not self.stopped.isSet():
+                    self._blockLayer.record(message.destination, retransmit_count + 1, delivered=False)
 
             try:
                 self.to_be_stopped.remove(transaction.retransmit_stop)
@@ -137,6 +310,9 @@ class CoAP(object):
             transaction.retransmit_stop = None
             transaction.retransmit_thread = None
 
+        if isinstance(message, Request) and message.timeouted:
+            self._exchange_completed(message)
+
     def receive_datagram(self):
         logger.debug("Start receiver Thread")
         while not self.stopped.isSet():
@@ -144,6 +320,7 @@ class CoAP(object):
             try:
                 datagram, addr = self._socket.recvfrom(1152)
             except socket.timeout:  # pragma: no cover
+                self.purge()
                 continue
             except socket.error:  # pragma: no cover
                 return
@@ -169,14 +346,23 @@ class CoAP(object):
                     continue
                 if send_ack:
                     self._send_ack(transaction)
+                if self._block2_window > 1 and self._receive_block2(transaction):
+                    continue
                 self._blockLayer.receive_response(transaction)
                 if transaction.block_transfer:
+                    # the next block reuses the request: let the retransmission of the previous one end first
+                    previous = transaction.retransmit_thread
+                    if previous is not None and previous is not threading.current_thread():
+                        previous.join()
+                    transaction.request.acknowledged = False
                     transaction = self._messageLayer.send_request(transaction.request)
+                    self._start_retransmission(transaction, transaction.request)
                     self.send_datagram(transaction.request)
                     continue
                 elif transaction is None:  # pragma: no cover
                     self._send_rst(transaction)
                     return
+                self._exchange_completed(transaction.request)
                 self._observeLayer.receive_response(transaction)
                 if transaction.notification:  # pragma: no cover
                     ack = Message()
@@ -187,7 +373,129 @@ class CoAP(object):
                 else:
                     self._callback(transaction.response)
             elif isinstance(message, Message):
-                self._messageLayer.receive_empty(message)
+                transaction = self._messageLayer.receive_empty(message)
+                if transaction is not None and (transaction.request.acknowledged or transaction.request.rejected):
+                    self._exchange_completed(transaction.request)
+
+    def _receive_block2(self, transaction):
+        """
+        Handle a response of a Block2 transfer fetched with several blocks outstanding. The first block of a
+        transfer starts it: its exchange is completed and the following blocks are requested, each block request
+        holding its own NSTART slot. Notifications are left to the BlockLayer.
+
+        :type transaction: Transaction
+        :param transaction: the transaction of the response
+        :return: True if the response has been handled
+        """
+        response = transaction.response
+        request = transaction.request
+        host, port = response.source
+        key_token = hash(str(host) + str(port) + str(response.token))
+        transfer = self._block2_transfers.get(key_token)
+        if transfer is None:
+            if response.block2 is None or response.observe is not None or request.block1 is not None:
+                return False
+            num, m, size = response.block2
+            if num != 0 or m == 0:
+                return False
+            etag = response.etag[0] if response.etag else None
+            transfer = Block2Transfer(request, size, etag, self._block2_window,
+                                      self._blockLayer.announced_size(response))
+            transfer.write(response)
+            transfer.next_num = 1
+            self._block2_transfers[key_token] = transfer
+            self._exchange_completed(request)
+            self._request_blocks(transfer)
+            return True
+
+        num = transfer.requests.pop(request, None)
+        self._exchange_completed(request)
+        if num is None:
+            # a duplicate, or the answer to a block requested before the transfer restarted
+            transfer.stale.discard(request)
+            if transfer.closed:
+                self._close_block2(key_token, transfer)
+            return True
+        transfer.timestamp = time.time()
+        if transfer.closed:
+            # answer to a block requested past the end of the transfer
+            self._close_block2(key_token, transfer)
+            return True
+        if response.block2 is None:
+            # the server cannot serve the block
+            self._close_block2(key_token, transfer)
+            self._callback(response)
+            return True
+        etag = response.etag[0] if response.etag else None
+        if transfer.etag is None:
+            transfer.etag = etag
+        if etag != transfer.etag or response.block2[2] != transfer.size:
+            logger.debug("Representation or block size changed, restart the block-wise transfer")
+            size_hint = self._blockLayer.announced_size(response)
+            if size_hint is None:
+                size_hint = transfer.size_hint
+            restarted = Block2Transfer(transfer.request, response.block2[2], None, self._block2_window, size_hint)
+            restarted.stale = transfer.stale.union(transfer.requests)
+            transfer = restarted
+            self._block2_transfers[key_token] = transfer
+        else:
+            transfer.write(response)
+            if transfer.completed:
+                self._close_block2(key_token, transfer)
+                response = transfer.last_response
+                response.payload = transfer.buffer.getvalue()
+                self._callback(response)
+                return True
+        self._request_blocks(transfer)
+        return True
+
+    def purge(self, now=None):
+        """
+        Release the block-wise transfers abandoned by the server, called when the socket is idle.
+
+        :param now: the current time
+        """
+        if now is None:
+            now = time.time()
+        self._blockLayer.purge(now)
+        for key_token, transfer in self._block2_transfers.items():
+            if now - transfer.timestamp > defines.EXCHANGE_LIFETIME:
+                logger.debug("Purge abandoned Block2 transfer")
+                del self._block2_transfers[key_token]
+
+    def _close_block2(self, key_token, transfer):
+        """
+        Close a Block2 transfer, it is dropped once the blocks still outstanding are answered.
+
+        :param key_token: the key of the transfer
+        :type transfer: Block2Transfer
+        :param transfer: the transfer
+        """
+        transfer.closed = True
+        if not transfer.requests and not transfer.stale and self._block2_transfers.get(key_token) is transfer:
+            del self._block2_transfers[key_token]
+
+    def _request_blocks(self, transfer):
+        """
+        Request the next blocks of a transfer, up to the window.
+
+        :type transfer: Block2Transfer
+        :param transfer: the transfer
+        """
+        while len(transfer.requests) < self._block2_window \
+                and (transfer.last is None or transfer.next_num <= transfer.last):
+            request = Request()
+            request.destination = transfer.request.destination
+            request.type = transfer.request.type
+            request.code = transfer.request.code
+            request.token = transfer.request.token
+            for option in transfer.request.options:
+                if option.number != defines.OptionRegistry.BLOCK2.number:
+                    request.add_option(option)
+            request.block2 = (transfer.next_num, 0, transfer.size)
+            transfer.requests[request] = transfer.next_num
+            transfer.next_num += 1
+            self._submit(request)
 
     def _send_ack(self, transaction):
         # Handle separate
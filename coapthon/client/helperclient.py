@@ -11,9 +11,10 @@ __author__ = 'jacko'
 
 
 class HelperClient(object):
-    def __init__(self, server):
+    def __init__(self, server, nstart=defines.NSTART, probing_rate=None, block2_window=1, block_policy=None):
         self.server = server
-        self.protocol = CoAP(self.server, random.randint(1, 65535), self._wait_response)
+        self.protocol = CoAP(self.server, random.randint(1, 65535), self._wait_response, nstart=nstart,
+                             probing_rate=probing_rate, block2_window=block2_window, block_policy=block_policy)
         self.queue = Queue()
 
     def _wait_response(self, message):
@@ -24,8 +25,8 @@ class HelperClient(object):
         self.protocol.stopped.set()
         self.queue.put(None)
 
-    def _thread_body(self, request, callback):
-        self.protocol.send_message(request)
+    def _thread_body(self, request, callback, progress=None):
+        self.protocol.send_message(request, progress)
         while not self.protocol.stopped.isSet():
             response = self.queue.get(block=True)
             callback(response)
@@ -83,7 +84,7 @@ class HelperClient(object):
             response = self.queue.get(block=True)
             return response
 
-    def post(self, path, payload, callback=None):  # pragma: no cover
+    def post(self, path, payload, callback=None, progress=None):  # pragma: no cover
         request = Request()
         request.destination = self.server
         request.code = defines.Codes.POST.number
@@ -91,24 +92,24 @@ class HelperClient(object):
         request.uri_path = path
         request.payload = payload
         if callback is not None:
-            thread = threading.Thread(target=self._thread_body, args=(request, callback))
+            thread = threading.Thread(target=self._thread_body, args=(request, callback, progress))
             thread.start()
         else:
-            self.protocol.send_message(request)
+            self.protocol.send_message(request, progress)
             response = self.queue.get(block=True)
             return response
 
-    def put(self, path, payload, callback=None):  # pragma: no cover
+    def put(self, path, payload, callback=None, progress=None):  # pragma: no cover
         request = Request()
         request.destination = self.server
         request.code = defines.Codes.PUT.number
         request.uri_path = path
         request.payload = payload
         if callback is not None:
-            thread = threading.Thread(target=self._thread_body, args=(request, callback))
+            thread = threading.Thread(target=self._thread_body, args=(request, callback, progress))
             thread.start()
         else:
-            self.protocol.send_message(request)
+            self.protocol.send_message(request, progress)
             response = self.queue.get(block=True)
             return response
 
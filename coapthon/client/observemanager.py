@@ -0,0 +1,228 @@
+import logging
+import random
+import threading
+import time
+from coapthon import defines
+from coapthon.client.coap import CoAP
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.utils import generate_random_token
+
+__author__ = 'giacomo'
+
+logger = logging.getLogger(__name__)
+
+
+class Observation(object):
+    def __init__(self, path, callback, query=None, token=None):
+        """
+        An observation handled by an ObserveManager.
+
+        :param path: the path of the observed resource
+        :param callback: function called with every fresh notification
+        :param query: the Uri-Query of the observe request
+        :param token: the token that identifies the observation
+        """
+        self.path = path
+        self.callback = callback
+        self.query = query
+        self.token = token
+        self.sequence = None
+        self.timestamp = None
+        self.max_age = defines.OptionRegistry.MAX_AGE.default
+        self.response = None
+        self.active = True
+
+    def is_fresh(self, sequence, now):
+        """
+        Check if a notification is newer than the last one received, as specified by RFC 7641 section 3.4.
+
+        :param sequence: the Observe value of the notification
+        :param now: the time the notification has been received
+        :return: True if the notification must be delivered
+        """
+        if self.sequence is None or self.timestamp is None:
+            return True
+        v1 = self.sequence
+        v2 = sequence
+        return (v1 < v2 and v2 - v1 < 2 ** 23) or (v1 > v2 and v1 - v2 > 2 ** 23) or now > self.timestamp + 128
+
+
+class ObserveManager(object):
+    def __init__(self, server, nstart=defines.NSTART, reregister=True, margin=defines.ACK_TIMEOUT):
+        """
+        Keep many observations of the resources of a server over a single socket. Notifications are demultiplexed
+        by token, notifications older than the last one delivered are discarded and observations that are not
+        refreshed within their Max-Age are registered again.
+
+        Callbacks run on the receiver thread, they must not block.
+
+        :param server: the (ip, port) of the server
+        :param nstart: the maximum number of outstanding requests to the server
+        :param reregister: if observations must be registered again when their Max-Age expires
+        :param margin: the seconds waited after the Max-Age before registering again
+        """
+        self.server = server
+        self._reregister = reregister
+        self._margin = margin
+        self._observations = {}
+        self._lock = threading.Lock()
+        self.protocol = CoAP(self.server, random.randint(1, 65535), self._receive, nstart=nstart)
+        self._wakeup = threading.Event()
+        self.protocol.to_be_stopped.append(self._wakeup)
+        self._maintenance = threading.Thread(target=self._maintain)
+        self._maintenance.daemon = True
+        self._maintenance.start()
+
+    def observe(self, path, callback, query=None):
+        """
+        Start observing a resource.
+
+        :param path: the path of the resource
+        :param callback: function called with every fresh notification, including the first response. An error
+            response or a response without Observe ends the observation
+        :param query: the Uri-Query of the request, e.g. "pmin=1"
+        :return: the token of the observation
+        """
+        with self._lock:
+            token = generate_random_token(8)
+            while token in self._observations:
+                token = generate_random_token(8)
+            observation = Observation(path, callback, query, token)
+            self._observations[token] = observation
+        self._register(observation, 0)
+        return token
+
+    def cancel(self, token):
+        """
+        Stop an observation and deregister it on the server with a GET carrying Observe 1.
+
+        :param token: the token returned by observe
+        """
+        with self._lock:
+            observation = self._observations.pop(token, None)
+        if observation is None:
+            return
+        observation.active = False
+        self._register(observation, 1)
+
+    def observations(self):
+        """
+        Get the active observations.
+
+        :return: the list of observations
+        """
+        with self._lock:
+            return self._observations.values()
+
+    def stop(self):
+        """
+        Stop the manager. The relations on the server are left to expire.
+
+        """
+        self.protocol.stopped.set()
+        self._wakeup.set()
+
+    def _register(self, observation, observe):
+        """
+        Send the observe request of an observation.
+
+        :type observation: Observation
+        :param observation: the observation
+        :param observe: 0 to register, 1 to deregister
+        """
+        request = Request()
+        request.destination = self.server
+        request.code = defines.Codes.GET.number
+        request.token = observation.token
+        request.uri_path = observation.path
+        if observation.query:
+            request.uri_query = observation.query
+        request.observe = observe
+        self.protocol.send_message(request)
+
+    def _receive(self, response):
+        """
+        Dispatch a response or a notification to the callback of its observation.
+
+        :type response: Response
+        :param response: the response
+        """
+        if not isinstance(response, Response) or response.code == defines.Codes.CONTINUE.number:
+            return
+        now = time.time()
+        with self._lock:
+            observation = self._observations.get(response.token)
+            if observation is None:
+                unknown = True
+            else:
+                unknown = False
+                sequence = response.observe
+                if response.code >= defines.Codes.ERROR_LOWER_BOUND or sequence is None:
+                    # the server ended the observation
+                    del self._observations[response.token]
+                    observation.active = False
+                elif observation.is_fresh(sequence, now):
+                    observation.sequence = sequence
+                    observation.timestamp = now
+                    observation.max_age = response.max_age
+                elif sequence == observation.sequence:
+                    # answer to a registration sent again, the representation did not change
+                    observation.timestamp = now
+                    observation.max_age = response.max_age
+                    return
+                else:
+                    logger.debug("Discard old notification " + str(sequence))
+                    return
+                observation.response = response
+        if unknown:
+            if response.observe is not None:
+                # a notification of a cancelled observation
+                self._send_rst(response)
+            return
+        observation.callback(response)
+        self._wakeup.set()
+
+    def _send_rst(self, response):
+        """
+        Reject a notification, the server removes the relation.
+
+        :type response: Response
+        :param response: the notification
+        """
+        rst = Message()
+        rst.type = defines.Types["RST"]
+        rst.code = defines.Codes.EMPTY.number
+        rst.mid = response.mid
+        rst.token = response.token
+        rst.destination = response.source
+        self.protocol.send_datagram(rst)
+
+    def _maintain(self):
+        """
+        Register again the observations that have not been refreshed within their Max-Age.
+
+        """
+        while not self.protocol.stopped.isSet():
+            now = time.time()
+            expired = []
+            timeout = None
+            with self._lock:
+                for observation in self._observations.values():
+                    if observation.timestamp is None:
+                        continue
+                    deadline = observation.timestamp + observation.max_age + self._margin
+                    if deadline <= now:
+                        # do not register again before another Max-Age
+                        observation.timestamp = now
+                        expired.append(observation)
+                        deadline = now + observation.max_age + self._margin
+                    if timeout is None or deadline - now < timeout:
+                        timeout = deadline - now
+            if self._reregister:
+                for observation in expired:
+                    logger.debug("Register again " + observation.path)
+                    self._register(observation, 0)
+            self._wakeup.wait(timeout=timeout)
+            self._wakeup.clear()
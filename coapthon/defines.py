@@ -23,6 +23,8 @@ MAX_RTT = (2 * MAX_LATENCY) + PROCESSING_DELAY
 
 EXCHANGE_LIFETIME = MAX_TRANSMIT_SPAN + (2 * MAX_LATENCY) + PROCESSING_DELAY
 
+NON_LIFETIME = MAX_TRANSMIT_SPAN + MAX_LATENCY
+
 DISCOVERY_URL = "/.well-known/core"
 
 ALL_COAP_NODES = "224.0.1.187"
@@ -33,8 +35,16 @@ MAX_PAYLOAD = 1024
 
 MAX_NON_NOTIFICATIONS = 10
 
+NSTART = 1
+
 BLOCKWISE_SIZE = 1024
 
+# bytes of a Block1 body reassembled in memory, larger bodies are spooled to a temporary file
+BLOCKWISE_SPOOL_SIZE = 262144
+
+# bytes held at once by the block-wise transfers in progress on a server, Block1 bodies and Block2 snapshots
+BLOCKWISE_BUDGET = 16777216
+
 '''  Message Format '''
 
 # number of bits used for the encoding of the CoAP version field.
@@ -121,6 +131,7 @@ class OptionRegistry(object):
     LOCATION_QUERY = OptionItem(20, "Location-Query", STRING, True, None)
     BLOCK2 = OptionItem(23, "Block2", INTEGER, False, None)
     BLOCK1 = OptionItem(27, "Block1", INTEGER, False, None)
+    SIZE2 = OptionItem(28, "Size2", INTEGER, False, 0)
     PROXY_URI = OptionItem(35, "Proxy-Uri", STRING, False, None)
     PROXY_SCHEME = OptionItem(39, "Proxy-Schema", STRING, False, None)
     SIZE1 = OptionItem(60, "Size1", INTEGER, False, None)
@@ -142,6 +153,7 @@ class OptionRegistry(object):
         20: LOCATION_QUERY,
         23: BLOCK2,
         27: BLOCK1,
+        28: SIZE2,
         35: PROXY_URI,
         39: PROXY_SCHEME,
         60: SIZE1
@@ -1,7 +1,13 @@
+import hashlib
 import logging
+import mmap
+import tempfile
+import threading
+import time
 from coapthon import defines
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.storage.storage import MemoryStorage
 
 logger = logging.getLogger(__name__)
 
@@ -14,65 +20,535 @@ class BlockItem(object):
         self.size = size
         self.payload = payload
         self.content_type = content_type
+        # Observe of the first block of a notification
+        self.observe = None
+        # bytes of a Block1 body sent so far, and the function called with them and the size of the body, if known,
+        # when the server acknowledges a block
+        self.sent = 0
+        self.progress = None
+        # last activity on the transfer, it is purged after EXCHANGE_LIFETIME without activity
+        self.timestamp = time.time()
+        # a block requested out of any transfer, served without keeping state
+        self.stateless = False
+        # the largest Block1 body accepted, None if unlimited
+        self.limit = None
+
+
+class ReassemblyBuffer(object):
+    def __init__(self, size_hint=None, spool_size=defines.BLOCKWISE_SPOOL_SIZE, limit=None):
+        """
+        The body of a Block1 transfer being reassembled. Blocks are copied once into a bytearray, preallocated from
+        the Size1 announced by the client or doubled when full. A body larger than spool_size is moved to a
+        temporary file.
+
+        :param size_hint: the expected size of the body, None if unknown
+        :param spool_size: the bytes kept in memory, None to never spool
+        :param limit: the largest body accepted, the buffer is not doubled past it. None if unlimited
+        """
+        self.length = 0
+        self._spool_size = spool_size
+        self._limit = limit
+        self._file = None
+        self._buffer = None
+        if size_hint is not None and spool_size is not None and size_hint > spool_size:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._buffer = bytearray(size_hint or 0)
+
+    def write(self, data, offset=None):
+        """
+        Write a block, blocks can be written in any order.
+
+        :param data: the payload of the block
+        :param offset: the offset of the block, None to append it
+        """
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if offset is None:
+            offset = self.length
+        end = offset + len(data)
+        if self._file is None and self._spool_size is not None and end > self._spool_size:
+            logger.debug("Spool block-wise body to a temporary file")
+            self._file = tempfile.TemporaryFile()
+            self._file.write(buffer(self._buffer, 0, self.length))
+            self._buffer = None
+        if self._file is not None:
+            self._file.seek(offset)
+            self._file.write(data)
+        else:
+            if end > len(self._buffer):
+                self._buffer.extend(bytearray(self._grown(end) - len(self._buffer)))
+            self._buffer[offset:end] = data
+        self.length = max(self.length, end)
+
+    @property
+    def held(self):
+        """
+        Get the bytes held by the body: the memory allocated for it, or its length once spooled.
+
+        :return: the number of bytes
+        """
+        if self._buffer is not None:
+            return len(self._buffer)
+        return self.length
+
+    def held_after(self, end):
+        """
+        Get the bytes the body would hold after a block ending at end is written, counting the preallocation
+        done when the buffer grows.
+
+        :param end: the offset of the end of the block
+        :return: the number of bytes
+        """
+        if self._buffer is None or (self._spool_size is not None and end > self._spool_size):
+            return max(self.length, end)
+        if end > len(self._buffer):
+            return self._grown(end)
+        return len(self._buffer)
+
+    def _grown(self, end):
+        """
+        Get the size of the memory buffer grown to hold a block ending at end.
+
+        :param end: the offset of the end of the block
+        :return: the size in bytes
+        """
+        size = 2 * len(self._buffer)
+        if self._limit is not None:
+            size = min(size, self._limit)
+        return max(end, size)
+
+    def close(self):
+        """
+        Release the body of an abandoned transfer.
+
+        """
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._buffer = None
+
+    def getvalue(self):
+        """
+        Get the reassembled body.
+
+        :return: a string, or the temporary file positioned at the start if the body has been spooled
+        """
+        if self._file is not None:
+            self._file.flush()
+            self._file.seek(0)
+            return self._file
+        return str(buffer(self._buffer, 0, self.length))
+
+
+class StreamReader(object):
+    # bytes pulled at a time from a file object that cannot seek
+    CHUNK_SIZE = 8192
+
+    def __init__(self, source):
+        """
+        A representation of unknown length, read block by block. A file object that can seek is read at the offset
+        of every block, other file objects and iterators of strings are consumed in order: a block can be read
+        again, the blocks before it cannot. The source can also be a callable returning the file object or the
+        iterator: it is called once per reader, so every transfer reads its own copy. Only a source opened that way
+        is closed by the reader, a file object or an iterator handed over directly stays with its owner.
+
+        :param source: the file object, the iterator or the callable opening them
+        """
+        self._owned = callable(source) and not hasattr(source, "read") and not hasattr(source, "__iter__")
+        if self._owned:
+            source = source()
+        self._source = source
+        self._seekable = hasattr(source, "read") and hasattr(source, "seek")
+        if self._seekable:
+            self._iterator = None
+        elif hasattr(source, "read"):
+            self._iterator = iter(lambda: source.read(self.CHUNK_SIZE), "")
+        else:
+            self._iterator = iter(source)
+        # bytes pulled from the iterator and not consumed yet, starting at offset _position
+        self._pending = ""
+        self._position = 0
+
+    def read(self, byte, size):
+        """
+        Read a block, and one more byte to know if other blocks follow.
+
+        :param byte: the offset of the block
+        :param size: the size of the block
+        :return: the block and True if more bytes follow, the block is None if its offset has been consumed already
+        """
+        if self._seekable:
+            self._source.seek(byte)
+            data = self._source.read(size + 1)
+            return data[:size], len(data) > size
+        if byte < self._position:
+            return None, False
+        chunks = [self._pending]
+        length = len(self._pending)
+        while length < byte - self._position + size + 1:
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                break
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf-8")
+            chunks.append(chunk)
+            length += len(chunk)
+        self._pending = "".join(chunks)[byte - self._position:]
+        self._position = byte
+        return self._pending[:size], len(self._pending) > size
+
+    @property
+    def size(self):
+        """
+        Get the size of the representation, known only for a file object that can seek.
+
+        :return: the size in bytes or None
+        """
+        if not self._seekable:
+            return None
+        self._source.seek(0, 2)
+        return self._source.tell()
+
+    def getvalue(self):
+        """
+        Read the whole representation and close the reader.
+
+        :return: the representation
+        """
+        data = []
+        byte = 0
+        more = True
+        while more:
+            block, more = self.read(byte, self.CHUNK_SIZE)
+            data.append(block)
+            byte += len(block)
+        self.close()
+        return "".join(data)
+
+    def close(self):
+        """
+        Close the source, if the reader opened it and it can be closed.
+
+        """
+        if not self._owned:
+            return
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            close()
+
+
+class RepresentationItem(object):
+    def __init__(self, etag, payload, content_type, timestamp, code=defines.Codes.CONTENT.number, max_age=None):
+        """
+        An encoded representation sent block-wise: the snapshot of a Block2 transfer, or the representation of an
+        observed resource sent in a notification and shared by all the observers.
+
+        :param etag: the ETag of the representation
+        :param payload: the whole payload
+        :param content_type: the content type
+        :param timestamp: the time the representation has been rendered or last used
+        :param code: the response code
+        :param max_age: the Max-Age of the response, None if the response has no Max-Age option
+        """
+        self.etag = etag
+        self.payload = payload
+        self.content_type = content_type
+        self.timestamp = timestamp
+        self.code = code
+        self.max_age = max_age
+        # bytes counted in the budget of the BlockLayer
+        self.size = 0
+
+
+class PeerStats(object):
+    def __init__(self, size):
+        """
+        What a BlockSizePolicy knows about a peer.
+
+        :param size: the block size in use
+        """
+        self.size = size
+        # smoothed fraction of the transmissions lost
+        self.loss = 0.0
+        self.srtt = None
+        self.min_rtt = None
+        # transmissions observed since the block size last changed
+        self.samples = 0
+        self.timestamp = time.time()
+
+
+class BlockSizePolicy(object):
+    # gain of the moving averages, as for SRTT in RFC 6298
+    GAIN = 0.125
+    # transmissions observed before the block size of a peer is changed again
+    SAMPLES = 8
+
+    def __init__(self, min_size=64, max_size=defines.MAX_PAYLOAD, loss_high=0.1, loss_low=0.02):
+        """
+        Adaptive block size, chosen per peer. The blocks are halved when more than loss_high of the transmissions to
+        and from the peer are lost, and doubled when less than loss_low are lost and the round trip time has not
+        grown past twice the smallest one measured, as it does when large datagrams queue up or get fragmented on a
+        slow link.
+
+        :param min_size: the smallest block size, a power of 2 between 16 and 1024
+        :param max_size: the largest block size, and the size used for a new peer
+        :param loss_high: the loss rate above which the blocks are shrunk
+        :param loss_low: the loss rate below which the blocks are grown
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.loss_high = loss_high
+        self.loss_low = loss_low
+        self._peers = {}
+        self._lock = threading.Lock()
+
+    def size(self, peer):
+        """
+        Get the block size to use with a peer.
+
+        :param peer: the (ip, port) of the peer
+        :return: the block size in bytes
+        """
+        stats = self._peers.get(peer)
+        if stats is None:
+            return self.max_size
+        return stats.size
+
+    def record(self, peer, retransmissions=0, rtt=None, delivered=True):
+        """
+        Record an exchange with a peer: a number of transmissions lost, followed by one that went through unless
+        the exchange timed out.
+
+        :param peer: the (ip, port) of the peer
+        :param retransmissions: the number of transmissions lost
+        :param rtt: the round trip time in seconds, only when the message has not been retransmitted
+        :param delivered: False if the exchange timed out
+        """
+        with self._lock:
+            stats = self._peers.get(peer)
+            if stats is None:
+                stats = PeerStats(self.max_size)
+                self._peers[peer] = stats
+            stats.timestamp = time.time()
+            for _ in range(retransmissions):
+                stats.loss += self.GAIN * (1 - stats.loss)
+            if delivered:
+                stats.loss -= self.GAIN * stats.loss
+            stats.samples += retransmissions + (1 if delivered else 0)
+            if rtt is not None:
+                if stats.srtt is None:
+                    stats.srtt = rtt
+                else:
+                    stats.srtt += self.GAIN * (rtt - stats.srtt)
+                if stats.min_rtt is None or rtt < stats.min_rtt:
+                    stats.min_rtt = rtt
+            if stats.samples < self.SAMPLES:
+                return
+            if stats.loss > self.loss_high and stats.size > self.min_size:
+                stats.size //= 2
+                stats.samples = 0
+                logger.debug("Block size for " + str(peer) + " shrunk to " + str(stats.size))
+            elif stats.loss < self.loss_low and stats.size < self.max_size \
+                    and (stats.srtt is None or stats.srtt < 2 * stats.min_rtt):
+                stats.size *= 2
+                stats.samples = 0
+                logger.debug("Block size for " + str(peer) + " grown to " + str(stats.size))
+
+    def purge(self, now=None):
+        """
+        Forget the peers without exchanges for EXCHANGE_LIFETIME.
+
+        :param now: the current time
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for peer in self._peers.keys():
+                if now - self._peers[peer].timestamp > defines.EXCHANGE_LIFETIME:
+                    del self._peers[peer]
+
+    def stats(self):
+        """
+        Get the block size in use with every peer.
+
+        :return: a dict peer -> (block size, loss rate, smoothed round trip time or None)
+        """
+        with self._lock:
+            return dict((peer, (stats.size, stats.loss, stats.srtt)) for peer, stats in self._peers.items())
 
 
 class BlockLayer(object):
-    def __init__(self):
-        self._block1_sent = {}
-        self._block2_sent = {}
-        self._block1_receive = {}
-        self._block2_receive = {}
+    def __init__(self, storage=None, spool_size=defines.BLOCKWISE_SPOOL_SIZE, budget=defines.BLOCKWISE_BUDGET,
+                 policy=None):
+        """
+        Initialize a Block Layer.
 
-    def receive_request(self, transaction):
+        :type storage: Storage
+        :param storage: where the state of the block transfers is kept, in-process dicts if None. The snapshots,
+            representations and bodies of the transfers are always kept in this process
+        :param spool_size: the size above which the body of a Block1 transfer is spooled to a temporary file, None
+            to always keep it in memory
+        :param budget: the bytes held at once by the Block1 bodies and the Block2 snapshots of the transfers in
+            progress, None for no limit. A Block1 body larger than the budget is answered with 4.13, a block that
+            does not fit in what is left with 5.03, and a Block2 transfer that does not fit is served without a
+            snapshot
+        :type policy: BlockSizePolicy
+        :param policy: chooses the block size used with each peer, defines.MAX_PAYLOAD for all the peers if None
+        """
+        if storage is None:
+            storage = MemoryStorage()
+        self._block1_sent = storage.table("block1_sent")
+        self._block2_sent = storage.table("block2_sent")
+        self._block1_receive = storage.table("block1_receive")
+        self._block2_receive = storage.table("block2_receive")
+        # the representations, snapshots and bodies hold streams and buffers that cannot be shared, they stay in
+        # this process
+        # hash(path) -> RepresentationItem, the last notification of an observed resource larger than a block
+        self._representations = {}
+        # hash(peer + token) -> RepresentationItem, the response of a Block2 transfer in progress
+        self._block2_snapshots = {}
+        # hash(peer + token) -> ReassemblyBuffer, the body of a Block1 transfer in progress
+        self._block1_buffers = {}
+        self._spool_size = spool_size
+        self._budget = budget
+        self._bytes_in_use = 0
+        self._budget_lock = threading.Lock()
+        self._policy = policy
+
+    def receive_request(self, transaction, limit=None):
         """
         Handles the Blocks option in a incoming request.
 
         :type transaction: Transaction
         :param transaction: the transaction that owns the request
+        :param limit: the largest Block1 body accepted by the target resource, None if unlimited. It is read on the
+            first block: a body announced larger in Size1 is refused at once, otherwise when it grows past it
         :rtype : Transaction
         """
         if transaction.request.block2 is not None:
             host, port = transaction.request.source
             key_token = hash(str(host) + str(port) + str(transaction.request.token))
             num, m, size = transaction.request.block2
-            if key_token in self._block2_receive:
-                self._block2_receive[key_token].num = num
-                self._block2_receive[key_token].size = size
-                self._block2_receive[key_token].m = m
-                del transaction.request.block2
+            if transaction.request.observe == 0 and num == 0:
+                # every notification starts from block 0, the size negotiated at registration stays on the request
+                return transaction
+            item = self._block2_receive.get(key_token)
+            if item is not None and num == 0:
+                # the client restarts the transfer
+                del self._block2_receive[key_token]
+                item = None
+            snapshot = self._block2_snapshots.get(key_token)
+            if snapshot is not None and (item is None or (transaction.request.etag and snapshot.etag is not None
+                                                          and snapshot.etag not in transaction.request.etag)):
+                # no transfer in progress, or the client validates another representation: render again
+                self._drop_snapshot(key_token)
+                snapshot = None
+            if snapshot is not None:
+                # the following blocks are sliced from the snapshot, the resource is not rendered again. While the
+                # block size does not change the block is read at num * size, so a client can request several
+                # blocks at once and in any order
+                if size == item.size:
+                    byte = num * size
+                else:
+                    byte = item.byte
+                self._send_representation(transaction, snapshot, num, size, byte)
+                if transaction.response.block2[1] == 0:
+                    # end of the transfer
+                    try:
+                        del self._block2_receive[key_token]
+                    except KeyError:
+                        pass
+                    self._drop_snapshot(key_token)
+                else:
+                    item.byte = byte + size
+                    item.num = num + 1
+                    item.size = size
+                    item.timestamp = time.time()
+                    self._block2_receive[key_token] = item
+                    snapshot.timestamp = time.time()
+                    self._block2_snapshots[key_token] = snapshot
+                return transaction
+            if item is None and num > 0 and transaction.request.code == defines.Codes.GET.number:
+                representation = self._representation(transaction.request)
+                if representation is not None and num * size < len(representation.payload):
+                    return self._send_representation(transaction, representation, num, size)
+            if item is not None:
+                # as with a snapshot, the block is read at num * size while the block size does not change, so
+                # pipelined requests answered out of order get the bytes of the block they asked for
+                if size == item.size:
+                    item.byte = num * size
+                item.num = num
+                item.size = size
+                item.m = m
             else:
-                # early negotiation
-                byte = 0
-                self._block2_receive[key_token] = BlockItem(byte, num, m, size)
-                del transaction.request.block2
+                # early negotiation, or a block requested without a transfer in progress
+                if num == 0:
+                    size = min(size, self.block_size(transaction.request.source))
+                item = BlockItem(num * size, num, m, size)
+                # e.g. a pipelined request retransmitted after the last block was served
+                item.stateless = num > 0
+            item.timestamp = time.time()
+            self._block2_receive[key_token] = item
+            del transaction.request.block2
 
         elif transaction.request.block1 is not None:
             # POST or PUT
             host, port = transaction.request.source
             key_token = hash(str(host) + str(port) + str(transaction.request.token))
             num, m, size = transaction.request.block1
-            if key_token in self._block1_receive:
+            item = self._block1_receive.get(key_token)
+            if item is not None:
+                reassembly = self._block1_buffers.get(key_token)
                 content_type = transaction.request.content_type
-                if num != self._block1_receive[key_token].num \
-                        or content_type != self._block1_receive[key_token].content_type:
+                if num != item.num or content_type != item.content_type or reassembly is None:
                     # Error Incomplete
                     return self.incomplete(transaction)
-                self._block1_receive[key_token].payload += transaction.request.payload
             else:
                 # first block
                 if num != 0:
                     # Error Incomplete
                     return self.incomplete(transaction)
                 content_type = transaction.request.content_type
-                self._block1_receive[key_token] = BlockItem(size, num, m, size, transaction.request.payload,
-                                                            content_type)
+                if self._budget is not None:
+                    limit = self._budget if limit is None else min(limit, self._budget)
+                if limit is not None and transaction.request.size1 is not None \
+                        and transaction.request.size1 > limit:
+                    return self.too_large(transaction, limit)
+                item = BlockItem(0, num, m, size, None, content_type)
+                item.limit = limit
+                reassembly = ReassemblyBuffer(transaction.request.size1, self._spool_size, limit)
+                # the memory preallocated from Size1 counts in the budget as well
+                if not self._reserve(reassembly.held):
+                    logger.warning("Block-wise budget exhausted, transfer refused")
+                    reassembly.close()
+                    return self.unavailable(transaction)
+                self._block1_buffers[key_token] = reassembly
+            payload = transaction.request.payload
+            if payload is not None:
+                if isinstance(payload, unicode):
+                    payload = payload.encode("utf-8")
+                if item.limit is not None and reassembly.length + len(payload) > item.limit:
+                    logger.warning("Block-wise body larger than accepted, transfer dropped")
+                    self._end_block1_receive(key_token)
+                    return self.too_large(transaction, item.limit)
+                grown = reassembly.held_after(reassembly.length + len(payload)) - reassembly.held
+                if grown > 0 and not self._reserve(grown):
+                    logger.warning("Block-wise budget exhausted, transfer dropped")
+                    self._end_block1_receive(key_token)
+                    return self.unavailable(transaction)
+                reassembly.write(payload)
+                if grown < 0:
+                    # spooled to a temporary file, the memory buffer has been released
+                    self._release(-grown)
 
             if m == 0:
-                transaction.request.payload = self._block1_receive[key_token].payload
+                transaction.request.payload = reassembly.getvalue()
                 # end of blockwise
                 del transaction.request.block1
                 transaction.block_transfer = False
-                # TODO remove from _block1_receive
+                self._end_block1_receive(key_token, close=False)
                 return transaction
             else:
                 # Continue
@@ -81,14 +557,16 @@ class BlockLayer(object):
                 transaction.response.destination = transaction.request.source
                 transaction.response.token = transaction.request.token
                 transaction.response.code = defines.Codes.CONTINUE.number
-                transaction.response.block1 = (num, m, size)
+                # the client scales down to the block size chosen for it
+                transaction.response.block1 = (num, m, min(size, self.block_size(transaction.request.source)))
 
             num += 1
-            byte = size
-            self._block1_receive[key_token].byte = byte
-            self._block1_receive[key_token].num = num
-            self._block1_receive[key_token].size = size
-            self._block1_receive[key_token].m = m
+            item.byte = reassembly.length
+            item.num = num
+            item.size = size
+            item.m = m
+            item.timestamp = time.time()
+            self._block1_receive[key_token] = item
 
         return transaction
 
@@ -102,8 +580,11 @@ class BlockLayer(object):
         """
         host, port = transaction.response.source
         key_token = hash(str(host) + str(port) + str(transaction.response.token))
-        if key_token in self._block1_sent and transaction.response.block1 is not None:
-            item = self._block1_sent[key_token]
+        item = self._block1_sent.get(key_token)
+        if item is not None and (transaction.response.block1 is None or item.m == 0):
+            # the server answered the last block, or stopped the transfer
+            self._end_block1(key_token, item)
+        if item is not None and transaction.response.block1 is not None:
             transaction.block_transfer = True
             if item.m == 0:
                 transaction.block_transfer = False
@@ -117,20 +598,26 @@ class BlockLayer(object):
             if n_size < item.size:
                 logger.debug("Scale down size, was " + str(item.size) + " become " + str(n_size))
                 item.size = n_size
+            if item.progress is not None:
+                item.progress(item.sent, self._body_size(item.payload))
             request = transaction.request
             del request.mid
             del request.block1
-            request.payload = item.payload[item.byte: item.byte+item.size]
+            del request.size1
+            request.payload, m = self._read_block(item.payload, item.byte, item.size)
             item.num += 1
             item.byte += item.size
-            if len(item.payload) <= item.byte:
-                m = 0
-            else:
-                m = 1
+            item.sent += len(request.payload)
+            item.m = m
+            item.timestamp = time.time()
             request.block1 = (item.num, m, item.size)
+            self._block1_sent[key_token] = item
         elif transaction.response.block2 is not None:
 
             num, m, size = transaction.response.block2
+            if num == 0 and key_token in self._block2_sent and self._block2_sent[key_token].num != 0:
+                # a new notification interrupted the transfer of the previous one
+                del self._block2_sent[key_token]
             if m == 1:
                 transaction.block_transfer = True
                 if key_token in self._block2_sent:
@@ -147,11 +634,17 @@ class BlockLayer(object):
                     item.num = num + 1
                     item.size = size
                     item.m = m
-                    item.payload += transaction.response.payload
+                    if item.payload is None:
+                        # first block of a transfer negotiated early
+                        item.payload = ReassemblyBuffer(self.announced_size(transaction.response), None)
+                    item.payload.write(transaction.response.payload)
                 else:
-                    item = BlockItem(size, num + 1, m, size, transaction.response.payload,
-                                     transaction.response.content_type)
-                    self._block2_sent[key_token] = item
+                    reassembly = ReassemblyBuffer(self.announced_size(transaction.response), None)
+                    reassembly.write(transaction.response.payload)
+                    item = BlockItem(size, num + 1, m, size, reassembly, transaction.response.content_type)
+                    item.observe = transaction.response.observe
+                item.timestamp = time.time()
+                self._block2_sent[key_token] = item
                 request = transaction.request
                 del request.mid
                 del request.block2
@@ -162,8 +655,15 @@ class BlockLayer(object):
                     if self._block2_sent[key_token].content_type != transaction.response.content_type:  # pragma: no cover
                         logger.error("Content-type Error")
                         return self.error(transaction, defines.Codes.UNSUPPORTED_CONTENT_FORMAT.number)
-                    transaction.response.payload = self._block2_sent[key_token].payload + transaction.response.payload
-                del self._block2_sent[key_token]
+                    item = self._block2_sent[key_token]
+                    if item.payload is not None:
+                        if transaction.response.payload:
+                            item.payload.write(transaction.response.payload)
+                        transaction.response.payload = item.payload.getvalue()
+                    if item.observe is not None and transaction.response.observe is None:
+                        # the blocks after the first one of a notification do not carry Observe
+                        transaction.response.observe = item.observe
+                    del self._block2_sent[key_token]
         else:
             transaction.block_transfer = False
         return transaction
@@ -187,50 +687,321 @@ class BlockLayer(object):
         :param transaction: the transaction that owns the response
         :rtype : Transaction
         """
+        if transaction.response.observe is not None and transaction.response.payload is not None:
+            if self.is_stream(transaction.response.payload):
+                # the representation of a notification is shared by all the observers, it is read whole
+                transaction.response.payload = StreamReader(transaction.response.payload).getvalue()
+            return self._send_notification(transaction)
         host, port = transaction.request.source
         key_token = hash(str(host) + str(port) + str(transaction.request.token))
-        if (key_token in self._block2_receive and transaction.response.payload is not None) or \
-                (transaction.response.payload is not None and len(transaction.response.payload) > defines.MAX_PAYLOAD):
-            if key_token in self._block2_receive:
+        item = self._block2_receive.get(key_token)
+        response = transaction.response
+        payload = response.payload
+        if payload is None:
+            return transaction
+        stream = self.is_stream(payload)
+        if stream:
+            payload = StreamReader(payload)
+        elif item is None and len(payload) <= self.block_size(transaction.request.source):
+            if transaction.request.size2 is not None:
+                self._announce_size(response, payload)
+            return transaction
+        elif isinstance(payload, unicode):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (str, buffer, bytearray, mmap.mmap)):
+            payload = str(payload)
+        negotiated = item is not None
+        if item is None:
+            item = BlockItem(0, 0, 1, self.block_size(transaction.request.source))
+        data, m = self._read_block(payload, item.byte, item.size)
+        if stream and not negotiated and m == 0:
+            # the whole stream fits in a single response
+            payload.close()
+            response.payload = data
+            return transaction
+        response.payload = data
+        del response.block2
+        response.block2 = (item.num, m, item.size)
+        if item.num == 0 or transaction.request.size2 is not None:
+            self._announce_size(response, payload)
 
-                byte = self._block2_receive[key_token].byte
-                size = self._block2_receive[key_token].size
-                num = self._block2_receive[key_token].num
+        item.byte += item.size
+        item.num += 1
+        if m == 0 or item.stateless:
+            try:
+                del self._block2_receive[key_token]
+            except KeyError:
+                # ended by a concurrent request of the same transfer
+                pass
+            if stream:
+                payload.close()
+            return transaction
+        item.timestamp = time.time()
+        self._block2_receive[key_token] = item
+        if stream or isinstance(payload, mmap.mmap):
+            # read on demand, not held in memory
+            size = 0
+        else:
+            size = len(payload)
+        if not self._reserve(size):
+            # the following blocks are rendered again
+            logger.debug("Block-wise budget exhausted, no snapshot kept")
+            return transaction
+        etag = response.etag
+        if etag:
+            etag = str(etag[0])
+        else:
+            etag = None
+        max_age = None
+        for option in response.options:
+            if option.number == defines.OptionRegistry.MAX_AGE.number:
+                max_age = option.value
+        snapshot = RepresentationItem(etag, payload, response.content_type, time.time(), response.code, max_age)
+        snapshot.size = size
+        self._block2_snapshots[key_token] = snapshot
+        return transaction
 
-            else:
-                byte = 0
-                num = 0
-                size = defines.MAX_PAYLOAD
-                m = 1
+    def _send_notification(self, transaction):
+        """
+        Send the first block of an observe response larger than a block. The whole representation is kept, tied to
+        its ETag, so that the observers fetch the other blocks with GET requests without rendering the resource
+        again. No state is kept for the token of the relation, the next notification starts from block 0 again.
 
-                self._block2_receive[key_token] = BlockItem(byte, num, m, size)
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the response
+        :rtype : Transaction
+        """
+        response = transaction.response
+        payload = response.payload
+        if transaction.request.block2 is not None:
+            num, m, size = transaction.request.block2
+        else:
+            size = self.block_size(transaction.request.source)
+        if response.block2 is not None and response.block2[1] == 1 and response.block2[2] == size:
+            # the first block of a representation shared by the observers of the same request
+            return transaction
+        if len(payload) <= size:
+            if transaction.request.block2 is not None:
+                del response.block2
+                response.block2 = (0, 0, size)
+            return transaction
+        etag = response.etag
+        if etag:
+            etag = str(etag[0])
+        else:
+            etag = self.generate_etag(payload)
+            response.etag = etag
+        path = "/" + transaction.request.uri_path
+        self._representations[hash(path)] = RepresentationItem(etag, payload, response.content_type, time.time())
+        response.payload = payload[:size]
+        del response.block2
+        response.block2 = (0, 1, size)
+        response.size2 = len(payload)
+        return transaction
 
-            ret = transaction.response.payload[byte:byte + size]
-            if len(ret) == size:
-                m = 1
-            else:
-                m = 0
-            transaction.response.payload = transaction.response.payload[byte:byte + size]
-            del transaction.response.block2
-            transaction.response.block2 = (num, m, size)
+    def _representation(self, request):
+        """
+        Get the representation shared by the observers of the requested resource. If the request carries ETags,
+        the representation must match one of them.
 
-            self._block2_receive[key_token].byte += size
-            self._block2_receive[key_token].num += 1
-            if m == 0:
-                # TODO remove from _block2_receive
-                del self._block2_receive[key_token]
+        :type request: Request
+        :param request: the request of a block
+        :rtype : RepresentationItem
+        :return: the representation or None
+        """
+        item = self._representations.get(hash("/" + request.uri_path))
+        if item is None or (request.etag and item.etag not in request.etag):
+            return None
+        return item
 
+    @staticmethod
+    def _send_representation(transaction, item, num, size, byte=None):
+        """
+        Answer a request of a block with a slice of a representation, the slice is not copied.
+
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the request
+        :type item: RepresentationItem
+        :param item: the representation
+        :param num: the number of the block
+        :param size: the size of the block
+        :param byte: the offset of the block, num * size if None
+        :rtype : Transaction
+        """
+        if byte is None:
+            byte = num * size
+        data, m = BlockLayer._read_block(item.payload, byte, size)
+        if data is None:
+            return BlockLayer.incomplete(transaction)
+        del transaction.request.block2
+        transaction.block_transfer = True
+        transaction.response = Response()
+        transaction.response.destination = transaction.request.source
+        transaction.response.token = transaction.request.token
+        transaction.response.code = item.code
+        if item.etag is not None:
+            transaction.response.etag = item.etag
+        if item.content_type != defines.Content_types["text/plain"]:
+            transaction.response.content_type = item.content_type
+        if item.max_age is not None:
+            transaction.response.max_age = item.max_age
+        transaction.response.block2 = (num, m, size)
+        transaction.response.payload = data
+        if num == 0 or transaction.request.size2 is not None:
+            BlockLayer._announce_size(transaction.response, item.payload)
         return transaction
 
-    def send_request(self, request):
+    @staticmethod
+    def _read_block(payload, byte, size):
+        """
+        Get a block of a representation, a slice of a string or a buffer is not copied.
+
+        :param payload: the representation, a string, a buffer or a StreamReader
+        :param byte: the offset of the block
+        :param size: the size of the block
+        :return: the block, None if a stream cannot go back to it, and the M flag
+        """
+        if isinstance(payload, StreamReader):
+            data, more = payload.read(byte, size)
+        else:
+            data = buffer(payload, byte, size)
+            more = byte + size < len(payload)
+        if more:
+            return data, 1
+        return data, 0
+
+    @staticmethod
+    def is_stream(payload):
+        """
+        Check if a payload is read block by block: a file object, an iterator of strings or a callable opening one.
+
+        :param payload: the payload
+        :return: True if the payload is a stream
+        """
+        if isinstance(payload, (basestring, buffer, bytearray, mmap.mmap, tuple)):
+            return False
+        return hasattr(payload, "read") or hasattr(payload, "__iter__") or callable(payload)
+
+    def _drop_snapshot(self, key_token):
+        """
+        Release the snapshot of a Block2 transfer, closing its stream.
+
+        :param key_token: the key of the transfer
+        """
+        snapshot = self._block2_snapshots.get(key_token)
+        if snapshot is None:
+            return
+        try:
+            del self._block2_snapshots[key_token]
+        except KeyError:
+            # released by a concurrent request of the same transfer
+            return
+        self._release(snapshot.size)
+        if isinstance(snapshot.payload, StreamReader):
+            snapshot.payload.close()
+
+    def _end_block1_receive(self, key_token, close=True):
+        """
+        Release the state and the body of a Block1 transfer.
+
+        :param key_token: the key of the transfer
+        :param close: False if the body has been handed to the resource
+        """
+        try:
+            del self._block1_receive[key_token]
+        except KeyError:
+            pass
+        reassembly = self._block1_buffers.pop(key_token, None)
+        if reassembly is None:
+            return
+        self._release(reassembly.held)
+        if close:
+            reassembly.close()
+
+    def _reserve(self, size):
+        """
+        Count bytes of a transfer in the budget.
+
+        :param size: the bytes
+        :return: False if they do not fit in the budget
+        """
+        with self._budget_lock:
+            if self._budget is not None and self._bytes_in_use + size > self._budget:
+                return False
+            self._bytes_in_use += size
+            return True
+
+    def _release(self, size):
+        """
+        Give back to the budget the bytes of a transfer.
+
+        :param size: the bytes
+        """
+        with self._budget_lock:
+            self._bytes_in_use = max(0, self._bytes_in_use - size)
+
+    def purge(self, now=None):
+        """
+        Release the block-wise transfers abandoned by the peers, with their snapshots and bodies, and the
+        representations of the notifications not requested anymore, after EXCHANGE_LIFETIME without activity.
+
+        :param now: the current time
+        """
+        if now is None:
+            now = time.time()
+        for table in (self._block2_snapshots, self._representations, self._block1_receive, self._block2_receive,
+                      self._block1_sent, self._block2_sent):
+            for key in table.keys():
+                item = table.get(key)
+                if item is None or now - item.timestamp <= defines.EXCHANGE_LIFETIME:
+                    continue
+                if table is self._block2_snapshots:
+                    self._drop_snapshot(key)
+                    continue
+                if table is self._block1_receive:
+                    logger.debug("Purge abandoned Block1 transfer")
+                    self._end_block1_receive(key)
+                    continue
+                try:
+                    del table[key]
+                except KeyError:
+                    continue
+                if isinstance(item.payload, StreamReader):
+                    item.payload.close()
+        if self._policy is not None:
+            self._policy.purge(now)
+
+    @staticmethod
+    def generate_etag(payload):
+        """
+        Generate an ETag from a representation, the same representation always gets the same ETag.
+
+        :param payload: the payload
+        :return: the ETag, 8 hexadecimal digits
+        """
+        if isinstance(payload, unicode):
+            payload = payload.encode("utf-8")
+        return hashlib.sha1(payload).hexdigest()[:8]
+
+    def send_request(self, request, progress=None):
         """
-        Handles the Blocks option in a outgoing request.
+        Handles the Blocks option in a outgoing request. The payload can be a file object, an iterator of strings or
+        a callable opening one: it is then read one block at a time, as the server acknowledges the previous block.
 
         :type request: Request
         :param request: the outgoing request
+        :param progress: function called with the bytes sent and the size of the body, None if unknown, when the
+            server acknowledges a block
         """
         assert isinstance(request, Request)
-        if request.block1 or (request.payload is not None and len(request.payload) > defines.MAX_PAYLOAD):
+        payload = request.payload
+        stream = payload is not None and self.is_stream(payload)
+        block_size = self.block_size(request.destination)
+        if block_size < defines.MAX_PAYLOAD and request.block2 is None and request.block1 is None \
+                and request.code == defines.Codes.GET.number:
+            # ask the server for the blocks chosen for it
+            request.block2 = (0, 0, block_size)
+        if request.block1 or stream or (payload is not None and len(payload) > block_size):
             host, port = request.destination
             key_token = hash(str(host) + str(port) + str(request.token))
             if request.block1:
@@ -238,21 +1009,151 @@ class BlockLayer(object):
             else:
                 num = 0
                 m = 1
-                size = defines.MAX_PAYLOAD
+                size = block_size
 
-            self._block1_sent[key_token] = BlockItem(size, num, m, size, request.payload, request.content_type)
-            request.payload = request.payload[0:size]
+            if stream:
+                payload = StreamReader(payload)
+                data, more = self._read_block(payload, 0, size)
+                if not more and not request.block1:
+                    # the whole body fits in a single request
+                    payload.close()
+                    request.payload = data
+                    return request
+                m = more
+                total = payload.size
+                if total is not None and request.size1 is None:
+                    # lets the server preallocate the body
+                    request.size1 = total
+            else:
+                data = payload[0:size]
+            item = BlockItem(size, num, m, size, payload, request.content_type)
+            item.sent = len(data)
+            item.progress = progress
+            self._block1_sent[key_token] = item
+            request.payload = data
             del request.block1
             request.block1 = (num, m, size)
         elif request.block2:
             host, port = request.destination
             key_token = hash(str(host) + str(port) + str(request.token))
             num, m, size = request.block2
-            item = BlockItem(size, num, m, size, "", None)
+            item = BlockItem(size, num, m, size, None, None)
             self._block2_sent[key_token] = item
             return request
         return request
 
+    def announced_size(self, response):
+        """
+        Get the size of a representation announced by the server in Size2, to preallocate its reassembly.
+
+        :type response: Response
+        :param response: the response carrying the first block
+        :return: the size in bytes, None if not announced or larger than the budget
+        """
+        size = response.size2
+        if size is None or (self._budget is not None and size > self._budget):
+            return None
+        return size
+
+    def block_size(self, peer):
+        """
+        Get the block size used with a peer when it does not ask for one.
+
+        :param peer: the (ip, port) of the peer
+        :return: the block size in bytes
+        """
+        if self._policy is None:
+            return defines.MAX_PAYLOAD
+        return self._policy.size(peer)
+
+    def record(self, peer, retransmissions=0, rtt=None, delivered=True):
+        """
+        Report an exchange with a peer to the block size policy, if any.
+
+        :param peer: the (ip, port) of the peer
+        :param retransmissions: the number of transmissions lost
+        :param rtt: the round trip time in seconds, only when the message has not been retransmitted
+        :param delivered: False if the exchange timed out
+        """
+        if self._policy is not None:
+            self._policy.record(peer, retransmissions, rtt, delivered)
+
+    def _end_block1(self, key_token, item):
+        """
+        Release a Block1 transfer sent by the client, closing its stream.
+
+        :param key_token: the key of the transfer
+        :type item: BlockItem
+        :param item: the transfer
+        """
+        try:
+            del self._block1_sent[key_token]
+        except KeyError:
+            return
+        if item.m == 0 and item.progress is not None:
+            item.progress(item.sent, self._body_size(item.payload))
+        if isinstance(item.payload, StreamReader):
+            item.payload.close()
+
+    @staticmethod
+    def _announce_size(response, payload):
+        """
+        Announce the size of the whole representation in the Size2 option, if it is known.
+
+        :type response: Response
+        :param response: the response carrying a block of the representation
+        :param payload: a string or a StreamReader
+        """
+        size = BlockLayer._body_size(payload)
+        if size is not None:
+            response.size2 = size
+
+    @staticmethod
+    def _body_size(payload):
+        """
+        Get the size of a body sent block-wise.
+
+        :param payload: a string or a StreamReader
+        :return: the size in bytes or None if unknown
+        """
+        if isinstance(payload, StreamReader):
+            return payload.size
+        return len(payload)
+
+    @staticmethod
+    def too_large(transaction, size):
+        """
+        Refuse a Block1 body with 4.13 Request Entity Too Large.
+
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the request
+        :param size: the largest body accepted, sent in the Size1 option
+        :rtype : Transaction
+        """
+        transaction.block_transfer = True
+        transaction.response = Response()
+        transaction.response.destination = transaction.request.source
+        transaction.response.token = transaction.request.token
+        transaction.response.code = defines.Codes.REQUEST_ENTITY_TOO_LARGE.number
+        transaction.response.size1 = size
+        return transaction
+
+    @staticmethod
+    def unavailable(transaction):
+        """
+        Refuse a block with 5.03 Service Unavailable, the transfer can be tried again later.
+
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the request
+        :rtype : Transaction
+        """
+        transaction.block_transfer = True
+        transaction.response = Response()
+        transaction.response.destination = transaction.request.source
+        transaction.response.token = transaction.request.token
+        transaction.response.code = defines.Codes.SERVICE_UNAVAILABLE.number
+        return transaction
+
     @staticmethod
     def incomplete(transaction):
         transaction.block_transfer = True
@@ -4,33 +4,130 @@ import time
 from coapthon.messages.message import Message
 from coapthon import defines
 from coapthon.messages.request import Request
+from coapthon.storage.storage import MemoryStorage
 from coapthon.transaction import Transaction
 
 logger = logging.getLogger(__name__)
 
 
 class MessageLayer(object):
-    def __init__(self, starting_mid):
-        self._transactions = {}
-        self._transactions_token = {}
+    def __init__(self, starting_mid, storage=None, pool=None):
+        """
+        Initialize a Message Layer.
+
+        :param starting_mid: the first MID to use, random if None
+        :type storage: Storage
+        :param storage: where the transactions are kept, in-process dicts if None
+        :type pool: ExchangePool
+        :param pool: if not None, transactions are taken from the pool and recycled when purged
+        """
+        if storage is None:
+            storage = MemoryStorage()
+        self._pool = pool
+        self._transactions = storage.table("transactions")
+        self._transactions_token = storage.table("transactions_token")
+        self._non_requests = storage.table("non_requests")
         if starting_mid is not None:
             self._current_mid = starting_mid
         else:
             self._current_mid = random.randint(1, 1000)
 
     def purge(self):
-        for k in self._transactions.keys():
-            now = time.time()
-            transaction = self._transactions[k]
-            if transaction.timestamp + defines.EXCHANGE_LIFETIME < now:
-                logger.debug("Delete transaction")
-                del self._transactions[k]
-        for k in self._transactions_token.keys():
-            now = time.time()
-            transaction = self._transactions_token[k]
-            if transaction.timestamp + defines.EXCHANGE_LIFETIME < now:
-                logger.debug("Delete transaction")
-                del self._transactions_token[k]
+        expired = []
+        for table in (self._transactions, self._transactions_token):
+            for k in table.keys():
+                now = time.time()
+                transaction = table.get(k)
+                if transaction is not None and transaction.timestamp + defines.EXCHANGE_LIFETIME < now:
+                    logger.debug("Delete transaction")
+                    self._delete(table, k)
+                    if self._pool is not None:
+                        expired.append(transaction)
+        if expired:
+            self._recycle_expired(expired)
+        now = time.time()
+        for k in self._non_requests.keys():
+            timestamp = self._non_requests.get(k)
+            if timestamp is not None and timestamp + defines.NON_LIFETIME < now:
+                self._delete(self._non_requests, k)
+
+    def _recycle_expired(self, expired):
+        """
+        Give back to the pool the purged transactions that nobody can use anymore. Transactions still stored under
+        another key, holding an observe relation, retransmitting or in a block-wise transfer are left to the GC.
+
+        :param expired: the purged transactions
+        """
+        alive = set()
+        for table in (self._transactions, self._transactions_token):
+            for k in table.keys():
+                alive.add(id(table.get(k)))
+        recycled = set()
+        for transaction in expired:
+            if id(transaction) in alive or id(transaction) in recycled:
+                continue
+            if transaction.request is None or transaction.request.observe is not None \
+                    or transaction.retransmit_thread is not None or transaction.block_transfer:
+                continue
+            recycled.add(id(transaction))
+            self._pool.recycle(transaction)
+
+    def recycle(self, transaction):
+        """
+        Give back to the pool a transaction that was never stored, such as the ones of receive_non_request.
+
+        :type transaction: Transaction
+        :param transaction: the transaction
+        """
+        if self._pool is not None:
+            self._pool.recycle(transaction)
+
+    def _new_transaction(self, request, lock=True):
+        """
+        Create the transaction of a request, taking it from the pool if any.
+
+        :type request: Request
+        :param request: the request
+        :param lock: if the transaction needs a lock
+        :rtype : Transaction
+        """
+        if self._pool is not None:
+            return self._pool.transaction(request=request, timestamp=request.timestamp)
+        return Transaction(request=request, timestamp=request.timestamp, lock=lock)
+
+    @staticmethod
+    def _store(table, key, value):
+        """
+        Store a value in a table. A shared table refuses a value larger than its slots, or any value when it is
+        full: the message is still handled, only the other workers do not see it.
+
+        :param table: the table
+        :param key: the key
+        :param value: the value
+        """
+        try:
+            table[key] = value
+        except ValueError:
+            logger.exception("Cannot store the state of an exchange")
+
+    @staticmethod
+    def _delete(table, key):
+        try:
+            del table[key]
+        except KeyError:
+            # already removed by another worker sharing the storage
+            pass
+
+    def fetch_mid(self):
+        """
+        Get the next MID to use for an outgoing message.
+
+        :rtype : int
+        """
+        current_mid = self._current_mid
+        self._current_mid += 1
+        self._current_mid %= 65535
+        return current_mid
 
     def receive_request(self, request):
         """
@@ -47,18 +144,41 @@ class MessageLayer(object):
         key_mid = hash(str(host).lower() + str(port).lower() + str(request.mid).lower())
         key_token = hash(str(host).lower() + str(port).lower() + str(request.token).lower())
 
-        if key_mid in self._transactions.keys():
+        if key_mid in self._transactions:
             # Duplicated
-            self._transactions[key_mid].request.duplicated = True
             transaction = self._transactions[key_mid]
+            transaction.request.duplicated = True
         else:
             request.timestamp = time.time()
-            transaction = Transaction(request=request, timestamp=request.timestamp)
+            transaction = self._new_transaction(request)
             with transaction:
-                self._transactions[key_mid] = transaction
-                self._transactions_token[key_token] = transaction
+                self._store(self._transactions, key_mid, transaction)
+                self._store(self._transactions_token, key_token, transaction)
         return transaction
 
+    def receive_non_request(self, request):
+        """
+        Fast path for NON requests that carry neither Block nor Observe options. Only the reception time is kept
+        for duplicate detection and the returned transaction is not stored.
+
+        :type request: Request
+        :param request: the incoming request
+        :rtype : Transaction
+        :return: the transaction or None if the request is a duplicate
+        """
+        logger.debug("receive_non_request - " + str(request))
+        try:
+            host, port = request.source
+        except AttributeError:
+            return
+        key_mid = hash(str(host).lower() + str(port).lower() + str(request.mid).lower())
+        if key_mid in self._non_requests:
+            request.duplicated = True
+            return None
+        request.timestamp = time.time()
+        self._store(self._non_requests, key_mid, request.timestamp)
+        return self._new_transaction(request, lock=False)
+
     def receive_response(self, response):
         """
 
@@ -71,15 +191,16 @@ class MessageLayer(object):
             host, port = response.source
         except AttributeError:
             return
-        key_mid = hash(str(host).lower() + str(port).lower() + str(response.mid).lower())
-        key_mid_multicast = hash(str(defines.ALL_COAP_NODES).lower() + str(port).lower() + str(response.mid).lower())
-        key_token = hash(str(host).lower() + str(port).lower() + str(response.token).lower())
-        key_token_multicast = hash(str(defines.ALL_COAP_NODES).lower() + str(port).lower() + str(response.token).lower())
-        if key_mid in self._transactions.keys():
+        # same keys as send_request, tokens are opaque and must not be case folded
+        key_mid = hash(str(host) + str(port) + str(response.mid))
+        key_mid_multicast = hash(str(defines.ALL_COAP_NODES) + str(port) + str(response.mid))
+        key_token = hash(str(host) + str(port) + str(response.token))
+        key_token_multicast = hash(str(defines.ALL_COAP_NODES) + str(port) + str(response.token))
+        if key_mid in self._transactions:
             transaction = self._transactions[key_mid]
         elif key_token in self._transactions_token:
             transaction = self._transactions_token[key_token]
-        elif key_mid_multicast in self._transactions.keys():
+        elif key_mid_multicast in self._transactions:
             transaction = self._transactions[key_mid_multicast]
         elif key_token_multicast in self._transactions_token:
             transaction = self._transactions_token[key_token_multicast]
@@ -113,11 +234,11 @@ class MessageLayer(object):
         key_mid_multicast = hash(str(defines.ALL_COAP_NODES) + str(port) + str(message.mid))
         key_token = hash(str(host) + str(port) + str(message.token))
         key_token_multicast = hash(str(defines.ALL_COAP_NODES) + str(port) + str(message.token))
-        if key_mid in self._transactions.keys():
+        if key_mid in self._transactions:
             transaction = self._transactions[key_mid]
         elif key_token in self._transactions_token:
             transaction = self._transactions_token[key_token]
-        elif key_mid_multicast in self._transactions.keys():
+        elif key_mid_multicast in self._transactions:
             transaction = self._transactions[key_mid_multicast]
         elif key_token_multicast in self._transactions_token:
             transaction = self._transactions_token[key_token_multicast]
@@ -128,12 +249,12 @@ class MessageLayer(object):
         if message.type == defines.Types["ACK"]:
             if not transaction.request.acknowledged:
                 transaction.request.acknowledged = True
-            elif not transaction.response.acknowledged:
+            elif transaction.response is not None and not transaction.response.acknowledged:
                 transaction.response.acknowledged = True
         elif message.type == defines.Types["RST"]:
             if not transaction.request.acknowledged:
                 transaction.request.rejected = True
-            elif not transaction.response.acknowledged:
+            elif transaction.response is not None and not transaction.response.acknowledged:
                 transaction.response.rejected = True
 
         if transaction.retransmit_stop is not None:
@@ -197,9 +318,43 @@ class MessageLayer(object):
             except AttributeError:
                 return
             key_mid = hash(str(host).lower() + str(port).lower() + str(transaction.response.mid).lower())
-            self._transactions[key_mid] = transaction
+            self._store(self._transactions, key_mid, transaction)
 
         transaction.request.acknowledged = True
+        self.update(transaction)
+        return transaction
+
+    def update(self, transaction):
+        """
+        Write back a transaction of an incoming request after it has been modified, so that storages that do not
+        share objects see its current state.
+
+        :type transaction: Transaction
+        :param transaction: the transaction
+        """
+        try:
+            host, port = transaction.request.source
+        except (AttributeError, TypeError):
+            return
+        key_mid = hash(str(host).lower() + str(port).lower() + str(transaction.request.mid).lower())
+        key_token = hash(str(host).lower() + str(port).lower() + str(transaction.request.token).lower())
+        if key_mid in self._transactions:
+            self._store(self._transactions, key_mid, transaction)
+        if key_token in self._transactions_token:
+            self._store(self._transactions_token, key_token, transaction)
+
+    def send_non_response(self, transaction):
+        """
+        Complete the response to a request received through receive_non_request.
+
+        :type transaction: Transaction
+        :param transaction:
+        """
+        logger.debug("send_non_response - " + str(transaction.response))
+        transaction.response.type = defines.Types["NON"]
+        transaction.response.mid = self.fetch_mid()
+        transaction.request.acknowledged = True
+        transaction.completed = True
         return transaction
 
     def send_empty(self, transaction, related, message):
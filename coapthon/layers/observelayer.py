@@ -1,21 +1,213 @@
+import binascii
+import json
 import logging
+import os
 import time
 from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.serializer import Serializer
+from coapthon.storage.storage import MemoryStorage
+from coapthon.transaction import Transaction
 
 logger = logging.getLogger(__name__)
 
 
 class ObserveItem(object):
-    def __init__(self, timestamp, non_counter, allowed, transaction):
+    def __init__(self, timestamp, non_counter, allowed, transaction, pmin=None, pmax=None, step=None):
+        """
+        An observe relation.
+
+        :param timestamp: the time of the last registration or notification
+        :param non_counter: the number of NON notifications sent since the last CON one
+        :param allowed: if notifications can be sent
+        :param transaction: the transaction of the observe request
+        :param pmin: the minimum period between two notifications in seconds, None for no limit
+        :param pmax: the maximum period between two notifications in seconds, None for no limit
+        :param step: the minimum change of a numeric representation that triggers a notification
+        """
         self.timestamp = timestamp
         self.non_counter = non_counter
         self.allowed = allowed
         self.transaction = transaction
+        self.pmin = pmin
+        self.pmax = pmax
+        self.step = step
+        self.last_value = None
+        self.pending = False
+        # last time the client showed it is alive: registration or ACK of a notification
+        self.last_seen = timestamp
+        # Max-Age of the last notification
+        self.max_age = defines.OptionRegistry.MAX_AGE.default
+        # a CON notification is waiting for its ACK
+        self.checking = False
+        self.notification_type = None
 
 
 class ObserveLayer(object):
-    def __init__(self):
-        self._relations = {}
+    def __init__(self, storage=None, max_per_resource=None, max_per_client=None, eviction="oldest"):
+        """
+        Initialize an Observe Layer.
+
+        :type storage: Storage
+        :param storage: where the observe relations are kept, in-process dicts if None
+        :param max_per_resource: the maximum number of observers of a resource, None for no limit
+        :param max_per_client: the maximum number of relations of a client (IP address), None for no limit
+        :param eviction: what to do with a new registration beyond a limit: "oldest" drops the relation that has
+            not been seen for the longest time, "reject" serves the request without registering the observer
+        """
+        if storage is None:
+            storage = MemoryStorage()
+        assert eviction in ("oldest", "reject")
+        self._max_per_resource = max_per_resource
+        self._max_per_client = max_per_client
+        self._eviction = eviction
+        self._relations = storage.table("relations")
+        # hash(path) -> set of the key_tokens of the relations on that path
+        self._index = storage.table("relations_index")
+        # hash(host) -> set of the key_tokens of the relations of that client
+        self._clients = storage.table("relations_clients")
+        # key_tokens of the relations with a pending notification or a pmax
+        self._scheduled = set()
+
+    @staticmethod
+    def _relation_path(item):
+        """
+        Get the path of the resource observed through a relation.
+
+        :type item: ObserveItem
+        :param item: the relation
+        :return: the path or None if the relation has no request, i.e. it has been created by a client
+        """
+        if item.transaction is None or item.transaction.request is None:
+            return None
+        return "/" + item.transaction.request.uri_path
+
+    @staticmethod
+    def _relation_host(item):
+        """
+        Get the address of the client of a relation.
+
+        :type item: ObserveItem
+        :param item: the relation
+        :return: the host or None if the relation has been created by a client
+        """
+        if item.transaction is None or item.transaction.request is None or item.transaction.request.source is None:
+            return None
+        return str(item.transaction.request.source[0])
+
+    def _add_relation(self, key_token, item):
+        """
+        Store a relation and index it by the path of the observed resource and by client.
+
+        :param key_token: the key of the relation
+        :type item: ObserveItem
+        :param item: the relation
+        """
+        old = self._relations.get(key_token)
+        self._relations[key_token] = item
+        for index, get_key in ((self._index, self._relation_path), (self._clients, self._relation_host)):
+            value = get_key(item)
+            old_value = get_key(old) if old is not None else None
+            if old_value is not None and old_value != value:
+                self._index_discard(index, hash(old_value), key_token)
+            if value is not None:
+                self._index_add(index, hash(value), key_token)
+
+    def _remove_relation(self, key_token):
+        """
+        Delete a relation and its entries in the indexes.
+
+        :param key_token: the key of the relation
+        :raise KeyError: if there is no such relation
+        """
+        item = self._relations[key_token]
+        del self._relations[key_token]
+        self._scheduled.discard(key_token)
+        for index, get_key in ((self._index, self._relation_path), (self._clients, self._relation_host)):
+            value = get_key(item)
+            if value is not None:
+                self._index_discard(index, hash(value), key_token)
+
+    @staticmethod
+    def _index_add(index, index_key, key_token):
+        keys = index.get(index_key)
+        if keys is None:
+            keys = set()
+        if key_token not in keys:
+            keys.add(key_token)
+            index[index_key] = keys
+
+    @staticmethod
+    def _index_discard(index, index_key, key_token):
+        keys = index.get(index_key)
+        if keys is not None and key_token in keys:
+            keys.discard(key_token)
+            if keys:
+                index[index_key] = keys
+            else:
+                try:
+                    del index[index_key]
+                except KeyError:
+                    pass
+
+    def _make_room(self, path, host):
+        """
+        Enforce the limits on the number of relations before a new registration.
+
+        :param path: the path of the resource to be observed
+        :param host: the address of the client
+        :return: True if the new relation can be added
+        """
+        for index, index_key, limit in ((self._index, hash(path), self._max_per_resource),
+                                        (self._clients, hash(host), self._max_per_client)):
+            if limit is None:
+                continue
+            keys = index.get(index_key)
+            while keys and len(keys) >= limit:
+                if self._eviction == "reject":
+                    return False
+                oldest = min(keys, key=self._last_seen)
+                logger.info("Evict observer")
+                self._evict(oldest)
+                keys = index.get(index_key)
+        return True
+
+    def _last_seen(self, key_token):
+        item = self._relations.get(key_token)
+        if item is None:
+            return 0
+        return item.last_seen
+
+    def _evict(self, key_token):
+        """
+        Drop a relation, e.g. to make room for a new one or because the client is not alive anymore.
+
+        :param key_token: the key of the relation
+        """
+        item = self._relations.get(key_token)
+        if item is not None and item.transaction is not None:
+            item.transaction.completed = True
+        try:
+            self._remove_relation(key_token)
+        except KeyError:
+            # stale entry of an index
+            for index in (self._index, self._clients):
+                for index_key in index.keys():
+                    self._index_discard(index, index_key, key_token)
+
+    def _relations_of(self, paths):
+        """
+        Get the keys of the relations on the given paths.
+
+        :param paths: the paths of the resources
+        :return: the list of keys
+        """
+        ret = []
+        for path in paths:
+            keys = self._index.get(hash(path))
+            if keys:
+                ret.extend(list(keys))
+        return ret
 
     def send_request(self, request):
         """
@@ -53,7 +245,7 @@ class ObserveLayer(object):
         host, port = message.destination
         key_token = hash(str(host) + str(port) + str(message.token))
         if key_token in self._relations and message.type == defines.Types["RST"]:
-            del self._relations[key_token]
+            self._remove_relation(key_token)
         return message
 
     def receive_request(self, transaction):
@@ -73,7 +265,21 @@ class ObserveLayer(object):
                 allowed = True
             else:
                 allowed = False
-            self._relations[key_token] = ObserveItem(time.time(), non_counter, allowed, transaction)
+                if not self._make_room("/" + transaction.request.uri_path, str(host)):
+                    logger.info("Too many observers, serve the request without registration")
+                    return transaction
+            pmin, pmax, step = self._conditional_attributes(transaction.request.uri_query)
+            self._add_relation(key_token, ObserveItem(time.time(), non_counter, allowed, transaction, pmin, pmax,
+                                                      step))
+        elif transaction.request.observe == 1:
+            # Deregistration
+            host, port = transaction.request.source
+            key_token = hash(str(host) + str(port) + str(transaction.request.token))
+            try:
+                self._remove_relation(key_token)
+                logger.info("Remove Subscriber")
+            except KeyError:
+                pass
 
         return transaction
 
@@ -91,10 +297,19 @@ class ObserveLayer(object):
             key_token = hash(str(host) + str(port) + str(transaction.request.token))
             logger.info("Remove Subscriber")
             try:
-                del self._relations[key_token]
+                self._remove_relation(key_token)
             except KeyError:
                 pass
             transaction.completed = True
+        elif empty.type == defines.Types["ACK"] and transaction.request is not None:
+            host, port = transaction.request.source
+            key_token = hash(str(host) + str(port) + str(transaction.request.token))
+            item = self._relations.get(key_token)
+            if item is not None:
+                # the client is alive
+                item.last_seen = time.time()
+                item.checking = False
+                self._relations[key_token] = item
         return transaction
 
     def send_response(self, transaction):
@@ -110,43 +325,307 @@ class ObserveLayer(object):
                 if transaction.resource is not None and transaction.resource.observable:
 
                     transaction.response.observe = transaction.resource.observe_count
-                    self._relations[key_token].allowed = True
-                    self._relations[key_token].transaction = transaction
-                    self._relations[key_token].timestamp = time.time()
+                    item = self._relations[key_token]
+                    item.allowed = True
+                    item.transaction = transaction
+                    item.timestamp = time.time()
+                    item.pending = False
+                    item.last_value = self._numeric_value(transaction.resource)
+                    item.max_age = transaction.response.max_age
+                    if item.notification_type is not None and transaction.response.type is None:
+                        transaction.response.type = item.notification_type
+                    item.notification_type = None
+                    if item.pmax is not None:
+                        self._scheduled.add(key_token)
+                    else:
+                        self._scheduled.discard(key_token)
+                    self._add_relation(key_token, item)
                 else:
-                    del self._relations[key_token]
+                    self._remove_relation(key_token)
             elif transaction.response.code >= defines.Codes.ERROR_LOWER_BOUND:
-                del self._relations[key_token]
+                self._remove_relation(key_token)
         return transaction
 
     def notify(self, resource, root=None):
+        """
+        Get the transactions of the observers to be notified of a change of a resource. Observers that asked for
+        a pmin are notified at most once every pmin seconds, the changes that come earlier are coalesced and
+        returned later by due(). Observers that asked for a step are not notified of smaller changes.
+
+        :param resource: the changed resource
+        :param root: the resource tree, if given the observers of the ancestors are notified too
+        :return: the list of transactions
+        """
         ret = []
+        now = time.time()
         if root is not None:
             resource_list = root.with_prefix_resource(resource.path)
         else:
             resource_list = [resource]
+        paths = [r.path for r in resource_list]
+        value = None
+        for key in self._relations_of(paths):
+            item = self._relations.get(key)
+            if item is None or item.transaction is None:
+                continue
+            if item.transaction.resource is not None:
+                matched = item.transaction.resource in resource_list
+            else:
+                # relation restored from a shared storage, the resource object is local to each process
+                matched = "/" + item.transaction.request.uri_path in paths
+            if not matched:
+                continue
+            if item.step is not None and item.last_value is not None:
+                if value is None:
+                    value = self._numeric_value(resource)
+                if value is not None and abs(value - item.last_value) < item.step:
+                    continue
+            if item.pmin is not None and now - item.timestamp < item.pmin:
+                item.pending = True
+                self._scheduled.add(key)
+                self._relations[key] = item
+                continue
+            ret.append(self._prepare_notification(key, item, resource, now))
+        return ret
+
+    def due(self, now=None):
+        """
+        Get the transactions of the observers whose coalesced notification can be sent because pmin has elapsed,
+        or that must be notified because pmax has elapsed.
+
+        :param now: the current time
+        :return: the list of transactions
+        """
+        if now is None:
+            now = time.time()
+        ret = []
+        for key in list(self._scheduled):
+            item = self._relations.get(key)
+            if item is None or item.transaction is None:
+                self._scheduled.discard(key)
+                continue
+            elapsed = now - item.timestamp
+            if (item.pending and elapsed >= (item.pmin or 0)) or (item.pmax is not None and elapsed >= item.pmax):
+                item.pending = False
+                ret.append(self._prepare_notification(key, item, item.transaction.resource, now))
+        return ret
+
+    def next_due(self, now=None):
+        """
+        Get the time left before due() returns something.
+
+        :param now: the current time
+        :return: the number of seconds or None if no notification is scheduled
+        """
+        if now is None:
+            now = time.time()
+        ret = None
+        for key in list(self._scheduled):
+            item = self._relations.get(key)
+            if item is None:
+                continue
+            if item.pending:
+                deadline = item.timestamp + (item.pmin or 0)
+            elif item.pmax is not None:
+                deadline = item.timestamp + item.pmax
+            else:
+                continue
+            if ret is None or deadline < ret:
+                ret = deadline
+        if ret is None:
+            return None
+        return max(0, ret - now)
+
+    def _prepare_notification(self, key, item, resource, now):
+        """
+        Prepare the transaction of a relation for a new notification. The notification is sent as CON if the
+        observer registered with a CON, after MAX_NON_NOTIFICATIONS NON notifications, or if the client has not
+        been seen for longer than the Max-Age of the last notification.
+
+        :param key: the key of the relation
+        :type item: ObserveItem
+        :param item: the relation
+        :param resource: the resource to be rendered
+        :param now: the current time
+        :rtype : Transaction
+        """
+        if item.non_counter > defines.MAX_NON_NOTIFICATIONS \
+                or item.transaction.request.type == defines.Types["CON"] \
+                or now - item.last_seen >= item.max_age:
+            item.notification_type = defines.Types["CON"]
+            item.non_counter = 0
+            item.checking = True
+        else:
+            item.non_counter += 1
+            item.notification_type = defines.Types["NON"]
+        item.transaction.resource = resource
+        if item.transaction.response is not None:
+            del item.transaction.response.mid
+            del item.transaction.response.token
+        self._relations[key] = item
+        return item.transaction
+
+    def purge(self, now=None):
+        """
+        Remove the relations of the clients that did not answer a liveness check, and start a check (a CON
+        notification) for the relations whose client has not been seen for longer than the Max-Age of the last
+        notification.
+
+        :param now: the current time
+        :return: the transactions of the relations to be checked
+        """
+        if now is None:
+            now = time.time()
+        ret = []
         for key in self._relations.keys():
-            if self._relations[key].transaction.resource in resource_list:
-                if self._relations[key].non_counter > defines.MAX_NON_NOTIFICATIONS \
-                        or self._relations[key].transaction.request.type == defines.Types["CON"]:
-                    self._relations[key].transaction.response.type = defines.Types["CON"]
-                    self._relations[key].non_counter = 0
-                elif self._relations[key].transaction.request.type == defines.Types["NON"]:
-                    self._relations[key].non_counter += 1
-                    self._relations[key].transaction.response.type = defines.Types["NON"]
-                self._relations[key].transaction.resource = resource
-                del self._relations[key].transaction.response.mid
-                del self._relations[key].transaction.response.token
-                ret.append(self._relations[key].transaction)
+            item = self._relations.get(key)
+            if item is None or item.transaction is None or item.transaction.request is None:
+                continue
+            idle = now - item.last_seen
+            if item.checking and idle > item.max_age + defines.EXCHANGE_LIFETIME:
+                logger.info("Observer expired")
+                self._evict(key)
+            elif not item.checking and idle >= item.max_age:
+                ret.append(self._prepare_notification(key, item, item.transaction.resource, now))
         return ret
 
+    def snapshot(self, filename):
+        """
+        Save the observe relations to a JSON file, so that a restarted server can keep notifying the observers
+        without waiting for them to register again. For every relation the observe request is saved encoded, with
+        the peer, together with the state of the relation. The Observe sequence number of the observed resources
+        is saved too. The file is replaced atomically.
+
+        :param filename: the path of the file
+        :return: the number of relations saved
+        """
+        serializer = Serializer()
+        relations = []
+        sequences = {}
+        for key in self._relations.keys():
+            item = self._relations.get(key)
+            if item is None or self._relation_host(item) is None:
+                continue
+            request = item.transaction.request
+            relations.append({
+                "source": list(request.source),
+                "request": binascii.hexlify(serializer.serialize(request)),
+                "non_counter": item.non_counter,
+                "pmin": item.pmin,
+                "pmax": item.pmax,
+                "step": item.step,
+                "last_value": item.last_value,
+                "last_seen": item.last_seen,
+                "max_age": item.max_age
+            })
+            resource = item.transaction.resource
+            if resource is not None:
+                sequences[resource.path] = resource.observe_count
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"relations": relations, "observe": sequences}, f)
+        os.rename(tmp, filename)
+        return len(relations)
+
+    def restore(self, filename, root):
+        """
+        Load the observe relations saved by snapshot. Relations on resources that do not exist anymore are
+        dropped. The Observe sequence number of the observed resources is moved past the saved one, so that the
+        observers do not discard the next notification as old.
+
+        :param filename: the path of the file
+        :param root: the resource tree
+        :return: the number of relations restored, 0 if the file does not exist
+        """
+        try:
+            with open(filename) as f:
+                saved = json.load(f)
+        except IOError:
+            return 0
+        for path, sequence in saved["observe"].items():
+            try:
+                resource = root[str(path)]
+            except KeyError:
+                continue
+            resource.observe_count = max(resource.observe_count, sequence + 1)
+        serializer = Serializer()
+        restored = 0
+        now = time.time()
+        for entry in saved["relations"]:
+            host, port = entry["source"]
+            request = serializer.deserialize(binascii.unhexlify(entry["request"]), (str(host), int(port)))
+            if not isinstance(request, Request):
+                continue
+            try:
+                resource = root["/" + request.uri_path]
+            except KeyError:
+                logger.info("Observed resource not found, drop relation")
+                continue
+            transaction = Transaction(request=request, resource=resource, timestamp=now)
+            transaction.completed = True
+            item = ObserveItem(now, entry["non_counter"], True, transaction, entry["pmin"], entry["pmax"],
+                               entry["step"])
+            item.last_value = entry["last_value"]
+            item.last_seen = entry["last_seen"]
+            item.max_age = entry["max_age"]
+            key_token = hash(str(host) + str(port) + str(request.token))
+            self._add_relation(key_token, item)
+            if item.pmax is not None:
+                self._scheduled.add(key_token)
+            restored += 1
+        return restored
+
+    @staticmethod
+    def _conditional_attributes(query):
+        """
+        Parse the pmin, pmax and st conditional attributes of an observe request, e.g. "pmin=1&pmax=60&st=0.5".
+        Malformed values are ignored.
+
+        :param query: the Uri-Query of the request
+        :return: pmin, pmax and step, each one None if missing
+        """
+        attributes = {}
+        for q in query.split("&"):
+            tmp = q.split("=")
+            if len(tmp) != 2 or tmp[0] not in ("pmin", "pmax", "st"):
+                continue
+            try:
+                value = float(tmp[1])
+            except ValueError:
+                continue
+            if value >= 0:
+                attributes[tmp[0]] = value
+        pmin = attributes.get("pmin")
+        pmax = attributes.get("pmax")
+        if pmin is not None and pmax is not None and pmax <= pmin:
+            pmax = None
+        if pmax == 0:
+            pmax = None
+        return pmin, pmax, attributes.get("st")
+
+    @staticmethod
+    def _numeric_value(resource):
+        """
+        Get the numeric value of the representation of a resource, used to check the step attribute.
+
+        :param resource: the resource
+        :return: the value or None if the representation is not a number
+        """
+        if resource is None:
+            return None
+        try:
+            return float(resource.payload)
+        except (IndexError, KeyError, TypeError, ValueError):
+            # no representation, or not a number
+            return None
+
     def remove_subscriber(self, message):
         logger.debug("Remove Subcriber")
         host, port = message.destination
         key_token = hash(str(host) + str(port) + str(message.token))
         try:
             self._relations[key_token].transaction.completed = True
-            del self._relations[key_token]
+            self._remove_relation(key_token)
         except KeyError:
             logger.warning("No Subscriber")
 
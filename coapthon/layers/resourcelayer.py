@@ -32,6 +32,9 @@ class ResourceLayer(object):
                     not in transaction.request.if_match:
                 transaction.response.code = defines.Codes.PRECONDITION_FAILED.number
                 return transaction
+        self.read_body(transaction, resource_node)
+        if self.too_large(transaction, resource_node):
+            return transaction
 
         method = getattr(resource_node, "render_POST", None)
         try:
@@ -89,6 +92,7 @@ class ResourceLayer(object):
         :param lp: the location_path attribute of the resource
         :return: the response
         """
+        self.read_body(transaction, parent_resource)
         method = getattr(parent_resource, "render_POST", None)
         try:
             resource = method(request=transaction.request)
@@ -174,6 +178,9 @@ class ResourceLayer(object):
         if transaction.request.if_none_match:
             transaction.response.code = defines.Codes.PRECONDITION_FAILED.number
             return transaction
+        self.read_body(transaction, transaction.resource)
+        if self.too_large(transaction, transaction.resource):
+            return transaction
 
         method = getattr(transaction.resource, "render_PUT", None)
 
@@ -207,6 +214,51 @@ class ResourceLayer(object):
 
         return transaction
 
+    def max_body_size(self, transaction):
+        """
+        Get the largest body accepted by the target of a request.
+
+        :param transaction: the transaction
+        :return: the size in bytes, None if unlimited or if the resource does not exist
+        """
+        path = str("/" + transaction.request.uri_path)
+        try:
+            resource = self._parent.root[path]
+        except KeyError:
+            return None
+        return resource.max_body_size
+
+    @staticmethod
+    def read_body(transaction, resource):
+        """
+        Read into a string a Block1 body spooled to a temporary file, unless the resource reads it as a file.
+
+        :param transaction: the transaction
+        :param resource: the resource rendering the request
+        """
+        payload = transaction.request.payload
+        if hasattr(payload, "read") and not resource.streaming_body:
+            transaction.request.payload = payload.read()
+            payload.close()
+
+    @staticmethod
+    def too_large(transaction, resource):
+        """
+        Refuse with 4.13 Request Entity Too Large a body larger than the resource accepts. A Block1 body is checked
+        by the BlockLayer while it is received.
+
+        :param transaction: the transaction
+        :param resource: the target resource
+        :return: True if the request has been refused
+        """
+        limit = resource.max_body_size
+        payload = transaction.request.payload
+        if limit is None or not isinstance(payload, basestring) or len(payload) <= limit:
+            return False
+        transaction.response.code = defines.Codes.REQUEST_ENTITY_TOO_LARGE.number
+        transaction.response.size1 = limit
+        return True
+
     def _handle_separate(self, transaction, callback):
         # Handle separate
         if not transaction.request.acknowledged:
@@ -1,3 +1,4 @@
+import mmap
 from coapthon.utils import parse_blockwise
 from coapthon import defines
 from coapthon.messages.option import Option
@@ -24,6 +25,36 @@ class Message(object):
         self._timestamp = None
         self._version = 1
 
+    def reset(self):
+        """
+        Bring the message back to the state of a newly created one, so that it can be reused by an ExchangePool.
+        The list of options is emptied in place.
+        """
+        self._type = None
+        self._mid = None
+        self._token = None
+        del self._options[:]
+        self._payload = None
+        self._destination = None
+        self._source = None
+        self._code = None
+        self._acknowledged = None
+        self._rejected = None
+        self._timeouted = None
+        self._cancelled = None
+        self._duplicated = None
+        self._timestamp = None
+        self._version = 1
+
+    def __getstate__(self):
+        """
+        Pickle support, used by shared storages. A payload that is a slice of a larger buffer is copied.
+        """
+        state = self.__dict__.copy()
+        if isinstance(state["_payload"], (buffer, bytearray, mmap.mmap)):
+            state["_payload"] = str(state["_payload"])
+        return state
+
     @property
     def version(self):
         return self._version
@@ -577,6 +608,66 @@ class Message(object):
     def block2(self):
         self.del_option_by_number(defines.OptionRegistry.BLOCK2.number)
 
+    @property
+    def size1(self):
+        """
+        Get the Size1 option, the size of the whole body of a block-wise request.
+
+        :return: the Size1 value or None if not specified
+        """
+        value = None
+        for option in self.options:
+            if option.number == defines.OptionRegistry.SIZE1.number:
+                value = option.value
+        return value
+
+    @size1.setter
+    def size1(self, value):
+        """
+        Set the Size1 option.
+
+        :param value: the size of the body in bytes
+        """
+        option = Option()
+        option.number = defines.OptionRegistry.SIZE1.number
+        option.value = value
+        self.del_option_by_number(defines.OptionRegistry.SIZE1.number)
+        self.add_option(option)
+
+    @size1.deleter
+    def size1(self):
+        self.del_option_by_number(defines.OptionRegistry.SIZE1.number)
+
+    @property
+    def size2(self):
+        """
+        Get the Size2 option, the size of the whole representation of a block-wise response.
+
+        :return: the Size2 value or None if not specified
+        """
+        value = None
+        for option in self.options:
+            if option.number == defines.OptionRegistry.SIZE2.number:
+                value = option.value
+        return value
+
+    @size2.setter
+    def size2(self, value):
+        """
+        Set the Size2 option.
+
+        :param value: the size of the representation in bytes, 0 in a request to ask for it
+        """
+        option = Option()
+        option.number = defines.OptionRegistry.SIZE2.number
+        option.value = value
+        self.del_option_by_number(defines.OptionRegistry.SIZE2.number)
+        self.add_option(option)
+
+    @size2.deleter
+    def size2(self):
+        self.del_option_by_number(defines.OptionRegistry.SIZE2.number)
+
     @property
     def line_print(self):
         inv_types = {v: k for k, v in defines.Types.iteritems()}
@@ -590,10 +681,13 @@ class Message(object):
         for opt in self._options:
             msg += "{name}: {value}, ".format(name=opt.name, value=opt.value)
         msg += "]"
-        if self.payload is not None:
+        if self.payload is None:
+            msg += " No payload"
+        elif hasattr(self.payload, "__getitem__"):
             msg += " {payload}...{length} bytes".format(payload=self.payload[0:20], length=len(self.payload))
         else:
-            msg += " No payload"
+            # a file object or an iterator
+            msg += " Payload read from a stream"
         return msg
 
     def __str__(self):
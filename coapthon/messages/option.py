@@ -7,6 +7,13 @@ class Option(object):
         self._number = None
         self._value = None
 
+    def reset(self):
+        """
+        Bring the option back to the state of a newly created one.
+        """
+        self._number = None
+        self._value = None
+
     @property
     def number(self):
         """
@@ -0,0 +1,169 @@
+import threading
+from coapthon.messages.option import Option
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.transaction import Transaction
+
+__author__ = 'giacomo'
+
+
+class ObjectPool(object):
+    def __init__(self, factory, max_size, reset=None):
+        """
+        Bounded pool of reusable objects.
+
+        :param factory: callable used to create a new object when the pool is empty
+        :param max_size: the maximum number of idle objects kept, released objects beyond it are dropped
+        :param reset: callable used to clean an object when it is released, obj.reset() if None
+        """
+        self._factory = factory
+        self._reset = reset
+        self.max_size = max_size
+        self._free = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        """
+        Get an object from the pool, or a new one if the pool is empty.
+
+        :return: the object
+        """
+        with self._lock:
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.created += 1
+        return self._factory()
+
+    def release(self, obj):
+        """
+        Give an object back to the pool. The caller must not use the object afterwards.
+
+        :param obj: the object
+        """
+        if self._reset is not None:
+            self._reset(obj)
+        else:
+            obj.reset()
+        with self._lock:
+            if len(self._free) < self.max_size:
+                self._free.append(obj)
+
+    def __len__(self):
+        return len(self._free)
+
+
+class ExchangePool(object):
+    def __init__(self, transactions=1024, messages=2048, options=16384, events=256):
+        """
+        Pools of the objects allocated for every exchange: transactions (with their lock), requests, responses,
+        options and the events used to stop retransmissions.
+
+        :param transactions: the size of the transaction pool
+        :param messages: the size of the request pool and of the response pool
+        :param options: the size of the option pool
+        :param events: the size of the event pool
+        """
+        self._transactions = ObjectPool(Transaction, transactions)
+        self._requests = ObjectPool(Request, messages)
+        self._responses = ObjectPool(Response, messages)
+        self._options = ObjectPool(Option, options)
+        self._events = ObjectPool(threading.Event, events, reset=lambda event: event.clear())
+
+    def transaction(self, request=None, timestamp=None):
+        """
+        Get a transaction.
+
+        :type request: Request
+        :param request: the request of the transaction
+        :param timestamp: the timestamp of the transaction
+        :rtype : Transaction
+        """
+        transaction = self._transactions.acquire()
+        transaction.request = request
+        transaction.timestamp = timestamp
+        return transaction
+
+    def request(self):
+        """
+        :rtype : Request
+        """
+        return self._requests.acquire()
+
+    def response(self):
+        """
+        :rtype : Response
+        """
+        return self._responses.acquire()
+
+    def option(self):
+        """
+        :rtype : Option
+        """
+        return self._options.acquire()
+
+    def event(self):
+        """
+        Get a cleared event.
+
+        :rtype : threading.Event
+        """
+        event = self._events.acquire()
+        # a late set() from a thread that still held the previous owner's reference
+        event.clear()
+        return event
+
+    def release_event(self, event):
+        """
+        Give back an event that nobody waits on anymore.
+
+        :type event: threading.Event
+        :param event: the event
+        """
+        self._events.release(event)
+
+    def release_message(self, message):
+        """
+        Give back a request or a response together with its options. Other messages are left to the GC.
+
+        :type message: Message
+        :param message: the message
+        """
+        if isinstance(message, Request):
+            pool = self._requests
+        elif isinstance(message, Response):
+            pool = self._responses
+        else:
+            return
+        for option in message.options:
+            self._options.release(option)
+        pool.release(message)
+
+    def recycle(self, transaction):
+        """
+        Give back a transaction that is not referenced anymore, together with its request and response.
+
+        :type transaction: Transaction
+        :param transaction: the transaction
+        """
+        if transaction.request is None:
+            # already recycled
+            return
+        self.release_message(transaction.request)
+        if transaction.response is not None:
+            self.release_message(transaction.response)
+        self._transactions.release(transaction)
+
+    def stats(self):
+        """
+        Get the number of objects created and reused by every pool.
+
+        :return: a dict name -> (created, reused, idle)
+        """
+        ret = {}
+        for name in ("transactions", "requests", "responses", "options", "events"):
+            pool = getattr(self, "_" + name)
+            ret[name] = (pool.created, pool.reused, len(pool))
+        return ret
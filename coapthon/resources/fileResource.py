@@ -0,0 +1,73 @@
+import hashlib
+import mmap
+import os
+import threading
+from coapthon import defines
+from coapthon.resources.resource import Resource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class FileResource(Resource):
+    def __init__(self, name, file_path, content_type=defines.Content_types["application/octet-stream"],
+                 coap_server=None, visible=True, observable=False, allow_children=False):
+        """
+        A static resource serving a file through a read-only memory mapping. The responses and the Block2 blocks
+        are slices of the mapping, so the file is never read per request and the pages are shared by all the
+        transfers through the page cache. The ETag is derived from the size, the modification time and the inode of
+        the file: the file is mapped again when they change. To update the file, replace it (e.g. with os.rename)
+        rather than rewriting it in place, the transfers in progress keep the old mapping.
+
+        :param name: the name of the resource
+        :param file_path: the path of the file
+        :param content_type: the Content-Format of the file
+        :param visible: if the resource is visible
+        :param observable: if the resource is observable
+        :param allow_children: if the resource could has children
+        """
+        super(FileResource, self).__init__(name, coap_server, visible=visible, observable=observable,
+                                           allow_children=allow_children)
+        self.file_path = file_path
+        self.file_content_type = content_type
+        self._mapping = None
+        self._metadata = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def generate_etag(stat):
+        """
+        Generate an ETag from the metadata of a file.
+
+        :param stat: the result of os.stat on the file
+        :return: the ETag, 8 hexadecimal digits
+        """
+        return hashlib.sha1("{0}-{1}-{2}".format(stat.st_size, stat.st_mtime, stat.st_ino)).hexdigest()[:8]
+
+    def load(self):
+        """
+        Map the file, again only if its metadata changed since the last call.
+
+        :return: the mapping, an empty string for an empty file
+        """
+        stat = os.stat(self.file_path)
+        metadata = (stat.st_size, stat.st_mtime, stat.st_ino)
+        with self._lock:
+            if metadata != self._metadata:
+                if stat.st_size == 0:
+                    # an empty file cannot be mapped
+                    mapping = ""
+                else:
+                    with open(self.file_path, "rb") as f:
+                        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mapping = mapping
+                self._metadata = metadata
+                self.etag = self.generate_etag(stat)
+                self.maximum_size_estimated = stat.st_size
+            return self._mapping
+
+    def render_GET(self, request):
+        mapping = self.load()
+        self._payload = {self.file_content_type: mapping}
+        if self.actual_content_type is None:
+            self.actual_content_type = self.file_content_type
+        return self
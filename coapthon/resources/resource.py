@@ -43,6 +43,10 @@ class Resource(object):
 
         self._max_age = None
 
+        self._max_body_size = None
+
+        self._streaming_body = False
+
         self._coap_server = coap_server
 
         self._deleted = False
@@ -129,6 +133,44 @@ class Resource(object):
         """
         self._max_age = ma
 
+    @property
+    def max_body_size(self):
+        """
+        Get the largest request body accepted by the resource.
+
+        :return: the size in bytes, None if unlimited
+        """
+        return self._max_body_size
+
+    @max_body_size.setter
+    def max_body_size(self, size):
+        """
+        Set the largest request body accepted by the resource. Larger PUT and POST requests are refused with 4.13
+        Request Entity Too Large, a Block1 transfer on its first block if the client announces the size in Size1.
+
+        :param size: the size in bytes, None if unlimited
+        """
+        self._max_body_size = size
+
+    @property
+    def streaming_body(self):
+        """
+        Check if the resource reads large request bodies as files.
+
+        :return: True if a Block1 body spooled to a temporary file is handed to the resource as the file
+        """
+        return self._streaming_body
+
+    @streaming_body.setter
+    def streaming_body(self, b):
+        """
+        Set if the resource reads large request bodies as files. Otherwise a Block1 body spooled to a temporary file
+        is read back into a string before render_PUT or render_POST is called.
+
+        :param b: True to receive spooled bodies as files, the resource then owns and closes them
+        """
+        self._streaming_body = b
+
     @property
     def payload(self):
         """
@@ -383,7 +425,11 @@ class Resource(object):
 
     def render_GET(self, request):
         """
-        Method to be redefined to render a GET request on the resource.
+        Method to be redefined to render a GET request on the resource. Besides a string, the payload can be a
+        buffer, a file object or an iterator of strings: these are read one block at a time and are not closed. An
+        iterator is consumed by the transfer, so a new one must be set for every request. A callable returning the
+        file object or the iterator can be set once instead: it is called for every transfer, which closes what it
+        returns.
 
         :param request: the request
         :return: the response
@@ -394,7 +440,8 @@ class Resource(object):
         """
         Method to be redefined to render a PUTT request on the resource.
 
-        :param request: the request
+        :param request: the request, a block-wise body larger than defines.BLOCKWISE_SPOOL_SIZE is received as a
+            temporary file in request.payload if streaming_body is set
         :return: the response
         """
         raise NotImplementedError
@@ -403,7 +450,8 @@ class Resource(object):
         """
         Method to be redefined to render a POST request on the resource.
 
-        :param request: the request
+        :param request: the request, a block-wise body larger than defines.BLOCKWISE_SPOOL_SIZE is received as a
+            temporary file in request.payload if streaming_body is set
         :return: the response
         """
         raise NotImplementedError
@@ -1,3 +1,4 @@
+import mmap
 import struct
 import ctypes
 from coapthon.messages.request import Request
@@ -5,18 +6,21 @@ from coapthon.messages.response import Response
 from coapthon.messages.option import Option
 from coapthon import defines
 from coapthon.messages.message import Message
+from coapthon.utils import byte_len
 
 
 class Serializer(object):
 
     @staticmethod
-    def deserialize(datagram, source):
+    def deserialize(datagram, source, pool=None):
         """
         De-serialize a stream of byte to a message.
 
         :type datagram: String
         :param datagram:
         :param source:
+        :type pool: ExchangePool
+        :param pool: if not None, requests, responses and options are taken from the pool
         """
         try:
             fmt = "!BBH"
@@ -34,10 +38,10 @@ class Serializer(object):
             message_type = (first & 0x30) >> 4
             token_length = (first & 0x0F)
             if Serializer.is_response(code):
-                message = Response()
+                message = Response() if pool is None else pool.response()
                 message.code = code
             elif Serializer.is_request(code):
-                message = Request()
+                message = Request() if pool is None else pool.request()
                 message.code = code
             else:
                 message = Message()
@@ -88,7 +92,7 @@ class Serializer(object):
                             value += str(b)
 
                     pos += option_length
-                    option = Option()
+                    option = Option() if pool is None else pool.option()
                     option.number = current_option
                     option.value = Serializer.convert_to_raw(current_option, value, option_length)
 
@@ -129,13 +133,54 @@ class Serializer(object):
         values = [tmp, message.code, message.mid]
 
         if message.token is not None and tkl > 0:
-
-            for b in str(message.token):
-                fmt += "c"
-                values.append(b)
+            fmt += str(tkl) + "s"
+            values.append(str(message.token))
 
         options = Serializer.as_sorted_list(message.options)  # already sorted
-        lastoptionnumber = 0
+        options_fmt, options_values, lastoptionnumber = Serializer._pack_options(options, 0)
+        fmt += options_fmt
+        values.extend(options_values)
+
+        payload = message.payload
+        if isinstance(payload, (bytearray, mmap.mmap)):
+            payload = buffer(payload)
+        if isinstance(payload, buffer) and len(payload) > 0:
+            # slice of a larger representation, copied once, straight into the datagram
+            fmt += "B"
+            values.append(defines.PAYLOAD_MARKER)
+        else:
+            fmt += Serializer._pack_payload(payload, values)
+            payload = None
+
+        datagram = None
+        if values[1] is None:
+            values[1] = 0
+        try:
+            s = struct.Struct(fmt)
+            if payload is not None:
+                datagram = ctypes.create_string_buffer(s.size + len(payload))
+                datagram[s.size:] = payload
+            else:
+                datagram = ctypes.create_string_buffer(s.size)
+            s.pack_into(datagram, 0, *values)
+        except struct.error as e:
+            print values
+            print e.args
+            print e.message
+
+        return datagram
+
+    @staticmethod
+    def _pack_options(options, lastoptionnumber):
+        """
+        Get the struct format and the values that encode a list of sorted options.
+
+        :param options: the sorted options
+        :param lastoptionnumber: the number of the option that precedes the list, 0 if none
+        :return: the format, the values and the number of the last option encoded
+        """
+        fmt = ""
+        values = []
         for option in options:
 
             # write 4-bit option delta
@@ -186,34 +231,75 @@ class Serializer(object):
 
             # update last option number
             lastoptionnumber = option.number
+        return fmt, values, lastoptionnumber
 
-        payload = message.payload
+    @staticmethod
+    def _pack_payload(payload, values):
+        """
+        Append the payload marker and the payload to values.
 
+        :param payload: the payload
+        :param values: the values to be packed
+        :return: the struct format of the appended values
+        """
         if payload is not None and len(payload) > 0:
             # if payload is present and of non-zero length, it is prefixed by
             # an one-byte Payload Marker (0xFF) which indicates the end of
             # options and the start of the payload
-
-            fmt += "B"
+            payload = str(payload)
             values.append(defines.PAYLOAD_MARKER)
+            values.append(payload)
+            return "B" + str(len(payload)) + "s"
+        return ""
 
-            for b in str(payload):
-                fmt += "c"
-                values.append(b)
+    @staticmethod
+    def notification_template(message):
+        """
+        Encode the parts of a notification that are the same for every observer: the options but Observe and the
+        payload. The result is used by serialize_notification.
 
-        datagram = None
-        if values[1] is None:
-            values[1] = 0
-        try:
-            s = struct.Struct(fmt)
-            datagram = ctypes.create_string_buffer(s.size)
-            s.pack_into(datagram, 0, *values)
-        except struct.error as e:
-            print values
-            print e.args
-            print e.message
+        :type message: Message
+        :param message: the notification rendered for one of the observers
+        :return: the options before Observe, the number of the last of them, the options after Observe and the
+            payload
+        """
+        observe_number = defines.OptionRegistry.OBSERVE.number
+        options = Serializer.as_sorted_list(message.options)
+        before = [option for option in options if option.number < observe_number]
+        after = [option for option in options if option.number > observe_number]
+        fmt, values, last = Serializer._pack_options(before, 0)
+        prefix = struct.pack("!" + fmt, *values)
+        fmt, values, _ = Serializer._pack_options(after, observe_number)
+        fmt += Serializer._pack_payload(message.payload, values)
+        suffix = struct.pack("!" + fmt, *values)
+        return prefix, last, suffix
 
-        return datagram
+    @staticmethod
+    def serialize_notification(message, template):
+        """
+        Serialize a notification stamping the header, the token and the Observe option of the message on an
+        encoded template.
+
+        :type message: Message
+        :param message: the notification, its options and payload must be the ones used to build the template
+        :param template: the template returned by notification_template
+        :rtype : String
+        """
+        prefix, last, suffix = template
+        token = message.token
+        if token is None or token == "":
+            token = ""
+        else:
+            token = str(token)
+        first = (defines.VERSION << 2 | message.type) << 4 | len(token)
+        header = struct.pack("!BBH" + str(len(token)) + "s", first, message.code, message.mid, token)
+        value = message.observe
+        length = byte_len(value)
+        observe = struct.pack("!B", (defines.OptionRegistry.OBSERVE.number - last) << 4 | length)
+        if length > 0:
+            words = Serializer.int_to_words(value, length, 8)
+            observe += struct.pack("!" + str(length) + "B", *words)
+        return header + prefix + observe + suffix
 
     @staticmethod
     def is_request(code):
@@ -1,3 +1,5 @@
+import Queue
+import collections
 import logging
 import logging.config
 import os
@@ -5,6 +7,7 @@ import random
 import socket
 import struct
 import threading
+import time
 
 from coapthon.messages.message import Message
 from coapthon import defines
@@ -23,7 +26,9 @@ logger = logging.getLogger(__name__)
 
 
 class CoAP(object):
-    def __init__(self, server_address, multicast=False, starting_mid=None):
+    def __init__(self, server_address, multicast=False, starting_mid=None, storage=None, pool=None,
+                 notification_workers=1, max_observers_per_resource=None, max_observers_per_client=None,
+                 observer_eviction="oldest", observe_snapshot=None, block_policy=None):
 
         """
         Initialize the server.
@@ -31,6 +36,22 @@ class CoAP(object):
         :param server_address: Server address for incoming connections
         :param multicast: if the ip is a multicast address
         :param starting_mid: used for testing purposes
+        :param storage: the Storage holding the state of the layers, shared by several worker processes
+            when a shared backend such as MmapStorage is used
+        :type pool: ExchangePool
+        :param pool: if not None, transactions, messages, options and events are recycled through the pool
+        :param notification_workers: the number of threads that notify the observers of the resources changed by
+            the requests, so that requests are answered without waiting for the notifications. With 0 the
+            observers are notified before the request is answered
+        :param max_observers_per_resource: the maximum number of observers of a resource, None for no limit
+        :param max_observers_per_client: the maximum number of observe relations of a client, None for no limit
+        :param observer_eviction: "oldest" to drop the least recently seen relation when a limit is reached,
+            "reject" to serve new observe requests without registering them
+        :param observe_snapshot: the file where the observe relations are saved periodically and on close, and
+            restored from when the server starts listening. None to disable
+        :type block_policy: BlockSizePolicy
+        :param block_policy: chooses the block size used with each client from the losses and round trip times
+            measured, None to always use defines.MAX_PAYLOAD
         """
         self.stopped = threading.Event()
         self.stopped.clear()
@@ -38,12 +59,33 @@ class CoAP(object):
         self.purge = threading.Thread(target=self.purge)
         self.purge.start()
 
-        self._messageLayer = MessageLayer(starting_mid)
-        self._blockLayer = BlockLayer()
-        self._observeLayer = ObserveLayer()
+        self._pool = pool
+        self._observe_snapshot = observe_snapshot
+        self._messageLayer = MessageLayer(starting_mid, storage, pool)
+        self._blockLayer = BlockLayer(storage, policy=block_policy)
+        self._observeLayer = ObserveLayer(storage, max_observers_per_resource, max_observers_per_client,
+                                          observer_eviction)
         self._requestLayer = RequestLayer(self)
         self.resourceLayer = ResourceLayer(self)
 
+        self._notification_wakeup = threading.Event()
+        self.to_be_stopped.append(self._notification_wakeup)
+        self._scheduler = threading.Thread(target=self.schedule_notifications)
+        self._scheduler.start()
+
+        # path -> resource, changes of the same resource waiting in the queue are coalesced
+        self._pending_notifications = {}
+        # paths being notified by a worker, their next change is queued when the worker is done so that the
+        # observers get the notifications in order
+        self._notifying = set()
+        self._pending_notifications_lock = threading.Lock()
+        self._notification_queue = Queue.Queue()
+        self._notification_workers = []
+        for _ in range(notification_workers):
+            worker = threading.Thread(target=self.notification_worker)
+            worker.start()
+            self._notification_workers.append(worker)
+
         # Resource directory
         root = Resource('root', self, visible=False, observable=False, allow_children=False)
         root.path = '/'
@@ -90,12 +132,88 @@ class CoAP(object):
 
     def purge(self):
         """
-        Clean old transactions
+        Clean old transactions and observe relations, and check that the observers are alive.
 
         """
         while not self.stopped.isSet():
             self.stopped.wait(timeout=defines.EXCHANGE_LIFETIME)
             self._messageLayer.purge()
+            self._blockLayer.purge()
+            observers = self._observeLayer.purge()
+            if observers and not self.stopped.isSet():
+                self._send_notifications(observers)
+            if not self.stopped.isSet():
+                self.save_observe_snapshot()
+
+    def save_observe_snapshot(self):
+        """
+        Save the observe relations to the observe_snapshot file, if any.
+
+        """
+        if self._observe_snapshot is None:
+            return
+        try:
+            saved = self._observeLayer.snapshot(self._observe_snapshot)
+            logger.debug("Saved %d observe relations", saved)
+        except (IOError, OSError):
+            logger.exception("Cannot save the observe relations")
+
+    def schedule_notifications(self):
+        """
+        Send the notifications delayed by pmin and the ones forced by pmax.
+
+        """
+        while not self.stopped.isSet():
+            timeout = self._observeLayer.next_due()
+            if timeout is None:
+                timeout = defines.MAX_LATENCY
+            self._notification_wakeup.wait(timeout=timeout)
+            self._notification_wakeup.clear()
+            if self.stopped.isSet():
+                break
+            observers = self._observeLayer.due()
+            if observers:
+                self._send_notifications(observers)
+
+    def _enqueue_notification(self, resource):
+        """
+        Schedule the notification of the observers of a resource on the notification workers.
+
+        :param resource: the changed resource
+        """
+        if not self._notification_workers:
+            self.notify(resource)
+            return
+        with self._pending_notifications_lock:
+            queued = resource.path in self._pending_notifications or resource.path in self._notifying
+            self._pending_notifications[resource.path] = resource
+        if not queued:
+            self._notification_queue.put(resource.path)
+
+    def notification_worker(self):
+        """
+        Notify the observers of the resources queued by _enqueue_notification.
+
+        """
+        while True:
+            path = self._notification_queue.get()
+            if path is None or self.stopped.isSet():
+                break
+            with self._pending_notifications_lock:
+                resource = self._pending_notifications.pop(path, None)
+                if resource is not None:
+                    self._notifying.add(path)
+            if resource is None:
+                continue
+            try:
+                self.notify(resource)
+            except Exception:
+                logger.exception("Notification of %s failed", path)
+            with self._pending_notifications_lock:
+                self._notifying.discard(path)
+                changed = path in self._pending_notifications
+            if changed:
+                self._notification_queue.put(path)
 
     def listen(self, timeout=10):
         """
@@ -103,6 +221,12 @@ class CoAP(object):
 
         :param timeout: Socket Timeout in seconds
         """
+        if self._observe_snapshot is not None:
+            try:
+                restored = self._observeLayer.restore(self._observe_snapshot, self.root)
+                logger.info("Restored %d observe relations", restored)
+            except (ValueError, KeyError, TypeError):
+                logger.exception("Cannot restore the observe relations")
         self._socket.settimeout(float(timeout))
         while not self.stopped.isSet():
             try:
@@ -113,7 +237,7 @@ class CoAP(object):
                 continue
             try:
                 serializer = Serializer()
-                message = serializer.deserialize(data, client_address)
+                message = serializer.deserialize(data, client_address, self._pool)
                 if isinstance(message, int):
                     logger.error("receive_datagram - BAD REQUEST")
 
@@ -127,16 +251,34 @@ class CoAP(object):
                     continue
 
                 logger.debug("receive_datagram - " + str(message))
-                if isinstance(message, Request):
+                if isinstance(message, Request) and message.type == defines.Types["NON"] \
+                        and message.block1 is None and message.block2 is None and message.observe is None:
+                    transaction = self._messageLayer.receive_non_request(message)
+                    if transaction is None:
+                        logger.debug("NON message duplicated")
+                        self._release_message(message)
+                        continue
+                    args = (transaction, )
+                    t = threading.Thread(target=self.receive_non_request, args=args)
+                    t.start()
+                elif isinstance(message, Request):
                     transaction = self._messageLayer.receive_request(message)
+                    if message.type == defines.Types["CON"]:
+                        # a duplicate means that the request or its answer has been lost
+                        self._blockLayer.record(client_address, 1 if transaction.request.duplicated else 0,
+                                                delivered=not transaction.request.duplicated)
                     if transaction.request.duplicated and transaction.completed:
                         logger.debug("message duplicated, transaction completed")
-                        if transaction.response is not None:
+                        if transaction.encoded_response is not None:
+                            self._socket.sendto(transaction.encoded_response, transaction.request.source)
+                        elif transaction.response is not None:
                             self.send_datagram(transaction.response)
+                        self._release_message(message)
                         continue
                     elif transaction.request.duplicated and not transaction.completed:
                         logger.debug("message duplicated, transaction NOT completed")
                         self._send_ack(transaction)
+                        self._release_message(message)
                         continue
                     args = (transaction, )
                     t = threading.Thread(target=self.receive_request, args=args)
@@ -151,9 +293,13 @@ class CoAP(object):
                         with transaction:
                             self._blockLayer.receive_empty(message, transaction)
                             self._observeLayer.receive_empty(message, transaction)
+                            self._release_response(transaction)
 
             except RuntimeError:
                 print "Exception with Executor"
+            except ValueError:
+                # e.g. a state too large for the slots of a shared storage, or a full storage
+                logger.exception("Cannot handle the message from %s", client_address)
         self._socket.close()
 
     def close(self):
@@ -162,9 +308,12 @@ class CoAP(object):
 
         """
         logger.info("Stop server")
+        self.save_observe_snapshot()
         self.stopped.set()
         for event in self.to_be_stopped:
             event.set()
+        for _ in self._notification_workers:
+            self._notification_queue.put(None)
         self._socket.close()
 
     def receive_request(self, transaction):
@@ -179,12 +328,15 @@ class CoAP(object):
 
             transaction.separate_timer = self._start_separate_timer(transaction)
 
-            self._blockLayer.receive_request(transaction)
+            limit = None
+            if transaction.request.block1 is not None and transaction.request.block1[0] == 0:
+                limit = self.resourceLayer.max_body_size(transaction)
+            self._blockLayer.receive_request(transaction, limit)
 
             if transaction.block_transfer:
                 self._stop_separate_timer(transaction.separate_timer)
                 self._messageLayer.send_response(transaction)
-                self.send_datagram(transaction.response)
+                self._send_response(transaction)
                 return
 
             self._observeLayer.receive_request(transaction)
@@ -192,13 +344,16 @@ class CoAP(object):
             self._requestLayer.receive_request(transaction)
 
             if transaction.resource is not None and transaction.resource.changed:
-                self.notify(transaction.resource)
+                self._enqueue_notification(transaction.resource)
                 transaction.resource.changed = False
             elif transaction.resource is not None and transaction.resource.deleted:
-                self.notify(transaction.resource)
+                self._enqueue_notification(transaction.resource)
                 transaction.resource.deleted = False
 
             self._observeLayer.send_response(transaction)
+            if transaction.request.observe == 0:
+                # a new relation may have a pmax
+                self._notification_wakeup.set()
 
             self._blockLayer.send_response(transaction)
 
@@ -209,21 +364,96 @@ class CoAP(object):
             if transaction.response is not None:
                 if transaction.response.type == defines.Types["CON"]:
                     self._start_retransmission(transaction, transaction.response)
-                self.send_datagram(transaction.response)
+                self._send_response(transaction)
+
+    def receive_non_request(self, transaction):
+        """
+        Handle a NON request without Block and Observe options. No separate timer is started and the block and
+        observe layers are skipped unless the response must be split in blocks.
+
+        :type transaction: Transaction
+        :param transaction: the transaction returned by MessageLayer.receive_non_request
+        """
+        self._requestLayer.receive_request(transaction)
+
+        if transaction.resource is not None and transaction.resource.changed:
+            self._enqueue_notification(transaction.resource)
+            transaction.resource.changed = False
+        elif transaction.resource is not None and transaction.resource.deleted:
+            self._enqueue_notification(transaction.resource)
+            transaction.resource.deleted = False
+
+        if transaction.response is None:
+            return
+
+        payload = transaction.response.payload
+        if payload is not None and (BlockLayer.is_stream(payload)
+                                    or len(payload) > self._blockLayer.block_size(transaction.request.source)):
+            self._blockLayer.send_response(transaction)
+
+        self._messageLayer.send_non_response(transaction)
+        self.send_datagram(transaction.response)
+        self._messageLayer.recycle(transaction)
+
+    def _release_message(self, message):
+        """
+        Give back to the pool a received message that is not referenced by any transaction.
+
+        :type message: Message
+        :param message: the message
+        """
+        if self._pool is not None:
+            self._pool.release_message(message)
 
     def send_datagram(self, message):
         """
 
         :type message: Message
         :param message:
+        :return: the serialized message
         """
         if not self.stopped.isSet():
             host, port = message.destination
             logger.debug("send_datagram - " + str(message))
             serializer = Serializer()
-            message = serializer.serialize(message)
+            datagram = serializer.serialize(message)
+
+            self._socket.sendto(datagram, (host, port))
+            return datagram
+
+    def _send_response(self, transaction):
+        """
+        Send the response of a transaction and keep its encoded form, so that duplicated requests can be answered
+        without serializing the response again. The transaction is stored again with its encoded form before the
+        response is sent, so that the other workers sharing the storage see it. The response is sent even if the
+        storage refuses the transaction.
+
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the response
+        """
+        if self.stopped.isSet():
+            return
+        response = transaction.response
+        logger.debug("send_datagram - " + str(response))
+        transaction.encoded_response = Serializer.serialize(response).raw
+        self._release_response(transaction)
+        self._messageLayer.update(transaction)
+        self._socket.sendto(transaction.encoded_response, response.destination)
+
+    @staticmethod
+    def _release_response(transaction):
+        """
+        Drop the Response object of a transaction once only its encoded form is needed, i.e. the response does not
+        wait for an ACK and the transaction does not hold an observe relation.
 
-            self._socket.sendto(message, (host, port))
+        :type transaction: Transaction
+        :param transaction: the transaction
+        """
+        response = transaction.response
+        if response is None or transaction.encoded_response is None or transaction.request.observe is not None:
+            return
+        if response.type != defines.Types["CON"] or response.acknowledged or response.rejected:
+            transaction.response = None
 
     def add_resource(self, path, resource):
         """
@@ -267,7 +497,10 @@ class CoAP(object):
                 future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
                 transaction.retransmit_thread = threading.Thread(target=self._retransmit,
                                                                  args=(transaction, message, future_time, 0))
-                transaction.retransmit_stop = threading.Event()
+                if self._pool is not None:
+                    transaction.retransmit_stop = self._pool.event()
+                else:
+                    transaction.retransmit_stop = threading.Event()
                 self.to_be_stopped.append(transaction.retransmit_stop)
                 transaction.retransmit_thread.start()
 
@@ -280,6 +513,7 @@ class CoAP(object):
         :param future_time: the amount of time to wait before a new attempt
         :param retransmit_count: the number of retransmissions
         """
+        sent = time.time()
         with transaction:
             while retransmit_count < defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected) \
                     and not self.stopped.isSet():
@@ -291,9 +525,14 @@ class CoAP(object):
 
             if message.acknowledged or message.rejected:
                 message.timeouted = False
+                # the round trip time of a retransmitted message is ambiguous
+                rtt = time.time() - sent if retransmit_count == 0 else None
+                self._blockLayer.record(message.destination, retransmit_count, rtt)
             else:
                 logger.warning("Give up on message {message}".format(message=message.line_print))
                 message.timeouted = True
+                if not self.stopped.isSet():
+                    self._blockLayer.record(message.destination, retransmit_count + 1, delivered=False)
                 if message.observe is not None:
                     self._observeLayer.remove_subscriber(message)
 
@@ -301,7 +540,10 @@ class CoAP(object):
                 self.to_be_stopped.remove(transaction.retransmit_stop)
             except ValueError:
                 pass
+            event = transaction.retransmit_stop
             transaction.retransmit_stop = None
+            if self._pool is not None:
+                self._pool.release_event(event)
             transaction.retransmit_thread = None
 
     def _start_separate_timer(self, transaction):
@@ -347,15 +589,95 @@ class CoAP(object):
         """
         observers = self._observeLayer.notify(resource)
         logger.debug("Notify")
+        # the observers with a pmin may have been postponed
+        self._notification_wakeup.set()
+        self._send_notifications(observers)
+
+    def _send_notifications(self, observers):
+        """
+        Send a notification to each observer.
+
+        Observers that sent the same request (path, query, Accept and block size) share one rendering of the
+        resource: the options and the payload are encoded once and only the header, the token and the Observe
+        option are encoded for each of them. Large representations are shared as well, the notification carries
+        the first block only.
+
+        :param observers: the transactions returned by the observe layer
+        """
+        groups = collections.OrderedDict()
         for transaction in observers:
-            with transaction:
-                transaction.response = None
-                transaction = self._requestLayer.receive_request(transaction)
-                transaction = self._observeLayer.send_response(transaction)
-                transaction = self._blockLayer.send_response(transaction)
-                transaction = self._messageLayer.send_response(transaction)
-                if transaction.response is not None:
-                    if transaction.response.type == defines.Types["CON"]:
-                        self._start_retransmission(transaction, transaction.response)
-
-                    self.send_datagram(transaction.response)
+            request = transaction.request
+            block_size = request.block2 or self._blockLayer.block_size(request.source)
+            groups.setdefault((request.uri_path, request.uri_query, request.accept, block_size),
+                              []).append(transaction)
+        for group in groups.values():
+            rendered = None
+            for transaction in group:
+                with transaction:
+                    if rendered is not None:
+                        self._notify_from_template(transaction, *rendered)
+                        continue
+                    transaction.response = None
+                    transaction = self._requestLayer.receive_request(transaction)
+                    transaction = self._observeLayer.send_response(transaction)
+                    transaction = self._blockLayer.send_response(transaction)
+                    transaction = self._messageLayer.send_response(transaction)
+                    if transaction.response is not None:
+                        if transaction.response.type == defines.Types["CON"]:
+                            self._start_retransmission(transaction, transaction.response)
+
+                        self._send_response(transaction)
+                        rendered = self._notification_template(transaction)
+
+    @staticmethod
+    def _notification_template(transaction):
+        """
+        Get what the other observers of the same request can reuse from a notification, if it can be shared.
+
+        :type transaction: Transaction
+        :param transaction: the transaction of the notification sent through the whole pipeline
+        :return: the resource, the response and the encoded template, or None
+        """
+        response = transaction.response
+        if response is None or response.code != defines.Codes.CONTENT.number or response.observe is None \
+                or (response.block2 is not None and response.block2[0] != 0) \
+                or (response.payload is not None and len(response.payload) > defines.MAX_PAYLOAD):
+            return None
+        return transaction.resource, response, Serializer.notification_template(response)
+
+    def _notify_from_template(self, transaction, resource, rendered, template):
+        """
+        Notify an observer reusing the rendering done for another observer of the same request.
+
+        :type transaction: Transaction
+        :param transaction: the transaction of the observer
+        :param resource: the rendered resource
+        :type rendered: Response
+        :param rendered: the notification sent to the other observer
+        :param template: the encoded template of the notification
+        """
+        response = Response()
+        response.destination = transaction.request.source
+        response.token = transaction.request.token
+        response.code = rendered.code
+        response.payload = rendered.payload
+        for option in rendered.options:
+            if option.number != defines.OptionRegistry.OBSERVE.number:
+                response.add_option(option)
+        transaction.response = response
+        transaction.resource = resource
+        transaction = self._observeLayer.send_response(transaction)
+        transaction = self._blockLayer.send_response(transaction)
+        transaction = self._messageLayer.send_response(transaction)
+        if transaction.response is None:
+            return
+        if transaction.response.type == defines.Types["CON"]:
+            self._start_retransmission(transaction, transaction.response)
+        if transaction.response.observe is None or transaction.response.block2 is not None:
+            # the relation has been dropped or the observer is in a block-wise transfer
+            self._send_response(transaction)
+        elif not self.stopped.isSet():
+            logger.debug("send_datagram - " + str(transaction.response))
+            transaction.encoded_response = Serializer.serialize_notification(transaction.response, template)
+            self._messageLayer.update(transaction)
+            self._socket.sendto(transaction.encoded_response, transaction.response.destination)
@@ -0,0 +1,241 @@
+import cPickle as pickle
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from coapthon import defines
+from coapthon.storage.storage import Storage
+
+__author__ = 'giacomo'
+
+logger = logging.getLogger(__name__)
+
+
+class MmapStorage(Storage):
+    """
+    Storage backed by memory-mapped files. Every process that opens a MmapStorage on the same path shares the
+    same tables, so several workers on one host see the same duplicates, block transfers and observe relations.
+
+    Keys are the hash() values computed by the layers, which are stable across processes as long as hash
+    randomization is not enabled. Values are pickled, so the objects read from a table are copies of the ones
+    written by other processes.
+    """
+    def __init__(self, path, slots=16384, slot_size=None):
+        """
+        Initialize the storage.
+
+        :param path: the path prefix of the files, one file per table is created
+        :param slots: the number of entries of every table
+        :param slot_size: the size in bytes of every entry, None to fit a transaction whose request and response
+            carry defines.MAX_PAYLOAD bytes each, together with the encoded response
+        """
+        if slot_size is None:
+            slot_size = 5 * defines.MAX_PAYLOAD
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+
+    def table(self, name):
+        """
+        Open the table with the given name, creating it if needed.
+
+        :param name: the name of the table
+        :rtype : MmapTable
+        """
+        return MmapTable(self.path + "." + name, self.slots, self.slot_size)
+
+
+class MmapTable(object):
+    """
+    Open addressing hash table stored in a memory-mapped file. Concurrent access from threads and processes is
+    serialized with a lock and flock on the file.
+    """
+    HEADER = struct.Struct("!8sIIQ")
+    SLOT = struct.Struct("!BqQI")
+    MAGIC = "COAPTBL1"
+    EMPTY = 0
+    USED = 1
+    DELETED = 2
+
+    def __init__(self, path, slots, slot_size):
+        """
+        Open a table, creating the file if needed. An existing file keeps its own number and size of slots.
+
+        :param path: the file path
+        :param slots: the number of entries
+        :param slot_size: the size in bytes of every entry
+        """
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock = threading.RLock()
+        # values read or written by this process, with the version they had in the table
+        self._local = {}
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size == 0:
+                size = self.HEADER.size + slots * slot_size
+                os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, slots, slot_size, 0)
+            else:
+                self._map = mmap.mmap(self._fd, size)
+                magic, slots, slot_size, _ = self.HEADER.unpack_from(self._map, 0)
+                if magic != self.MAGIC:
+                    raise ValueError(path + " is not a storage table")
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._slots = slots
+        self._slot_size = slot_size
+
+    @contextmanager
+    def _locked(self, operation=fcntl.LOCK_EX):
+        with self._lock:
+            fcntl.flock(self._fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, index):
+        return self.HEADER.size + index * self._slot_size
+
+    def _find(self, key):
+        """
+        Look for a key with linear probing.
+
+        :param key: the key
+        :return: the index of the slot holding the key or None, the index of the first free slot or None
+        """
+        start = key % self._slots
+        free = None
+        for i in xrange(self._slots):
+            index = (start + i) % self._slots
+            state, slot_key, _, _ = self.SLOT.unpack_from(self._map, self._offset(index))
+            if state == self.EMPTY:
+                if free is None:
+                    free = index
+                return None, free
+            elif state == self.DELETED:
+                if free is None:
+                    free = index
+            elif slot_key == key:
+                return index, free
+        return None, free
+
+    def _next_version(self):
+        magic, slots, slot_size, version = self.HEADER.unpack_from(self._map, 0)
+        version += 1
+        self.HEADER.pack_into(self._map, 0, magic, slots, slot_size, version)
+        return version
+
+    def _state(self, index):
+        return self.SLOT.unpack_from(self._map, self._offset(index))[0]
+
+    def _delete_slot(self, index):
+        if self._state((index + 1) % self._slots) == self.EMPTY:
+            # end of a probing chain, the slot and the tombstones before it can become empty
+            self.SLOT.pack_into(self._map, self._offset(index), self.EMPTY, 0, 0, 0)
+            for _ in xrange(self._slots - 1):
+                index = (index - 1) % self._slots
+                if self._state(index) != self.DELETED:
+                    break
+                self.SLOT.pack_into(self._map, self._offset(index), self.EMPTY, 0, 0, 0)
+        else:
+            _, key, version, _ = self.SLOT.unpack_from(self._map, self._offset(index))
+            self.SLOT.pack_into(self._map, self._offset(index), self.DELETED, key, version, 0)
+
+    def __getitem__(self, key):
+        with self._locked(fcntl.LOCK_SH):
+            index, _ = self._find(key)
+            if index is None:
+                self._local.pop(key, None)
+                raise KeyError(key)
+            offset = self._offset(index)
+            _, _, version, length = self.SLOT.unpack_from(self._map, offset)
+            cached = self._local.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            start = offset + self.SLOT.size
+            value = pickle.loads(self._map[start:start + length])
+            self._local[key] = (version, value)
+            return value
+
+    def __setitem__(self, key, value):
+        """
+        Store a value.
+
+        :param key: the key
+        :param value: the value, it must be picklable
+        :raise ValueError: if the pickled value is larger than a slot or the table is full
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self._slot_size - self.SLOT.size:
+            raise ValueError("Entry of " + str(len(data)) + " bytes does not fit a slot of " +
+                             str(self._slot_size) + " bytes")
+        with self._locked():
+            index, free = self._find(key)
+            if index is None:
+                index = free
+            if index is None:
+                raise ValueError("Storage table is full")
+            version = self._next_version()
+            start = self._offset(index) + self.SLOT.size
+            self._map[start:start + len(data)] = data
+            self.SLOT.pack_into(self._map, self._offset(index), self.USED, key, version, len(data))
+            self._local[key] = (version, value)
+
+    def __delitem__(self, key):
+        """
+        Remove a key. A key already removed, e.g. by another process, is ignored.
+
+        :param key: the key
+        """
+        with self._locked():
+            self._local.pop(key, None)
+            index, _ = self._find(key)
+            if index is not None:
+                self._delete_slot(index)
+
+    def __contains__(self, key):
+        with self._locked(fcntl.LOCK_SH):
+            index, _ = self._find(key)
+            return index is not None
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        Get all the keys of the table. Values cached by this process for keys no longer in the table are dropped.
+
+        :rtype : list
+        """
+        ret = []
+        with self._locked(fcntl.LOCK_SH):
+            for index in xrange(self._slots):
+                state, key, _, _ = self.SLOT.unpack_from(self._map, self._offset(index))
+                if state == self.USED:
+                    ret.append(key)
+            present = set(ret)
+            for key in self._local.keys():
+                if key not in present:
+                    del self._local[key]
+        return ret
+
+    def close(self):
+        """
+        Unmap the table and close the file.
+
+        """
+        with self._lock:
+            self._map.close()
+            os.close(self._fd)
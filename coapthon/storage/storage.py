@@ -0,0 +1,31 @@
+__author__ = 'giacomo'
+
+
+class Storage(object):
+    """
+    Factory of the tables used by the layers to keep their state (transactions, block transfers, observe
+    relations). A table behaves like a dict with integer keys: it supports get, set, delete, membership test,
+    keys() and len().
+    """
+    def table(self, name):
+        """
+        Get the table with the given name.
+
+        :param name: the name of the table
+        :return: the table
+        """
+        raise NotImplementedError
+
+
+class MemoryStorage(Storage):
+    """
+    In-process storage, tables are plain dicts.
+    """
+    def table(self, name):
+        """
+        Get a new in-process table.
+
+        :param name: the name of the table
+        :rtype : dict
+        """
+        return {}
@@ -2,7 +2,7 @@ import threading
 
 
 class Transaction(object):
-    def __init__(self, request=None, response=None, resource=None, timestamp=None):
+    def __init__(self, request=None, response=None, resource=None, timestamp=None, lock=True):
         self._response = response
         self._request = request
         self._resource = resource
@@ -13,16 +13,58 @@ class Transaction(object):
         self.separate_timer = None
         self.retransmit_thread = None
         self.retransmit_stop = None
-        self._lock = threading.RLock()
+        self.encoded_response = None
+        if lock:
+            self._lock = threading.RLock()
+        else:
+            self._lock = None
+
+        self.cacheHit = False
+        self.cached_element = None
 
+    def reset(self):
+        """
+        Bring the transaction back to the state of a newly created one, so that it can be reused by an ExchangePool.
+        The lock is kept.
+        """
+        self._response = None
+        self._request = None
+        self._resource = None
+        self._timestamp = None
+        self._completed = False
+        self._block_transfer = False
+        self.notification = False
+        self.separate_timer = None
+        self.retransmit_thread = None
+        self.retransmit_stop = None
+        self.encoded_response = None
         self.cacheHit = False
         self.cached_element = None
 
+    def __getstate__(self):
+        """
+        Pickle support, used by shared storages. Locks, timers, threads and the resource are not pickled.
+        """
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_resource"] = None
+        state["separate_timer"] = None
+        state["retransmit_thread"] = None
+        state["retransmit_stop"] = None
+        state["cached_element"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
     def __enter__(self):
-        self._lock.acquire()
+        if self._lock is not None:
+            self._lock.acquire()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._lock.release()
+        if self._lock is not None:
+            self._lock.release()
 
     @property
     def response(self):
@@ -1,5 +1,7 @@
 import random
 import string
+import threading
+import time
 
 __author__ = 'giacomo'
 
@@ -120,9 +122,63 @@ def parse_uri(uri):
     return str(host), port, path
 
 
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        """
+        Token bucket used to pace outgoing traffic.
+
+        :param rate: the number of tokens (bytes) added to the bucket every second
+        :param capacity: the maximum burst, one second worth of tokens by default
+        """
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = max(self.rate, 1)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take tokens from the bucket. The bucket is allowed to go in debt, the debt is paid back by waiting.
+
+        :param amount: the number of tokens to take
+        :return: the number of seconds to wait before sending
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            wait = 0
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+            self._tokens -= amount
+            return wait
+
+
+class TreeNode(object):
+    def __init__(self):
+        """
+        Node of the path trie of a Tree, one node per path segment.
+        """
+        self.children = {}
+        self.keys = set()
+
+
 class Tree(object):
     def __init__(self):
         self.tree = {}
+        self._root = TreeNode()
+
+    @staticmethod
+    def _segments(path):
+        """
+        Split a path in segments, a trailing slash is ignored.
+
+        :param path: the path
+        :return: the list of segments
+        """
+        return path.rstrip("/").split("/")
 
     def dump(self):
         """
@@ -133,30 +189,67 @@ class Tree(object):
         return self.tree.keys()
 
     def with_prefix(self, path):
+        """
+        Get the paths that are a prefix of path (path included), e.g. "/", "/test" and "/test_post" for
+        "/test_post". The trie is walked segment by segment, so the cost depends on the length of path and not on
+        the number of paths in the tree.
+
+        :param path: the path
+        :return: the list of paths, from the shortest
+        :raise KeyError: if there is none
+        """
         ret = []
-        for key in self.tree.keys():
-            if path.startswith(key):
-                ret.append(key)
+        node = self._root
+        for segment in self._segments(path):
+            # paths whose last segment is a prefix of this segment
+            for i in range(1, len(segment)):
+                partial = node.children.get(segment[:i])
+                if partial is not None:
+                    ret.extend(partial.keys)
+            node = node.children.get(segment)
+            if node is None:
+                break
+            ret.extend(node.keys)
 
         if len(ret) > 0:
             return ret
         raise KeyError
 
     def with_prefix_resource(self, path):
-        ret = []
-        for key, value in self.tree.iteritems():
-            if path.startswith(key):
-                ret.append(value)
+        """
+        Get the resources whose path is a prefix of path (path included).
 
-        if len(ret) > 0:
-            return ret
-        raise KeyError
+        :param path: the path
+        :return: the list of resources, from the shortest path
+        :raise KeyError: if there is none
+        """
+        return [self.tree[key] for key in self.with_prefix(path)]
 
     def __getitem__(self, item):
         return self.tree[item]
 
     def __setitem__(self, key, value):
+        if key not in self.tree:
+            node = self._root
+            for segment in self._segments(key):
+                child = node.children.get(segment)
+                if child is None:
+                    child = TreeNode()
+                    node.children[segment] = child
+                node = child
+            node.keys.add(key)
         self.tree[key] = value
 
     def __delitem__(self, key):
         del self.tree[key]
+        nodes = [self._root]
+        for segment in self._segments(key):
+            nodes.append(nodes[-1].children[segment])
+        nodes[-1].keys.discard(key)
+        # prune the nodes left without paths
+        segments = self._segments(key)
+        for i in range(len(segments), 0, -1):
+            node = nodes[i]
+            if node.keys or node.children:
+                break
+            del nodes[i - 1].children[segments[i - 1]]
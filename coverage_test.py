@@ -1,21 +1,102 @@
 from Queue import Queue
+import multiprocessing
+import os
 import random
 import socket
+import tempfile
 import threading
+import time
 import unittest
 from coapclient import HelperClient
 from coapserver import CoAPServer
 from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer, BlockSizePolicy
+from coapthon.layers.messagelayer import MessageLayer
+from coapthon.client.observemanager import ObserveManager, Observation
+from coapthon.layers.observelayer import ObserveLayer
+from coapthon.layers.resourcelayer import ResourceLayer
 from coapthon.messages.message import Message
 from coapthon.messages.option import Option
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.pool import ExchangePool
+from coapthon.resources.fileResource import FileResource
+from coapthon.resources.resource import Resource
 from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from coapthon.storage.mmapstorage import MmapStorage
+from coapthon.transaction import Transaction
+from coapthon.utils import TokenBucket, Tree
+from exampleresources import BasicResource
 
 __author__ = 'Giacomo Tanganelli'
 __version__ = "2.0"
 
 
+def shared_request(mid, type_name):
+    request = Request()
+    request.code = defines.Codes.GET.number
+    request.type = defines.Types[type_name]
+    request.mid = mid
+    request.token = "tk" + str(mid)
+    request.uri_path = "/basic"
+    request.source = ("127.0.0.1", 5700)
+    return request
+
+
+def receive_shared(path, results):
+    # another worker opening the same storage
+    layer = MessageLayer(None, MmapStorage(path))
+    results.put(layer.receive_request(shared_request(1, "CON")).request.duplicated)
+    results.put(layer.receive_non_request(shared_request(2, "NON")) is None)
+    results.put(layer.receive_non_request(shared_request(3, "NON")) is None)
+
+
+def observe(layer, resource, token, query="", host="127.0.0.1", port=5700):
+    # register an observer and answer its request, as the server does
+    request = Request()
+    request.source = (host, port)
+    request.type = defines.Types["NON"]
+    request.mid = random.randint(1, 65535)
+    request.code = defines.Codes.GET.number
+    request.token = token
+    request.uri_path = resource.path[1:]
+    if query:
+        request.uri_query = query
+    request.observe = 0
+    transaction = Transaction(request=request, resource=resource)
+    layer.receive_request(transaction)
+    transaction.response = Response()
+    transaction.response.code = defines.Codes.CONTENT.number
+    layer.send_response(transaction)
+    return transaction
+
+
+def observe_indexes(layer):
+    # the path and client indexes rebuilt from the relations
+    paths = {}
+    clients = {}
+    for key in layer._relations.keys():
+        item = layer._relations[key]
+        paths.setdefault(hash(layer._relation_path(item)), set()).add(key)
+        clients.setdefault(hash(layer._relation_host(item)), set()).add(key)
+    return paths, clients
+
+
+def put_block(layer, token, num, m, payload, size1=None, limit=None):
+    # a 64 bytes block of a Block1 PUT received by the layer
+    request = Request()
+    request.source = ("127.0.0.1", 5700)
+    request.code = defines.Codes.PUT.number
+    request.token = token
+    request.uri_path = "firmware"
+    if size1 is not None:
+        request.size1 = size1
+    request.block1 = (num, m, 64)
+    request.payload = payload[num * 64:(num + 1) * 64]
+    return layer.receive_request(Transaction(request=request), limit)
+
+
 class Tests(unittest.TestCase):
 
     def setUp(self):
@@ -551,6 +632,7 @@ class Tests(unittest.TestCase):
         expected.token = None
         expected.payload = None
         expected.block2 = (0, 1, 512)
+        expected.size2 = 2041
 
         exchange1 = (req, expected)
         self.current_mid += 1
@@ -1481,6 +1563,1109 @@ class Tests(unittest.TestCase):
 
         self._test_with_client_observe([exchange1, exchange2])
 
+    def test_non_duplicate(self):
+        print "TEST_NON_DUPLICATE"
+        path = "/basic"
+
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = path
+        req.type = defines.Types["NON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.Types["NON"]
+        expected._mid = None
+        expected.code = defines.Codes.CONTENT.number
+        expected.token = None
+        expected.payload = "Basic Resource"
+
+        exchange1 = (req, expected)
+        # duplicated NON requests are silently ignored
+        exchange2 = (req, None)
+        self.current_mid += 1
+
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = path
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.Types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.Codes.CONTENT.number
+        expected.token = None
+        expected.payload = "Basic Resource"
+
+        exchange3 = (req, expected)
+        self.current_mid += 1
+
+        self._test_plugtest([exchange1, exchange2, exchange3])
+
+    def test_duplicate_encoded_response(self):
+        print "TEST_DUPLICATE_ENCODED_RESPONSE"
+        directory = tempfile.mkdtemp()
+        server = CoAP(("127.0.0.1", 5684), storage=MmapStorage(os.path.join(directory, "coap")))
+        server.add_resource("basic/", BasicResource())
+        server_thread = threading.Thread(target=server.listen, args=(10,))
+        server_thread.start()
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.token = "dup"
+        datagram = Serializer().serialize(req)
+        serialize = Serializer.serialize
+        serialized = []
+
+        def counting(message):
+            serialized.append(message)
+            return serialize(message)
+        Serializer.serialize = staticmethod(counting)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        try:
+            sock.sendto(datagram, ("127.0.0.1", 5684))
+            first, _ = sock.recvfrom(4096)
+            self.assertEqual(len(serialized), 1)
+            # another worker sees the encoded response
+            table = MmapStorage(os.path.join(directory, "coap")).table("transactions")
+            self.assertEqual([table[key].encoded_response for key in table.keys()], [first])
+            table.close()
+            # the retransmission is answered without serializing the response again
+            sock.sendto(datagram, ("127.0.0.1", 5684))
+            second, _ = sock.recvfrom(4096)
+            self.assertEqual(second, first)
+            self.assertEqual(len(serialized), 1)
+        finally:
+            Serializer.serialize = staticmethod(serialize)
+            sock.close()
+            server.close()
+            server_thread.join(timeout=25)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_mmap_storage_refused(self):
+        print "TEST_MMAP_STORAGE_REFUSED"
+        directory = tempfile.mkdtemp()
+        # the slots are too small for a transaction
+        server = CoAP(("127.0.0.1", 5684), storage=MmapStorage(os.path.join(directory, "coap"), slot_size=64))
+        server.add_resource("basic/", BasicResource())
+        server_thread = threading.Thread(target=server.listen, args=(10,))
+        server_thread.start()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        try:
+            for token in ("ref1", "ref2"):
+                req = Request()
+                req.code = defines.Codes.GET.number
+                req.uri_path = "/basic"
+                req.type = defines.Types["CON"]
+                req._mid = self.current_mid
+                req.token = token
+                self.current_mid += 1
+                sock.sendto(Serializer().serialize(req), ("127.0.0.1", 5684))
+                datagram, _ = sock.recvfrom(4096)
+                response = Serializer().deserialize(datagram, ("127.0.0.1", 5684))
+                self.assertEqual(response.code, defines.Codes.CONTENT.number)
+                self.assertEqual(response.token, token)
+        finally:
+            sock.close()
+            server.close()
+            server_thread.join(timeout=25)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_pool(self):
+        print "TEST_POOL"
+        pool = ExchangePool(transactions=1, messages=1, options=4, events=1)
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.token = "tok"
+        datagram = Serializer().serialize(req)
+
+        message = Serializer().deserialize(datagram, ("127.0.0.1", 5684), pool)
+        transaction = pool.transaction(request=message, timestamp=0)
+        self.assertEqual(message.uri_path, "basic")
+        pool.recycle(transaction)
+        # a second recycle of the same transaction is ignored
+        pool.recycle(transaction)
+        self.assertIsNone(transaction.request)
+
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.type = defines.Types["NON"]
+        req._mid = self.current_mid
+        datagram = Serializer().serialize(req)
+        reused = Serializer().deserialize(datagram, ("127.0.0.1", 5684), pool)
+        self.assertIs(reused, message)
+        self.assertEqual(reused.uri_path, "")
+        self.assertEqual(reused.type, defines.Types["NON"])
+        self.assertEqual(len(reused.options), 0)
+        self.assertIs(pool.transaction(request=reused, timestamp=1), transaction)
+        self.assertEqual(pool.stats()["requests"], (1, 1, 0))
+
+    def test_notification_template(self):
+        print "TEST_NOTIFICATION_TEMPLATE"
+        response = Response()
+        response.type = defines.Types["CON"]
+        response._mid = self.server_mid
+        response.code = defines.Codes.CONTENT.number
+        response.token = "ab"
+        response.etag = "e1"
+        response.max_age = 30
+        response.content_type = defines.Content_types["application/json"]
+        response.payload = "Observable Resource"
+        response.observe = 1
+        template = Serializer.notification_template(response)
+        for observe in (0, 300, 70000):
+            response.observe = observe
+            datagram = Serializer.serialize_notification(response, template)
+            self.assertEqual(datagram, Serializer.serialize(response).raw)
+
+    def test_conditional_attributes(self):
+        print "TEST_CONDITIONAL_ATTRIBUTES"
+        self.assertEqual(ObserveLayer._conditional_attributes(""), (None, None, None))
+        self.assertEqual(ObserveLayer._conditional_attributes("pmin=1&pmax=60&st=0.5"), (1, 60, 0.5))
+        # pmax not greater than pmin and malformed values are ignored
+        self.assertEqual(ObserveLayer._conditional_attributes("pmin=10&pmax=5&st=x&rt=a"), (10, None, None))
+
+    def test_tree(self):
+        print "TEST_TREE"
+        tree = Tree()
+        for path in ("/", "/test", "/test/a", "/test/a/b", "/other"):
+            tree[path] = path
+        self.assertEqual(sorted(tree.with_prefix("/test_post")), ["/", "/test"])
+        self.assertEqual(sorted(tree.with_prefix("/test/a/c")), ["/", "/test", "/test/a"])
+        self.assertEqual(tree.with_prefix_resource("/test/a/b"), ["/", "/test", "/test/a", "/test/a/b"])
+        del tree["/test/a/b"]
+        self.assertEqual(tree.with_prefix("/test/a/b"), ["/", "/test", "/test/a"])
+        # the node left without paths is pruned
+        self.assertEqual(tree._root.children[""].children["test"].children["a"].children, {})
+        self.assertRaises(KeyError, tree.with_prefix, "missing")
+
+    def test_mmap_storage_oversized(self):
+        print "TEST_MMAP_STORAGE_OVERSIZED"
+        directory = tempfile.mkdtemp()
+        table = MmapStorage(os.path.join(directory, "coap"), slots=4, slot_size=256).table("transactions")
+        table[1] = "small"
+        self.assertRaises(ValueError, table.__setitem__, 1, "x" * 1000)
+        self.assertEqual(table[1], "small")
+        self.assertRaises(ValueError, table.__setitem__, 2, "x" * 1000)
+        self.assertNotIn(2, table)
+        # a key removed by another process
+        del table[2]
+        for key in (2, 3, 4):
+            table[key] = "small"
+        self.assertRaises(ValueError, table.__setitem__, 5, "small")
+        self.assertEqual(sorted(table.keys()), [1, 2, 3, 4])
+        table.close()
+        os.remove(os.path.join(directory, "coap.transactions"))
+        os.rmdir(directory)
+
+    def test_mmap_storage_shared(self):
+        print "TEST_MMAP_STORAGE_SHARED"
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "coap")
+        layer = MessageLayer(None, MmapStorage(path))
+        self.assertFalse(layer.receive_request(shared_request(1, "CON")).request.duplicated)
+        self.assertIsNotNone(layer.receive_non_request(shared_request(2, "NON")))
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=receive_shared, args=(path, results))
+        worker.start()
+        worker.join()
+        # the duplicates received by the other worker are detected
+        self.assertEqual([results.get(timeout=1) for _ in range(3)], [True, True, False])
+        # and the request it received first is a duplicate here
+        self.assertIsNone(layer.receive_non_request(shared_request(3, "NON")))
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_observe_manager(self):
+        print "TEST_OBSERVE_MANAGER"
+        observation = Observation("basic", None)
+        self.assertTrue(observation.is_fresh(5, 0))
+        observation.sequence = 5
+        observation.timestamp = 0
+        self.assertTrue(observation.is_fresh(6, 1))
+        self.assertFalse(observation.is_fresh(4, 1))
+        self.assertTrue(observation.is_fresh(4, 129))
+        observation.sequence = 2 ** 24 - 1
+        self.assertTrue(observation.is_fresh(0, 1))
+
+        manager = ObserveManager(self.server_address)
+        basic = manager.observe("basic", self.queue.put)
+        storage = manager.observe("storage", self.queue.put)
+        received = [self.queue.get(timeout=5), self.queue.get(timeout=5)]
+        self.assertEqual(sorted(r.token for r in received), sorted([basic, storage]))
+        manager.cancel(storage)
+        client = HelperClient(self.server_address)
+        client.put("storage", "storage")
+        client.put("basic", "basic")
+        notification = self.queue.get(timeout=5)
+        self.assertEqual(notification.token, basic)
+        self.assertEqual(notification.payload, "basic")
+        client.stop()
+        manager.stop()
+
+    def test_observe_snapshot(self):
+        print "TEST_OBSERVE_SNAPSHOT"
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.type = defines.Types["CON"]
+        request.mid = self.current_mid
+        request.code = defines.Codes.GET.number
+        request.token = "snap"
+        request.uri_path = "basic"
+        request.uri_query = "pmax=30"
+        request.observe = 0
+        resource = Resource("basic", observable=True)
+        resource.path = "/basic"
+        resource.observe_count = 5
+        layer = ObserveLayer()
+        transaction = Transaction(request=request, resource=resource)
+        layer.receive_request(transaction)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        self.assertEqual(layer.snapshot(filename), 1)
+
+        # the server restarted, the resource is a new object
+        resource = Resource("basic", observable=True)
+        resource.path = "/basic"
+        tree = Tree()
+        tree["/basic"] = resource
+        layer = ObserveLayer()
+        self.assertEqual(layer.restore(filename, tree), 1)
+        os.remove(filename)
+        self.assertEqual(resource.observe_count, 6)
+        observers = layer.notify(resource)
+        self.assertEqual(len(observers), 1)
+        self.assertEqual(observers[0].request.token, "snap")
+        self.assertEqual(observers[0].request.source, ("127.0.0.1", 5700))
+        self.assertIsNotNone(layer.next_due())
+
+    def test_observe_conditional(self):
+        print "TEST_OBSERVE_CONDITIONAL"
+        resource = Resource("value", observable=True)
+        resource.path = "/value"
+        resource.payload = "10"
+        layer = ObserveLayer()
+        now = time.time()
+
+        # changes within pmin are coalesced in a single notification
+        transaction = observe(layer, resource, "pmin", "pmin=10")
+        self.assertEqual(layer.notify(resource), [])
+        self.assertEqual(layer.notify(resource), [])
+        self.assertEqual(layer.due(now + 5), [])
+        self.assertAlmostEqual(layer.next_due(now), 10, delta=1)
+        self.assertEqual(layer.due(now + 11), [transaction])
+        self.assertEqual(layer.due(now + 12), [])
+        self.assertIsNone(layer.next_due(now + 12))
+        layer.send_response(transaction)
+
+        # without changes a notification is forced at pmax
+        transaction = observe(layer, resource, "pmax", "pmax=5")
+        self.assertAlmostEqual(layer.next_due(now), 5, delta=1)
+        self.assertEqual(layer.due(now + 1), [])
+        self.assertEqual(layer.due(now + 6), [transaction])
+        layer.send_response(transaction)
+        self.assertAlmostEqual(layer.next_due(now), 5, delta=1)
+
+        # changes smaller than st are not notified
+        transaction = observe(layer, resource, "st", "st=1")
+        resource.payload = "10.5"
+        self.assertNotIn(transaction, layer.notify(resource))
+        resource.payload = "11.5"
+        self.assertIn(transaction, layer.notify(resource))
+        layer.send_response(transaction)
+        resource.payload = "12"
+        self.assertNotIn(transaction, layer.notify(resource))
+
+    def test_observe_pmax(self):
+        print "TEST_OBSERVE_PMAX"
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.uri_query = "pmax=1"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.token = "pmax"
+        req.observe = 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        serializer = Serializer()
+        sock.sendto(serializer.serialize(req), self.server_address)
+        response = serializer.deserialize(sock.recvfrom(4096)[0], self.server_address)
+        self.assertEqual(response.code, defines.Codes.CONTENT.number)
+        registered = time.time()
+        # the scheduler sends a notification at pmax although the resource did not change
+        notification = serializer.deserialize(sock.recvfrom(4096)[0], self.server_address)
+        self.assertEqual(notification.token, "pmax")
+        # the representation did not change, the client only refreshes the relation
+        self.assertEqual(notification.observe, response.observe)
+        self.assertGreaterEqual(time.time() - registered, 0.9)
+        ack = Message()
+        ack.type = defines.Types["ACK"]
+        ack.code = defines.Codes.EMPTY.number
+        ack.mid = notification.mid
+        sock.sendto(serializer.serialize(ack), self.server_address)
+        sock.close()
+
+    def test_observe_indexes(self):
+        print "TEST_OBSERVE_INDEXES"
+        layer = ObserveLayer()
+        first = Resource("first", observable=True)
+        first.path = "/first"
+        second = Resource("second", observable=True)
+        second.path = "/second"
+        a = observe(layer, first, "a", host="10.0.0.1")
+        b = observe(layer, first, "b", host="10.0.0.2")
+        c = observe(layer, second, "c", host="10.0.0.1")
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+        self.assertEqual(len(layer._clients[hash("10.0.0.1")]), 2)
+        # only the observers of the changed resource are notified
+        self.assertEqual(set(layer.notify(first)), set([a, b]))
+        self.assertEqual(layer.notify(second), [c])
+
+        # deregistration
+        request = Request()
+        request.source = a.request.source
+        request.token = a.request.token
+        request.uri_path = "first"
+        request.observe = 1
+        layer.receive_request(Transaction(request=request))
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+        self.assertEqual(layer.notify(first), [b])
+
+        # RST to a notification
+        rst = Message()
+        rst.type = defines.Types["RST"]
+        layer.receive_empty(rst, b)
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+        self.assertEqual(layer.notify(first), [])
+        self.assertNotIn(hash("10.0.0.2"), layer._clients)
+
+        # the client does not answer the liveness check
+        now = time.time() + c.response.max_age
+        self.assertEqual(layer.purge(now), [c])
+        self.assertEqual(layer.purge(now + defines.EXCHANGE_LIFETIME + 1), [])
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+        self.assertEqual(layer._index, {})
+        self.assertEqual(layer._clients, {})
+        self.assertEqual(layer.notify(second), [])
+
+    def test_observe_limits(self):
+        print "TEST_OBSERVE_LIMITS"
+        first = Resource("first", observable=True)
+        first.path = "/first"
+        second = Resource("second", observable=True)
+        second.path = "/second"
+
+        # the relation not seen for the longest time is evicted at the limit of the resource
+        layer = ObserveLayer(max_per_resource=2)
+        a = observe(layer, first, "a", host="10.0.0.1")
+        b = observe(layer, first, "b", host="10.0.0.2")
+        ack = Message()
+        ack.type = defines.Types["ACK"]
+        time.sleep(0.01)
+        # the client of a answers a notification, b becomes the oldest
+        layer.receive_empty(ack, a)
+        c = observe(layer, first, "c", host="10.0.0.3")
+        self.assertEqual(set(layer.notify(first)), set([a, c]))
+        self.assertTrue(b.completed)
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+
+        # the limit of a client counts the relations on all the resources
+        layer = ObserveLayer(max_per_client=2)
+        a = observe(layer, first, "a")
+        b = observe(layer, second, "b")
+        c = observe(layer, second, "c")
+        self.assertEqual(layer.notify(first), [])
+        self.assertEqual(set(layer.notify(second)), set([b, c]))
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+
+        # with "reject" the new observer is served without being registered
+        layer = ObserveLayer(max_per_resource=1, eviction="reject")
+        a = observe(layer, first, "a", host="10.0.0.1")
+        b = observe(layer, first, "b", host="10.0.0.2")
+        self.assertEqual(layer.notify(first), [a])
+        self.assertIsNone(b.response.observe)
+
+        # a relation whose client does not answer the liveness check is removed
+        layer = ObserveLayer()
+        a = observe(layer, first, "a", host="10.0.0.1")
+        b = observe(layer, first, "b", host="10.0.0.2")
+        now = time.time() + a.response.max_age
+        self.assertEqual(set(layer.purge(now)), set([a, b]))
+        self.assertEqual(a.response.type, None)
+        # the CON notification of the check is acknowledged by the client of b only
+        layer.send_response(a)
+        layer.send_response(b)
+        self.assertEqual(a.response.type, defines.Types["CON"])
+        layer.receive_empty(ack, b)
+        # later the relation of a expires, b is checked again
+        self.assertEqual(layer.purge(now + defines.EXCHANGE_LIFETIME + 1), [b])
+        self.assertTrue(a.completed)
+        self.assertEqual(layer.notify(first), [b])
+        self.assertEqual(observe_indexes(layer), (layer._index, layer._clients))
+
+    def test_notification_workers(self):
+        print "TEST_NOTIFICATION_WORKERS"
+        server = CoAP(("127.0.0.1", 5685), notification_workers=3)
+        resources = []
+        for name in ("first", "second", "third"):
+            resource = Resource(name, observable=True)
+            resource.path = "/" + name
+            resources.append(resource)
+        notified = []
+        notifying = []
+        overlaps = []
+        lock = threading.Lock()
+
+        def notify(resource):
+            with lock:
+                if resource.path in notifying:
+                    overlaps.append(resource.path)
+                notifying.append(resource.path)
+            value = int(resource.payload)
+            time.sleep(random.uniform(0, 0.005))
+            with lock:
+                notified.append((resource.path, value))
+                notifying.remove(resource.path)
+        server.notify = notify
+        try:
+            for i in range(50):
+                for resource in resources:
+                    resource.payload = str(i)
+                    server._enqueue_notification(resource)
+                time.sleep(0.001)
+            for _ in range(100):
+                if not server._pending_notifications and not notifying:
+                    break
+                time.sleep(0.05)
+        finally:
+            server.close()
+        # every resource is notified by one worker at a time, so each observer gets the changes in order
+        self.assertEqual(overlaps, [])
+        for resource in resources:
+            values = [value for path, value in notified if path == resource.path]
+            self.assertEqual(values, sorted(values))
+            self.assertEqual(values[-1], 49)
+        for worker in server._notification_workers:
+            worker.join(timeout=5)
+            self.assertFalse(worker.is_alive())
+
+    def test_block_notification_shared(self):
+        print "TEST_BLOCK_NOTIFICATION_SHARED"
+        serializer = Serializer()
+        observers = []
+        for token in ("obs1", "obs2"):
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.uri_path = "/big"
+            req.type = defines.Types["NON"]
+            req._mid = self.current_mid
+            req.token = token
+            req.observe = 0
+            req.block2 = (0, 0, 512)
+            self.current_mid += 1
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+            sock.sendto(serializer.serialize(req), self.server_address)
+            response = serializer.deserialize(sock.recvfrom(4096)[0], self.server_address)
+            self.assertEqual(response.block2, (0, 1, 512))
+            observers.append(sock)
+        # the second observer is notified from the template of the first one
+        self.server.notify(self.server.root["/big"])
+        for sock in observers:
+            notification = serializer.deserialize(sock.recvfrom(4096)[0], self.server_address)
+            self.assertIsNotNone(notification.observe)
+            self.assertEqual(notification.block2, (0, 1, 512))
+            self.assertEqual(notification.size2, 2041)
+            self.assertEqual(len(notification.payload), 512)
+            sock.close()
+
+    def test_block_notification(self):
+        print "TEST_BLOCK_NOTIFICATION"
+        layer = BlockLayer()
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "obs"
+        request.uri_path = "big"
+        request.observe = 0
+        payload = "".join(chr(ord("a") + i % 26) for i in range(3000))
+        for _ in range(2):
+            # the next notification starts from block 0 again
+            response = Response()
+            response.code = defines.Codes.CONTENT.number
+            response.observe = 2
+            response.payload = payload
+            transaction = layer.send_response(Transaction(request=request, response=response))
+            self.assertEqual(transaction.response.block2, (0, 1, defines.MAX_PAYLOAD))
+            self.assertEqual(transaction.response.payload, payload[:defines.MAX_PAYLOAD])
+        etag = transaction.response.etag
+        self.assertEqual(len(etag), 1)
+
+        # the other blocks are fetched without Observe and with another token
+        received = str(transaction.response.payload)
+        for num in (1, 2):
+            block = Request()
+            block.source = ("127.0.0.1", 5700)
+            block.code = defines.Codes.GET.number
+            block.token = "block" + str(num)
+            block.uri_path = "big"
+            block.block2 = (num, 0, defines.MAX_PAYLOAD)
+            transaction = layer.receive_request(Transaction(request=block))
+            self.assertTrue(transaction.block_transfer)
+            self.assertEqual(transaction.response.etag, etag)
+            received += str(transaction.response.payload)
+        self.assertEqual(transaction.response.block2, (2, 0, defines.MAX_PAYLOAD))
+        self.assertEqual(received, payload)
+
+    def test_block2_snapshot(self):
+        print "TEST_BLOCK2_SNAPSHOT"
+        layer = BlockLayer()
+        payload = "".join(chr(ord("a") + i % 26) for i in range(2500))
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        response = Response()
+        response.code = defines.Codes.CONTENT.number
+        response.etag = "v1"
+        response.payload = payload
+        transaction = layer.send_response(Transaction(request=request, response=response))
+        self.assertEqual(transaction.response.block2, (0, 1, defines.MAX_PAYLOAD))
+        received = str(transaction.response.payload)
+        for num in (1, 2):
+            request.block2 = (num, 0, defines.MAX_PAYLOAD)
+            # served from the snapshot, no response is rendered
+            transaction = layer.receive_request(Transaction(request=request))
+            self.assertTrue(transaction.block_transfer)
+            self.assertEqual(transaction.response.etag, ["v1"])
+            received += str(transaction.response.payload)
+        self.assertEqual(transaction.response.block2, (2, 0, defines.MAX_PAYLOAD))
+        self.assertEqual(received, payload)
+        self.assertEqual(len(layer._block2_snapshots), 0)
+
+        # abandoned transfer
+        response.payload = payload
+        layer.send_response(Transaction(request=request, response=response))
+        self.assertEqual(len(layer._block2_snapshots), 1)
+        layer.purge(time.time() + defines.EXCHANGE_LIFETIME + 1)
+        self.assertEqual(len(layer._block2_snapshots), 0)
+
+    def test_block1_reassembly(self):
+        print "TEST_BLOCK1_REASSEMBLY"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(300))
+        for size1, spool_size in ((300, None), (None, 1024), (None, 100), (300, 100)):
+            layer = BlockLayer(spool_size=spool_size)
+            for num in range(5):
+                transaction = put_block(layer, "put", num, 1 if num < 4 else 0, payload,
+                                        size1 if num == 0 else None)
+            self.assertFalse(transaction.block_transfer)
+            body = transaction.request.payload
+            if spool_size == 100:
+                # spooled to a temporary file
+                body = body.read()
+            self.assertEqual(body, payload)
+            self.assertEqual(len(layer._block1_receive), 0)
+            self.assertEqual(len(layer._block1_buffers), 0)
+
+    def test_block1_spooled_body(self):
+        print "TEST_BLOCK1_SPOOLED_BODY"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(defines.BLOCKWISE_SPOOL_SIZE + 1000))
+        client = HelperClient(self.server_address)
+        response = client.post("big", payload)
+        self.assertEqual(response.code, defines.Codes.CHANGED.number)
+        # the body has been spooled to a temporary file, the resource still gets a string
+        self.assertEqual(self.server.root["/big"].payload, payload)
+        for _ in range(2):
+            response = client.get("big")
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+            self.assertEqual(response.payload, payload)
+        client.stop()
+
+    def test_block2_stream(self):
+        print "TEST_BLOCK2_STREAM"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(2500))
+
+        def fetch(stream):
+            layer = BlockLayer()
+            request = Request()
+            request.source = ("127.0.0.1", 5700)
+            request.code = defines.Codes.GET.number
+            request.token = "get"
+            request.uri_path = "log"
+            response = Response()
+            response.code = defines.Codes.CONTENT.number
+            response.payload = stream
+            transaction = layer.send_response(Transaction(request=request, response=response))
+            if transaction.response.block2 is None:
+                # fits in a single response
+                return transaction.response.payload
+            self.assertEqual(transaction.response.block2, (0, 1, defines.MAX_PAYLOAD))
+            received = str(transaction.response.payload)
+            for num in (1, 2):
+                request.block2 = (num, 0, defines.MAX_PAYLOAD)
+                transaction = layer.receive_request(Transaction(request=request))
+                self.assertTrue(transaction.block_transfer)
+                received += str(transaction.response.payload)
+            self.assertEqual(transaction.response.block2, (2, 0, defines.MAX_PAYLOAD))
+            self.assertEqual(len(layer._block2_snapshots), 0)
+            return received
+
+        self.assertEqual(fetch(payload[i:i + 100] for i in range(0, len(payload), 100)), payload)
+        self.assertEqual(fetch(iter([payload[:10]])), payload[:10])
+        # a file handed over directly is left open to its owner, it can be served again
+        log = tempfile.TemporaryFile()
+        log.write(payload)
+        for _ in range(2):
+            self.assertEqual(fetch(log), payload)
+            self.assertFalse(log.closed)
+        log.close()
+        # a callable opens a stream for every transfer, which closes it
+        opened = []
+
+        def open_log():
+            f = tempfile.TemporaryFile()
+            f.write(payload)
+            opened.append(f)
+            return f
+
+        for _ in range(2):
+            self.assertEqual(fetch(open_log), payload)
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(all(f.closed for f in opened))
+
+    def test_file_resource(self):
+        print "TEST_FILE_RESOURCE"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(2500))
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "firmware.bin")
+        with open(path, "wb") as f:
+            f.write(payload)
+        resource = FileResource("firmware", path)
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "firmware"
+        resource.render_GET(request)
+        etag = resource.etag
+        self.assertEqual(len(resource.payload), len(payload))
+        self.assertEqual(resource.actual_content_type, defines.Content_types["application/octet-stream"])
+
+        layer = BlockLayer()
+        response = Response()
+        response.code = defines.Codes.CONTENT.number
+        response.etag = etag
+        response.payload = resource.payload
+        transaction = layer.send_response(Transaction(request=request, response=response))
+        received = str(transaction.response.payload)
+        for num in (1, 2):
+            request.block2 = (num, 0, defines.MAX_PAYLOAD)
+            transaction = layer.receive_request(Transaction(request=request))
+            transaction.response.destination = request.source
+            transaction.response.type = defines.Types["ACK"]
+            transaction.response.mid = 1
+            # blocks are serialized straight from the mapping
+            datagram = Serializer().serialize(transaction.response)
+            self.assertTrue(datagram.raw.endswith(str(transaction.response.payload)))
+            received += str(transaction.response.payload)
+        self.assertEqual(received, payload)
+
+        # the file is mapped again only when it is replaced
+        resource.render_GET(request)
+        self.assertEqual(resource.etag, etag)
+        replacement = os.path.join(directory, "firmware.new")
+        with open(replacement, "wb") as f:
+            f.write(payload[:100])
+        os.rename(replacement, path)
+        resource.render_GET(request)
+        self.assertNotEqual(resource.etag, etag)
+        self.assertEqual(resource.payload[:], payload[:100])
+        os.remove(path)
+        os.rmdir(directory)
+
+    def test_get_block_pipelined(self):
+        print "TEST_GET_BLOCK_PIPELINED"
+        expected = self.server.root["/big"].payload
+        for nstart, window in ((1, 4), (4, 4), (4, 16)):
+            client = HelperClient(self.server_address, nstart=nstart, block2_window=window)
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.uri_path = "/big"
+            req.type = defines.Types["CON"]
+            req.destination = self.server_address
+            req.block2 = (0, 0, 64)
+            response = client.send_request(req)
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+            self.assertEqual(response.block2[1], 0)
+            self.assertEqual(response.payload, expected)
+            # the blocks requested past the end are still answered
+            for _ in range(10):
+                if not client.protocol._block2_transfers:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(len(client.protocol._block2_transfers), 0)
+            client.stop()
+
+    def test_get_block_restart(self):
+        print "TEST_GET_BLOCK_RESTART"
+        client = HelperClient(("127.0.0.1", 5699), block2_window=2)
+        protocol = client.protocol
+        old = "".join(chr(ord("a") + i % 26) for i in range(40))
+        new = old.upper()
+
+        def answer(request, etag, num, payload, size2=None):
+            response = Response()
+            response.code = defines.Codes.CONTENT.number
+            response.source = request.destination
+            response.token = request.token
+            response.etag = etag
+            response.block2 = (num, int(num * 16 + 16 < len(payload)), 16)
+            if size2 is not None:
+                response.size2 = size2
+            response.payload = payload[num * 16:num * 16 + 16]
+            return protocol._receive_block2(Transaction(request=request, response=response))
+
+        def outstanding(transfer):
+            return dict((num, request) for request, num in transfer.requests.items())
+
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.type = defines.Types["NON"]
+        req.token = "rs"
+        req.destination = ("127.0.0.1", 5699)
+        self.assertTrue(answer(req, "a", 0, old, len(old)))
+        transfer = protocol._block2_transfers.values()[0]
+        first = outstanding(transfer)
+        self.assertEqual(sorted(first), [1, 2])
+
+        # the representation changes, the transfer restarts from the first block
+        self.assertTrue(answer(first[1], "b", 1, new))
+        restarted = protocol._block2_transfers.values()[0]
+        self.assertIsNot(restarted, transfer)
+        self.assertEqual(restarted.size_hint, len(old))
+        self.assertEqual(restarted.stale, set([first[2]]))
+        second = outstanding(restarted)
+        self.assertEqual(sorted(second), [0, 1])
+
+        # late and duplicate answers are dropped without closing the transfer
+        self.assertTrue(answer(first[2], "a", 2, old))
+        self.assertTrue(answer(second[0], "b", 0, new))
+        self.assertTrue(answer(second[0], "b", 0, new))
+        self.assertFalse(restarted.closed)
+        self.assertIs(protocol._block2_transfers.values()[0], restarted)
+        self.assertTrue(answer(second[1], "b", 1, new))
+        self.assertTrue(answer(outstanding(restarted)[2], "b", 2, new))
+        self.assertEqual(client.queue.get(timeout=1).payload, new)
+        # the block requested past the end is still answered
+        self.assertTrue(answer(outstanding(restarted)[3], "b", 3, new))
+        self.assertEqual(protocol._block2_transfers, {})
+        client.stop()
+
+    def test_nstart(self):
+        print "TEST_NSTART"
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 5698))
+        server.settimeout(0.5)
+        serializer = Serializer()
+        client = HelperClient(("127.0.0.1", 5698), nstart=2)
+        for i in range(5):
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.uri_path = "/basic"
+            req.type = defines.Types["CON"]
+            req.token = "ns" + str(i)
+            req.destination = ("127.0.0.1", 5698)
+            client.protocol.send_message(req)
+
+        seen = set()
+
+        def receive():
+            while True:
+                datagram, source = server.recvfrom(4096)
+                request = serializer.deserialize(datagram, source)
+                if request.token not in seen:
+                    # not a retransmission
+                    seen.add(request.token)
+                    return request
+        received = [receive(), receive()]
+        # the other requests wait for an exchange to complete
+        self.assertRaises(socket.timeout, receive)
+        self.assertEqual(len(client.protocol._outstanding[("127.0.0.1", 5698)]), 2)
+        answered = []
+        while received:
+            request = received.pop(0)
+            response = Response()
+            response.type = defines.Types["ACK"]
+            response.mid = request.mid
+            response.token = request.token
+            response.code = defines.Codes.CONTENT.number
+            response.destination = request.source
+            server.sendto(serializer.serialize(response), request.source)
+            answered.append(request.token)
+            self.assertEqual(client.queue.get(timeout=1).token, request.token)
+            if len(seen) < 5:
+                received.append(receive())
+        self.assertEqual(answered, ["ns0", "ns1", "ns2", "ns3", "ns4"])
+        self.assertEqual(client.protocol._outstanding, {})
+        self.assertEqual(client.protocol._pending, {})
+        client.stop()
+        server.close()
+
+    def test_token_bucket(self):
+        print "TEST_TOKEN_BUCKET"
+        bucket = TokenBucket(100)
+        # a burst of one second worth of tokens is sent at once
+        self.assertEqual(bucket.consume(60), 0)
+        self.assertEqual(bucket.consume(60), 0)
+        # then the debt is paid back by waiting
+        self.assertAlmostEqual(bucket.consume(10), 0.2, delta=0.05)
+        time.sleep(0.3)
+        self.assertEqual(bucket.consume(10), 0)
+
+    def test_post_block_stream(self):
+        print "TEST_POST_BLOCK_STREAM"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(3000))
+        upload = tempfile.TemporaryFile()
+        upload.write(payload)
+        chunks = (payload[i:i + 700] for i in range(0, len(payload), 700))
+        for body, total in ((upload, len(payload)), (chunks, None)):
+            client = HelperClient(self.server_address)
+            progress = []
+            response = client.post("big", body, progress=lambda sent, size: progress.append((sent, size)))
+            self.assertEqual(response.code, defines.Codes.CHANGED.number)
+            self.assertEqual(self.server.root["/big"].payload, payload)
+            self.assertEqual(progress, [(1024, total), (2048, total), (3000, total)])
+            client.stop()
+
+    def test_block_budget(self):
+        print "TEST_BLOCK_BUDGET"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(300))
+
+        layer = BlockLayer(budget=200)
+        transaction = put_block(layer, "big", 0, 1, payload, size1=300)
+        self.assertEqual(transaction.response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(transaction.response.size1, 200)
+        for num in range(3):
+            transaction = put_block(layer, "first", num, 1, payload)
+            self.assertEqual(transaction.response.code, defines.Codes.CONTINUE.number)
+        # the second transfer does not fit in what is left
+        transaction = put_block(layer, "second", 0, 1, payload)
+        self.assertEqual(transaction.response.code, defines.Codes.SERVICE_UNAVAILABLE.number)
+        self.assertEqual(len(layer._block1_buffers), 1)
+        # the first one cannot grow past the budget
+        transaction = put_block(layer, "first", 3, 1, payload)
+        self.assertEqual(transaction.response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(len(layer._block1_buffers), 0)
+        self.assertEqual(layer._bytes_in_use, 0)
+
+        # a Block2 transfer that does not fit is served without a snapshot
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        response = Response()
+        response.code = defines.Codes.CONTENT.number
+        response.payload = payload * 10
+        transaction = layer.send_response(Transaction(request=request, response=response))
+        self.assertEqual(transaction.response.block2, (0, 1, defines.MAX_PAYLOAD))
+        self.assertEqual(len(layer._block2_snapshots), 0)
+
+        # abandoned transfers are purged
+        layer = BlockLayer()
+        put_block(layer, "abandoned", 0, 1, payload)
+        response.payload = payload * 10
+        layer.send_response(Transaction(request=request, response=response))
+        self.assertEqual(layer._bytes_in_use, 64 + 3000)
+        layer.purge(time.time() + defines.EXCHANGE_LIFETIME + 1)
+        self.assertEqual(len(layer._block1_receive), 0)
+        self.assertEqual(len(layer._block1_buffers), 0)
+        self.assertEqual(len(layer._block2_receive), 0)
+        self.assertEqual(len(layer._block2_snapshots), 0)
+        self.assertEqual(layer._bytes_in_use, 0)
+
+        # the memory preallocated from Size1 counts, not only the bytes received
+        layer = BlockLayer(budget=1000)
+        transaction = put_block(layer, "first", 0, 1, payload, size1=600)
+        self.assertEqual(transaction.response.code, defines.Codes.CONTINUE.number)
+        self.assertEqual(layer._bytes_in_use, 600)
+        transaction = put_block(layer, "second", 0, 1, payload, size1=600)
+        self.assertEqual(transaction.response.code, defines.Codes.SERVICE_UNAVAILABLE.number)
+        self.assertEqual(len(layer._block1_buffers), 1)
+        # and so does the growth of the buffer
+        for num in range(3):
+            transaction = put_block(layer, "third", num, 1, payload)
+            self.assertEqual(transaction.response.code, defines.Codes.CONTINUE.number)
+        self.assertEqual(layer._bytes_in_use, 600 + 256)
+        layer.purge(time.time() + defines.EXCHANGE_LIFETIME + 1)
+        self.assertEqual(layer._bytes_in_use, 0)
+
+    def test_block2_pipelined_without_snapshot(self):
+        print "TEST_BLOCK2_PIPELINED_WITHOUT_SNAPSHOT"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(300))
+        # the representation does not fit in the budget, every block is rendered again
+        layer = BlockLayer(budget=100)
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        for num in (0, 2, 1, 4, 3):
+            request.block2 = (num, 0, 64)
+            response = Response()
+            response.code = defines.Codes.CONTENT.number
+            response.payload = payload
+            transaction = layer.receive_request(Transaction(request=request, response=response))
+            transaction = layer.send_response(transaction)
+            self.assertEqual(len(layer._block2_snapshots), 0)
+            self.assertEqual(transaction.response.block2, (num, int(num < 4), 64))
+            self.assertEqual(str(transaction.response.payload), payload[num * 64:(num + 1) * 64])
+
+    def test_block_size_options(self):
+        print "TEST_BLOCK_SIZE_OPTIONS"
+        payload = "".join(chr(ord("a") + i % 26) for i in range(300))
+        layer = BlockLayer()
+
+        # the first block announces the size of the representation, the following ones only if asked
+        request = Request()
+        request.source = ("127.0.0.1", 5700)
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        request.block2 = (0, 0, 64)
+        response = Response()
+        response.code = defines.Codes.CONTENT.number
+        response.payload = payload
+        transaction = layer.receive_request(Transaction(request=request, response=response))
+        transaction = layer.send_response(transaction)
+        self.assertEqual(transaction.response.block2, (0, 1, 64))
+        self.assertEqual(transaction.response.size2, 300)
+        request.block2 = (1, 0, 64)
+        transaction = layer.receive_request(Transaction(request=request))
+        self.assertEqual(transaction.response.block2, (1, 1, 64))
+        self.assertIsNone(transaction.response.size2)
+        request.block2 = (2, 0, 64)
+        request.size2 = 0
+        transaction = layer.receive_request(Transaction(request=request))
+        self.assertEqual(transaction.response.size2, 300)
+
+        # the client preallocates the body from Size2
+        client = BlockLayer()
+        for num in range(5):
+            request = Request()
+            request.destination = ("127.0.0.1", 5700)
+            request.token = "get"
+            response = Response()
+            response.source = ("127.0.0.1", 5700)
+            response.token = "get"
+            response.code = defines.Codes.CONTENT.number
+            response.block2 = (num, 1 if num < 4 else 0, 64)
+            response.payload = payload[num * 64:(num + 1) * 64]
+            if num == 0:
+                response.size2 = 300
+            transaction = client.receive_response(Transaction(request=request, response=response))
+            if num == 0:
+                key_token = hash("127.0.0.1" + "5700" + "get")
+                self.assertEqual(len(client._block2_sent[key_token].payload._buffer), 300)
+        self.assertEqual(transaction.response.payload, payload)
+        self.assertEqual(len(client._block2_sent), 0)
+
+        # a body larger than the resource accepts is refused on the first block
+        transaction = put_block(layer, "announced", 0, 1, payload, size1=300, limit=100)
+        self.assertEqual(transaction.response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(transaction.response.size1, 100)
+        self.assertEqual(len(layer._block1_buffers), 0)
+        transaction = put_block(layer, "unknown", 0, 1, payload, limit=100)
+        self.assertEqual(transaction.response.code, defines.Codes.CONTINUE.number)
+        transaction = put_block(layer, "unknown", 1, 1, payload, limit=100)
+        self.assertEqual(transaction.response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(len(layer._block1_buffers), 0)
+        # and so is a request without Block1
+        resource = Resource("firmware")
+        resource.max_body_size = 100
+        request = Request()
+        request.payload = payload
+        transaction = Transaction(request=request, response=Response())
+        self.assertTrue(ResourceLayer.too_large(transaction, resource))
+        self.assertEqual(transaction.response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(transaction.response.size1, 100)
+        request.payload = payload[:100]
+        self.assertFalse(ResourceLayer.too_large(Transaction(request=request, response=Response()), resource))
+
+    def test_block_size_policy(self):
+        print "TEST_BLOCK_SIZE_POLICY"
+        peer = ("127.0.0.1", 5700)
+        policy = BlockSizePolicy(min_size=64)
+        self.assertEqual(policy.size(peer), defines.MAX_PAYLOAD)
+        # one transmission out of two lost
+        for _ in range(4):
+            policy.record(peer, 1)
+        self.assertEqual(policy.size(peer), 512)
+        for _ in range(40):
+            policy.record(peer, 1)
+        self.assertEqual(policy.size(peer), 64)
+        # a clean link with a stable round trip time
+        for _ in range(60):
+            policy.record(peer, 0, rtt=0.1)
+        self.assertEqual(policy.size(peer), defines.MAX_PAYLOAD)
+        size, loss, srtt = policy.stats()[peer]
+        self.assertLess(loss, 0.02)
+        self.assertAlmostEqual(srtt, 0.1)
+        # the round trip time grows past twice the smallest one: the blocks are not grown
+        other = ("127.0.0.1", 5701)
+        for _ in range(4):
+            policy.record(other, 1)
+        policy.record(other, 0, rtt=0.1)
+        for _ in range(20):
+            policy.record(other, 0, rtt=0.5)
+        size = policy.size(other)
+        for _ in range(40):
+            policy.record(other, 0, rtt=0.5)
+        self.assertEqual(policy.size(other), size)
+        self.assertLess(size, defines.MAX_PAYLOAD)
+        policy.purge(time.time() + defines.EXCHANGE_LIFETIME + 1)
+        self.assertEqual(policy.stats(), {})
+
+        # the server splits the responses with the size chosen for the client
+        for _ in range(4):
+            policy.record(peer, 1)
+        layer = BlockLayer(policy=policy)
+        request = Request()
+        request.source = peer
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        response = Response()
+        response.code = defines.Codes.CONTENT.number
+        response.payload = "a" * 700
+        transaction = layer.send_response(Transaction(request=request, response=response))
+        self.assertEqual(transaction.response.block2, (0, 1, 512))
+        # and the client asks for them
+        request = Request()
+        request.destination = peer
+        request.code = defines.Codes.GET.number
+        request.token = "get"
+        request.uri_path = "big"
+        self.assertEqual(layer.send_request(request).block2, (0, 0, 512))
+
+
 if __name__ == '__main__':
     unittest.main()
 
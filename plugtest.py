@@ -566,6 +566,7 @@ class Tests(unittest.TestCase):
         expected.token = None
         expected.payload = None
         expected.block2 = (0, 1, 1024)
+        expected.size2 = 2002
 
         exchange1 = (req, expected)
         self.current_mid += 1
@@ -702,6 +703,7 @@ I say, looked for all the world like a strip of that same patchwork quilt. Indee
         expected.token = None
         expected.payload = None
         expected.block2 = (0, 1, 1024)
+        expected.size2 = 2002
 
         exchange1 = (req, expected)
         self.current_mid += 1
@@ -4,7 +4,8 @@ setup(
     name='CoAPy',
     version='4.0.2',
     packages=['coapthon', 'coapthon.layers', 'coapthon.client', 'coapthon.server', 'coapthon.messages',
-              'coapthon.forward_proxy', 'coapthon.resources', 'coapthon.reverse_proxy'],
+              'coapthon.forward_proxy', 'coapthon.resources', 'coapthon.reverse_proxy',
+              'coapthon.storage'],
     url='https://github.com/philipbl/CoAPy',
     license='MIT License',
     author='Philip Lundrigan',